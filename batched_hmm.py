@@ -0,0 +1,381 @@
+# batched_hmm.py
+# Inference for the HMMs trained by FeatureGenerators.HiddenSpaceGenerator over
+# every series at once. The series are padded into a single array and the
+# Viterbi and forward-backward recurrences are done in log space for all of
+# them together, one timestep at a time
+
+import numpy as np
+
+
+def _logsumexp(a, axis):
+    """A numerically stable log(sum(exp(a))) over the axis
+
+    Arguments:
+        a: The array of log values
+        axis: The axis to sum over
+    """
+    top = np.max(a, axis=axis, keepdims=True)
+    top = np.where(np.isfinite(top), top, 0.)
+    total = np.sum(np.exp(a - top), axis=axis, keepdims=True)
+    # where every value is -inf the sum is 0, whose log is -inf
+    return (np.where(total > 0, np.log(np.where(total > 0, total, 1.)),
+                     -np.inf) + top).squeeze(axis)
+
+
+class HMMParams():
+    """The parameters of an HMM with a multivariate gaussian emission for each
+    hidden state, as numpy arrays in log space.
+    """
+    def __init__(self, log_start, log_trans, means, covs, log_end=None):
+        """
+        Arguments:
+            log_start: The log probability of starting in each state
+            log_trans: The log probability of transitioning from each state
+                (rows) to each state (columns)
+            means: The mean of each state's emission
+            covs: The covariance of each state's emission
+            log_end: The log probability of each state ending the series. If
+                None then the series can end in any state.
+        """
+        self.log_start = np.asarray(log_start, dtype=float)
+        self.log_trans = np.asarray(log_trans, dtype=float)
+        self.means = np.asarray(means, dtype=float)
+        self.covs = np.asarray(covs, dtype=float)
+        self.log_end = None if log_end is None else \
+            np.asarray(log_end, dtype=float)
+
+    @property
+    def n_components(self):
+        return self.log_start.shape[0]
+
+    def to_dict(self):
+        """Returns the parameters as a dict of numpy arrays, for saving
+        """
+        params = {'log_start': self.log_start, 'log_trans': self.log_trans,
+                  'means': self.means, 'covs': self.covs}
+        if self.log_end is not None:
+            params['log_end'] = self.log_end
+        return params
+
+    @classmethod
+    def from_dict(cls, params):
+        """Makes the parameters from the result of to_dict
+
+        Arguments:
+            params: The dict of parameters
+        """
+        return cls(params['log_start'], params['log_trans'], params['means'],
+                   params['covs'], params.get('log_end', None))
+
+    @classmethod
+    def from_pomegranate(cls, hmm):
+        """Gets the parameters of a trained pomegranate HiddenMarkovModel whose
+        states have MultivariateGaussianDistributions.
+
+        Arguments:
+            hmm: The trained HiddenMarkovModel
+        """
+        # the silent start and end states come after the emitting ones
+        emitting = [i for i, state in enumerate(hmm.states)
+                    if state.distribution is not None]
+        trans = hmm.dense_transition_matrix()
+
+        with np.errstate(divide='ignore'):
+            log_start = np.log(trans[hmm.start_index, emitting])
+            log_trans = np.log(trans[np.ix_(emitting, emitting)])
+            end = trans[emitting, hmm.end_index]
+            # only a finite model (one with transitions into the end state)
+            # accounts for how likely each state is to end the series
+            log_end = np.log(end) if end.sum() > 0 else None
+
+        means, covs = zip(*(hmm.states[i].distribution.parameters
+                            for i in emitting))
+        return cls(log_start, log_trans, np.array(means), np.array(covs),
+                   log_end)
+
+
+def series_bounds(series_ids):
+    """Returns where each series starts and its length, given the series id of
+    each row. A new series starts wherever the id changes.
+
+    Arguments:
+        series_ids: The series id of each row
+    """
+    series_ids = np.asarray(series_ids)
+    starts = np.flatnonzero(np.concatenate(
+        ([True], series_ids[1:] != series_ids[:-1])))
+    lengths = np.diff(np.append(starts, len(series_ids)))
+    return starts, lengths
+
+
+def pad_series(X):
+    """Arranges the rows of X into a padded array with a row for each series
+    and a column for each timestep. Returns the padded inputs, the length of
+    each series and the (series, timestep) of each row of X.
+
+    Arguments:
+        X: The inputs with first column the series id
+    """
+    X = np.asarray(X)
+    starts, lengths = series_bounds(X[:, 0])
+
+    series = np.repeat(np.arange(len(starts)), lengths)
+    steps = np.arange(X.shape[0]) - starts[series]
+
+    padded = np.zeros((len(starts), lengths.max() if len(lengths) else 0,
+                       X.shape[1] - 1))
+    padded[series, steps] = X[:, 1:]
+    return padded, lengths, (series, steps)
+
+
+def log_emissions(params, padded):
+    """Returns the log likelihood of each padded input under each state's
+    emission, with shape (series, timesteps, states).
+
+    Arguments:
+        params: The HMMParams
+        padded: The padded inputs from pad_series
+    """
+    flat = padded.reshape(-1, padded.shape[-1])
+    d = flat.shape[1]
+    out = np.empty((flat.shape[0], params.n_components))
+    for k in range(params.n_components):
+        cov = params.covs[k]
+        try:
+            chol = np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            chol = np.linalg.cholesky(cov + 1e-8 * np.eye(d))
+        z = np.linalg.solve(chol, (flat - params.means[k]).T)
+        out[:, k] = (-0.5 * (z * z).sum(axis=0) -
+                     np.log(np.diag(chol)).sum() - 0.5 * d * np.log(2 * np.pi))
+    return out.reshape(padded.shape[0], padded.shape[1], params.n_components)
+
+
+def _viterbi_forward(params, log_emit, lengths):
+    """Returns the Viterbi scores of each state at the last step of every
+    series and the backpointers of every step
+
+    Arguments:
+        params: The HMMParams
+        log_emit: The log emissions from log_emissions
+        lengths: The length of each series
+    """
+    S, T, K = log_emit.shape
+    back = np.zeros((S, T, K), dtype=int)
+    delta = params.log_start + log_emit[:, 0]
+    for t in range(1, T):
+        scores = delta[:, :, None] + params.log_trans[None]
+        back[:, t] = np.argmax(scores, axis=1)
+        new = np.max(scores, axis=1) + log_emit[:, t]
+        # series which already ended keep their final scores
+        active = (t < lengths)[:, None]
+        delta = np.where(active, new, delta)
+    return delta, back
+
+
+def viterbi(params, log_emit, lengths):
+    """Returns the most likely sequence of hidden states of every series, as a
+    (series, timesteps) array. Steps past the end of a series are -1.
+
+    Arguments:
+        params: The HMMParams
+        log_emit: The log emissions from log_emissions
+        lengths: The length of each series
+    """
+    S, T, K = log_emit.shape
+    delta, back = _viterbi_forward(params, log_emit, lengths)
+
+    if params.log_end is not None:
+        delta = delta + params.log_end
+
+    path = np.full((S, T), -1, dtype=int)
+    state = np.argmax(delta, axis=1)
+    rows = np.arange(S)
+    for t in range(T - 1, -1, -1):
+        # only series long enough to have this step take part in backtracking
+        active = t < lengths
+        path[active, t] = state[active]
+        if t > 0:
+            state = np.where(active, back[rows, t, state], state)
+    return path
+
+
+def _forward(params, log_emit):
+    """Returns the log forward probabilities of every step of every series,
+    as a (series, timesteps, states) array
+
+    Arguments:
+        params: The HMMParams
+        log_emit: The log emissions from log_emissions
+    """
+    S, T, K = log_emit.shape
+    alpha = np.zeros((S, T, K))
+    alpha[:, 0] = params.log_start + log_emit[:, 0]
+    for t in range(1, T):
+        alpha[:, t] = _logsumexp(alpha[:, t - 1, :, None] +
+                                 params.log_trans[None], axis=1) + \
+            log_emit[:, t]
+    return alpha
+
+
+def _backward(params, log_emit, lengths):
+    """Returns the log backward probabilities of every step of every series,
+    as a (series, timesteps, states) array
+
+    Arguments:
+        params: The HMMParams
+        log_emit: The log emissions from log_emissions
+        lengths: The length of each series
+    """
+    S, T, K = log_emit.shape
+    # the backward pass starts from the last step of each series separately
+    end = np.zeros(K) if params.log_end is None else params.log_end
+    beta = np.zeros((S, T, K))
+    beta[np.arange(S), lengths - 1] = end
+    for t in range(T - 2, -1, -1):
+        step = _logsumexp(params.log_trans[None] +
+                          (log_emit[:, t + 1] + beta[:, t + 1])[:, None, :],
+                          axis=2)
+        inside = (t + 1 < lengths)[:, None]
+        beta[:, t] = np.where(inside, step, beta[:, t])
+    return beta
+
+
+def posteriors(params, log_emit, lengths):
+    """Returns the log posterior probability of each hidden state at every
+    step of every series by the forward-backward algorithm, as a
+    (series, timesteps, states) array. Steps past the end of a series are 0.
+
+    Arguments:
+        params: The HMMParams
+        log_emit: The log emissions from log_emissions
+        lengths: The length of each series
+    """
+    S, T, K = log_emit.shape
+    active = np.arange(T)[None, :] < lengths[:, None]
+    alpha = _forward(params, log_emit)
+
+    beta = _backward(params, log_emit, lengths)
+
+    log_post = alpha + beta
+    log_post -= _logsumexp(log_post, axis=2)[:, :, None]
+    return np.where(active[:, :, None], log_post, 0.)
+
+
+def predict(params, X, algorithm='map'):
+    """Returns the hidden state of every row of X as a single column, with all
+    of the series decoded at once.
+
+    Arguments:
+        params: The HMMParams
+        X: The inputs with first column the series id
+        algorithm: Either 'map' for the most likely state of each step by the
+            forward-backward algorithm (the default of pomegranate's predict)
+            or 'viterbi' for the most likely sequence of states.
+    """
+    padded, lengths, (series, steps) = pad_series(X)
+    log_emit = log_emissions(params, padded)
+    if algorithm == 'viterbi':
+        states = viterbi(params, log_emit, lengths)
+    else:
+        states = np.argmax(posteriors(params, log_emit, lengths), axis=2)
+    return states[series, steps].reshape(-1, 1)
+
+
+def expected_statistics(params, X):
+    """Returns the expected sufficient statistics of the series of X for an
+    EM (Baum-Welch) update, as a dict: the expected number of series starting
+    in each state ('start'), of transitions between each pair of states
+    ('trans'), and the posterior weighted count ('weights'), sum ('sums') and
+    sum of outer products ('outers') of the inputs of each state, plus the
+    log likelihood of X ('loglik'). These add up over any partition of the
+    series, eg. chunks of a dataset too large for memory.
+
+    Arguments:
+        params: The HMMParams
+        X: The inputs with first column the series id
+    """
+    padded, lengths, (series, steps) = pad_series(np.asarray(X, dtype=float))
+    S, T, K = padded.shape[0], padded.shape[1], params.n_components
+    log_emit = log_emissions(params, padded)
+    alpha = _forward(params, log_emit)
+    beta = _backward(params, log_emit, lengths)
+
+    # the log likelihood of each series from the end of its forward pass
+    end = np.zeros(K) if params.log_end is None else params.log_end
+    loglik = _logsumexp(alpha[np.arange(S), lengths - 1] + end, axis=1)
+
+    # the posterior of each state only at the steps within each series, as
+    # the padded steps past its end are meaningless (and can overflow)
+    weights = np.exp(alpha[series, steps] + beta[series, steps] -
+                     loglik[series][:, None])
+    start = np.exp(alpha[:, 0] + beta[:, 0] - loglik[:, None])
+    trans = np.zeros((K, K))
+    for t in range(T - 1):
+        inside = t + 1 < lengths
+        if not inside.any():
+            break
+        xi = (alpha[inside, t][:, :, None] + params.log_trans[None] +
+              (log_emit[inside, t + 1] + beta[inside, t + 1])[:, None, :] -
+              loglik[inside][:, None, None])
+        trans += np.exp(xi).sum(axis=0)
+
+    x = padded[series, steps]
+    return {'start': start.sum(axis=0), 'trans': trans,
+            'weights': weights.sum(axis=0), 'sums': weights.T.dot(x),
+            'outers': np.einsum('nk,ni,nj->kij', weights, x, x),
+            'loglik': loglik.sum()}
+
+
+def next_log_prior(params, X, ids, algorithm='map'):
+    """Returns the (unnormalized) log score of each hidden state at the step
+    after the last of each of the given series, before seeing its inputs, as
+    a (len(ids), states) array. With predict_next this decodes games appended
+    to the end of the series without decoding the series again.
+
+    Arguments:
+        params: The HMMParams
+        X: The inputs with first column the series id
+        ids: The series ids to get the scores of. Ids with no rows in X are
+            treated as empty series.
+        algorithm: See predict
+    """
+    X = np.asarray(X, dtype=float)
+    prior = np.tile(params.log_start, (len(ids), 1))
+    if X.shape[0] == 0:
+        return prior
+
+    padded, lengths, _ = pad_series(X)
+    log_emit = log_emissions(params, padded)
+    if algorithm == 'viterbi':
+        last = _viterbi_forward(params, log_emit, lengths)[0]
+        step = np.max(last[:, :, None] + params.log_trans[None], axis=1)
+    else:
+        alpha = _forward(params, log_emit)
+        last = alpha[np.arange(len(lengths)), lengths - 1]
+        step = _logsumexp(last[:, :, None] + params.log_trans[None], axis=1)
+
+    starts, _ = series_bounds(X[:, 0])
+    where = {sid: i for i, sid in enumerate(X[starts, 0])}
+    for i, sid in enumerate(ids):
+        if sid in where:
+            prior[i] = step[where[sid]]
+    return prior
+
+
+def predict_next(params, log_prior, which, X):
+    """Returns the hidden state of each row of X as the next step of a series,
+    as a single column. Gives the same states as predict on the series with
+    the row appended.
+
+    Arguments:
+        params: The HMMParams
+        log_prior: The result of next_log_prior
+        which: For each row of X, the row of log_prior of its series
+        X: The inputs of the new steps, without a series id
+    """
+    X = np.asarray(X, dtype=float)
+    scores = log_prior[which] + log_emissions(params, X[None])[0]
+    if params.log_end is not None:
+        scores = scores + params.log_end
+    return np.argmax(scores, axis=1).reshape(-1, 1)
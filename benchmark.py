@@ -0,0 +1,229 @@
+# benchmark.py
+# Times each stage of the pipeline on synthetic leagues of several sizes, as
+# multiples of the real data: parsing the boxscores (scrape.parse_game),
+# generating the features (feature_gen.generate_features) and cross validating
+# each model (train_models). The time and peak memory of every stage at every
+# size is written to a JSON results file, so that the effect of a change on
+# how the pipeline scales can be measured and compared between runs
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+import cv_harness
+import hmm_cache
+import synthetic
+
+from feature_gen import generate_features
+from parallel_cv import ParallelCV
+from train_models import _MODELS, get_model_spec
+
+
+class Measure():
+    """Times the code run within it and, if tracing, its peak memory as
+    allocated through python (which includes numpy's arrays). The high water
+    mark of the whole process's memory is always recorded after it, which is
+    cheap but only grows from stage to stage.
+    """
+    def __init__(self, trace=False):
+        """
+        Arguments:
+            trace: Whether to trace the memory, which slows down python code
+        """
+        self.trace = trace
+        self.seconds = 0.
+        self.peak_bytes = None
+        self.max_rss_bytes = None
+
+    def __enter__(self):
+        if self.trace:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        if self.trace:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        # in kilobytes on linux
+        self.max_rss_bytes = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return False
+
+
+def league_size(scale, n_teams=None, games_per_team=None, n_seasons=None):
+    """Returns the size of the league scale times the real data, by the
+    number of seasons unless given
+
+    Arguments:
+        scale: The multiple of the real data
+        n_teams: The number of teams, default the real number
+        games_per_team: The games each team plays a season, default the real
+            number
+        n_seasons: The number of seasons, default scale times the real number
+    """
+    size = dict(synthetic.REAL_SIZE)
+    size['n_seasons'] = max(1, int(round(scale * size['n_seasons'])))
+    for key, value in (('n_teams', n_teams),
+                       ('games_per_team', games_per_team),
+                       ('n_seasons', n_seasons)):
+        if value is not None:
+            size[key] = value
+    return size
+
+
+def bench_scale(scale, size, models, missing_rate=0.01, seed=0, n_splits=5,
+                n_jobs=1, trace=False, verbose=False):
+    """Runs every stage on a synthetic league and returns a result dict for
+    each stage
+
+    Arguments:
+        scale: The multiple of the real data, for the results
+        size: The league_size
+        models: The names of the models to cross validate
+        missing_rate: The probability that each boxscore total is unknown
+        seed: The seed of the league
+        n_splits: The number of folds of the cross validation
+        n_jobs: The number of processes the folds are run on. The memory of
+            the worker processes isn't traced.
+        trace: Whether to trace the memory
+        verbose: Whether to print each result as it finishes
+    """
+    results = []
+
+    def record(stage, rows, measure):
+        result = dict(size, scale=scale, missing_rate=missing_rate,
+                      stage=stage, rows=rows, seconds=measure.seconds,
+                      peak_bytes=measure.peak_bytes,
+                      max_rss_bytes=measure.max_rss_bytes)
+        results.append(result)
+        if verbose:
+            print('SCALE {} {}: {} ROWS IN {:.3f}s, PEAK {}, MAX RSS '
+                  '{:.1f}MB'.format(scale, stage, rows, measure.seconds,
+                                    'UNTRACED' if measure.peak_bytes is None
+                                    else '{:.1f}MB'.format(
+                                        measure.peak_bytes / 1e6),
+                                    measure.max_rss_bytes / 1e6))
+
+    # the boxscores are made before parsing, so only the parsing is timed
+    years = range(2006, 2006 + size['n_seasons'])
+    payloads = list(synthetic.generate_boxscores(missing_rate=missing_rate,
+                                                 seed=seed, **size))
+    with Measure(trace) as measure:
+        games = list(synthetic.parse_boxscores(payloads))
+    record('parse', len(payloads), measure)
+    del payloads
+
+    data = synthetic.make_league(games, years, size['n_teams'])
+    del games
+    with Measure(trace) as measure:
+        X, y = generate_features(data)
+    record('features', X.shape[0], measure)
+    del data
+
+    # the HMMs of a smaller league mustn't warm start this one's
+    hmm_cache._CACHES.clear()
+    with ParallelCV(n_jobs) as executor:
+        for name in models:
+            with Measure(trace) as measure:
+                results_ = cv_harness.schedule(X, y, [get_model_spec(name)],
+                                               executor, n_splits=n_splits)
+                accuracy = np.mean(results_[0].result())
+            record('train:' + name, results_[0].shape[0], measure)
+            results[-1]['accuracy'] = accuracy
+    return results
+
+
+def environment():
+    """Describes the machine and code the benchmarks ran on
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.decode().strip()
+    except Exception:
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(),
+            'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count()}
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the pipeline on synthetic leagues '
+                    'which are multiples of the size of the real data.')
+    parser.add_argument('-o', '--outfile', type=str,
+                        default='benchmarks.json',
+                        help='The file to write the results to as JSON.')
+    parser.add_argument('--scales', type=str, default='1,10,100',
+                        help='The multiples of the real data, separated by '
+                             'commas.')
+    parser.add_argument('--teams', type=int, default=None,
+                        help='Fix the number of teams rather than scaling the '
+                             'number of seasons.')
+    parser.add_argument('--games', type=int, default=None,
+                        help='Fix the number of games each team plays a '
+                             'season.')
+    parser.add_argument('--seasons', type=int, default=None,
+                        help='Fix the number of seasons.')
+    parser.add_argument('--missing-rate', type=float, default=0.01,
+                        help='The probability that each boxscore total is '
+                             'unknown.')
+    parser.add_argument('--models', type=str, default=','.join(_MODELS),
+                        help='The models to cross validate, separated by '
+                             'commas, or none.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the synthetic leagues.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes to run the folds on.')
+    parser.add_argument('--memory', action='store_true',
+                        help='Trace the peak memory of each stage, which '
+                             'slows down the python heavy stages many times '
+                             'over, so the times are no longer comparable.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print each result as it finishes.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    models = [name for name in args.models.split(',')
+              if name and name != 'none']
+    unknown = [name for name in models if name not in _MODELS]
+    if unknown:
+        print('UNKNOWN', *unknown)
+        exit(1)
+
+    results = []
+    for scale in [float(s) for s in args.scales.split(',') if s]:
+        size = league_size(scale, args.teams, args.games, args.seasons)
+        results.extend(bench_scale(scale, size, models, args.missing_rate,
+                                   args.seed, n_jobs=args.jobs,
+                                   trace=args.memory,
+                                   verbose=args.verbose))
+        # written after every scale so the smaller ones are kept if a larger
+        # one runs out of memory
+        with open(args.outfile, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+# bracket.py
+# Simulates the tournament from the pairwise win probabilities of a trained
+# model. Every simulated tournament is played at once, round by round, as
+# vectorized draws, and the simulations are split into chunks with their own
+# seeds so that the results are the same however many processes (or
+# machines, with workqueue.py) run them
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+
+import numpy as np
+
+import workqueue
+
+from pairwise import SITES, load_matrix
+
+
+# the stages a team can reach, after the First Four
+STAGES = ('R64', 'R32', 'S16', 'E8', 'F4', 'Final', 'Champion')
+
+# the points for a correct pick in each round (ESPN's scoring)
+DEFAULT_SCORING = (10, 20, 40, 80, 160, 320)
+
+
+class Field():
+    """The teams of the tournament and the probability that each beats each
+    other at a neutral site
+    """
+    def __init__(self, slots, probs):
+        """
+        Arguments:
+            slots: The field in bracket order, so that the first round is slot
+                0 against 1, 2 against 3 and so on. Each slot is either a team
+                id or a list of the two team ids of its play in game. The
+                number of slots must be a power of two, eg. 64.
+            probs: A function giving the (teams, teams) matrix of the
+                probability that each team beats each other team at a neutral
+                site, given the list of team ids
+        """
+        slots = [list(slot) if isinstance(slot, (list, tuple)) else [slot]
+                 for slot in slots]
+        if len(slots) & (len(slots) - 1) or len(slots) < 2:
+            raise ValueError('The number of slots must be a power of two')
+        if any(len(slot) not in (1, 2) for slot in slots):
+            raise ValueError('A slot must be a team or a play in game')
+
+        self.teams = [int(tid) for slot in slots for tid in slot]
+        if len(set(self.teams)) != len(self.teams):
+            raise ValueError('A team is in the field more than once')
+
+        # the index of the team(s) of each slot, with -1 if no play in game
+        index = iter(range(len(self.teams)))
+        self.slots = np.array([[next(index) for _ in slot] + [-1] * (2 -
+                               len(slot)) for slot in slots])
+
+        probs = np.array(probs(self.teams), dtype=float)
+        # a matchup the model can't score is a coin flip
+        probs[np.isnan(probs)] = 0.5
+        self.probs = probs
+
+    @property
+    def n_rounds(self):
+        return int(np.log2(len(self.slots)))
+
+
+def pairwise_source(path):
+    """Returns a probability function for a Field from a matrix saved by
+    pairwise.py
+
+    Arguments:
+        path: The saved .npy file
+    """
+    matrix, index, _ = load_matrix(path)
+    neutral = SITES.index('neutral')
+
+    def _probs(teams):
+        missing = [tid for tid in teams if tid not in index]
+        if missing:
+            raise ValueError('No probabilities for teams {}'.format(missing))
+        rows = [index[tid] for tid in teams]
+        return matrix[neutral][np.ix_(rows, rows)]
+    return _probs
+
+
+def model_source(model, data, year=None):
+    """Returns a probability function for a Field from a saved model and the
+    games played so far
+
+    Arguments:
+        model: The TrainedModel from model_io
+        data: The raw data dictionary as given by scrape.py
+        year: The season, default the latest in data
+    """
+    from serve import MatchupPredictor
+
+    predictor = MatchupPredictor(model, data, year)
+
+    def _probs(teams):
+        n = len(teams)
+        a = np.repeat(teams, n)
+        b = np.tile(teams, n)
+        matchups = [(int(i), int(j), 'neutral') for i, j in zip(a, b)]
+        return predictor.predict(matchups).reshape(n, n)
+    return _probs
+
+
+def simulate(field, n_sims, seed=None):
+    """Plays n_sims tournaments at once and returns how many times each team
+    reached each of STAGES (or as many as the field has rounds), as a
+    (teams, rounds + 1) array
+
+    Arguments:
+        field: The Field
+        n_sims: The number of tournaments
+        seed: The seed, or a numpy SeedSequence, of the random draws
+    """
+    rng = np.random.default_rng(seed)
+    probs = field.probs
+    counts = np.zeros((len(field.teams), field.n_rounds + 1), dtype=np.int64)
+
+    # the play in games, where there are any
+    first, second = field.slots[:, 0], field.slots[:, 1]
+    winners = np.tile(first, (n_sims, 1))
+    play_in = np.flatnonzero(second >= 0)
+    if len(play_in):
+        p = probs[first[play_in], second[play_in]]
+        wins = rng.random((n_sims, len(play_in))) < p
+        winners[:, play_in] = np.where(wins, first[play_in],
+                                       second[play_in])
+
+    # each round, every simulation's 2k remaining teams play pairwise
+    for r in range(field.n_rounds + 1):
+        counts[:, r] = np.bincount(winners.ravel(),
+                                   minlength=len(field.teams))
+        if r == field.n_rounds:
+            break
+        a, b = winners[:, 0::2], winners[:, 1::2]
+        winners = np.where(rng.random(a.shape) < probs[a, b], a, b)
+    return counts
+
+
+def _simulate_chunk(args):
+    """Simulates one chunk in a worker process
+
+    Arguments:
+        args: The (field, n_sims, seed) of the chunk
+    """
+    field, n_sims, seed = args
+    return simulate(field, n_sims, seed)
+
+
+def run(field, n_sims, seed=None, n_jobs=1, chunk_size=100000,
+        executor=None):
+    """Simulates n_sims tournaments in chunks and returns the probability
+    that each team reaches each stage, as a (teams, rounds + 1) array. Each
+    chunk has its own seed spawned from seed, so the result only depends on
+    the seed and chunk_size, not on n_jobs.
+
+    Arguments:
+        field: The Field
+        n_sims: The number of tournaments
+        seed: The seed of the random draws. If None then it isn't repeatable.
+        n_jobs: The number of processes, where None or below 1 is every cpu
+        chunk_size: The number of tournaments simulated at once
+        executor: A workqueue.Coordinator to run the chunks on instead of
+            local processes
+    """
+    sizes = [chunk_size] * (n_sims // chunk_size)
+    if n_sims % chunk_size:
+        sizes.append(n_sims % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    chunks = [(field, size, s) for size, s in zip(sizes, seeds)]
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    if executor is not None:
+        counts = sum(executor.map(_simulate_chunk, chunks))
+    elif n_jobs == 1 or len(chunks) == 1:
+        counts = sum(map(_simulate_chunk, chunks))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            counts = sum(pool.map(_simulate_chunk, chunks))
+    return counts / float(n_sims)
+
+
+def optimal_bracket(field, advance, scoring=DEFAULT_SCORING):
+    """Returns the bracket with the highest expected score and that score.
+    The bracket is the list of the picked winners of each round (as team ids)
+    and since a pick is worth scoring[r] times the probability that the team
+    wins round r, the best consistent bracket is found exactly by working up
+    the bracket, keeping the best expected score of each subtree for each team
+    picked to win it.
+
+    Arguments:
+        field: The Field
+        advance: The result of run
+        scoring: The points for a correct pick in each round
+    """
+    n = len(field.teams)
+    # the teams of each subtree of the current round, as a mask
+    members = np.zeros((len(field.slots), n), dtype=bool)
+    for i, slot in enumerate(field.slots):
+        members[i, slot[slot >= 0]] = True
+    # best[i, t] is the best expected score of subtree i with t picked as
+    # its winner, -inf if t isn't in it
+    best = np.where(members, 0., -np.inf)
+    picks = []
+
+    for r in range(field.n_rounds):
+        left, right = best[0::2], best[1::2]
+        # picking t from one side means picking the best of the other side
+        others = np.where(members[0::2], right.max(axis=1)[:, None],
+                          left.max(axis=1)[:, None])
+        own = np.where(members[0::2], left, right)
+        best = own + others + scoring[r] * advance[:, r + 1]
+        members = members[0::2] | members[1::2]
+        best[~members] = -np.inf
+        picks.append(best)
+
+    # pick the champion, then the winner of every subtree below down to the
+    # first round
+    bracket = [[int(np.argmax(picks[-1][0]))]]
+    for r in range(field.n_rounds - 2, -1, -1):
+        above = bracket[0]
+        below = []
+        for i, winner in enumerate(above):
+            for child in (2 * i, 2 * i + 1):
+                if np.isfinite(picks[r][child, winner]):
+                    below.append(winner)
+                else:
+                    below.append(int(np.argmax(picks[r][child])))
+        bracket.insert(0, below)
+
+    score = float(picks[-1][0].max())
+    return [[field.teams[t] for t in picked] for picked in bracket], score
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Simulate the tournament many times to get each team\'s '
+                    'chance of reaching each round and the bracket with the '
+                    'best expected score.')
+    parser.add_argument('field', type=str,
+                        help='A JSON list of the teams in bracket order, '
+                             'where a play in game is a list of two teams.')
+    parser.add_argument('--matrix', type=str, default=None,
+                        help='The probabilities saved by pairwise.py')
+    parser.add_argument('--model', type=str, default=None,
+                        help='A model saved by train_models.py --save, used '
+                             'with --data instead of --matrix.')
+    parser.add_argument('--data', type=str, default=None,
+                        help='The raw data from scrape.py for --model.')
+    parser.add_argument('-n', '--sims', type=int, default=1000000,
+                        help='The number of tournaments to simulate.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='The seed, for repeatable results.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes, or 0 for every cpu.')
+    parser.add_argument('--scoring', type=str,
+                        default=','.join(map(str, DEFAULT_SCORING)),
+                        help='The points for a correct pick in each round, '
+                             'separated by commas.')
+    parser.add_argument('-o', '--outfile', type=str, default=None,
+                        help='The file to save the results to as JSON.')
+    workqueue.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    try:
+        with open(args.field, 'r') as f:
+            slots = json.load(f)
+    except:
+        print('COULDN\'T OPEN', args.field)
+        exit(1)
+
+    if args.matrix is not None:
+        source = pairwise_source(args.matrix)
+    elif args.model is not None and args.data is not None:
+        from model_io import load_model
+        with open(args.data, 'r') as f:
+            source = model_source(load_model(args.model), json.load(f))
+    else:
+        print('EITHER --matrix OR --model AND --data ARE NEEDED')
+        exit(1)
+
+    field = Field(slots, source)
+    scoring = [float(points) for points in args.scoring.split(',')]
+    if len(scoring) != field.n_rounds:
+        print('THE SCORING NEEDS', field.n_rounds, 'ROUNDS')
+        exit(1)
+
+    if args.queue is not None:
+        with workqueue.start_coordinator(args) as coordinator:
+            advance = run(field, args.sims, args.seed, executor=coordinator)
+    else:
+        advance = run(field, args.sims, args.seed, args.jobs)
+    bracket, score = optimal_bracket(field, advance, scoring)
+
+    # the stages named from the champion backwards, so smaller fields work
+    stages = STAGES[-(field.n_rounds + 1):] \
+        if field.n_rounds < len(STAGES) else \
+        ['R{}'.format(2 ** (field.n_rounds - r))
+         for r in range(field.n_rounds - 1)] + ['Final', 'Champion']
+    # most likely champions first
+    order = np.lexsort(advance.T)[::-1]
+    print('TEAM', *stages, sep='\t')
+    for t in order:
+        print(field.teams[t], *['{:.4f}'.format(p) for p in advance[t]],
+              sep='\t')
+    print('BEST BRACKET EXPECTED SCORE', score)
+    print('CHAMPION', bracket[-1][0])
+
+    if args.outfile is not None:
+        with open(args.outfile, 'w') as f:
+            json.dump({'sims': args.sims, 'seed': args.seed,
+                       'stages': list(stages),
+                       'advance': {str(tid): advance[t].tolist()
+                                   for t, tid in enumerate(field.teams)},
+                       'bracket': bracket, 'expected_score': score}, f)
+
+
+if __name__ == '__main__':
+    main()
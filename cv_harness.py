@@ -0,0 +1,283 @@
+# cv_harness.py
+# A single K-fold cross validation routine for every model in train_models.py.
+# Each model is described by its stages (input selection, an optional latent
+# feature generator and the classifier), and the output of every stage is
+# memoized per fold so that models sharing stages only compute them once
+
+import os
+
+import numpy as np
+
+import instrument
+
+
+# the memoized outputs of the stages, keyed by the dataset, the fold and the
+# stages which produced them. Kept for the life of the process, so the worker
+# processes of a ParallelCV also reuse them between the tasks they run
+_CACHE = {}
+
+# the datasets given out tokens, by their token. Keeping them means the id
+# in a token can't be reused by another array while the values memoized
+# under it are still cached
+_DATASETS = {}
+
+
+def memoize(key, func, stage='value'):
+    """Returns the cached value for the key, calling func to compute it only
+    if it hasn't been yet.
+
+    Arguments:
+        key: A hashable key identifying the value
+        func: A function with no arguments computing the value
+        stage: The name of the stage computing it, for the profile
+    """
+    if key not in _CACHE:
+        with instrument.span('cv_harness.' + stage):
+            _CACHE[key] = func()
+    else:
+        instrument.count('cv_harness.reused.' + stage)
+    return _CACHE[key]
+
+
+def clear_cache():
+    """Forgets all the memoized stage outputs of this process, and the
+    datasets they were memoized for
+    """
+    _CACHE.clear()
+    _DATASETS.clear()
+
+
+def dataset_token(X):
+    """Returns a token identifying the dataset, which is also valid in the
+    worker processes. The dataset is kept until clear_cache, so that no other
+    array can be given the same token while values are memoized under it.
+
+    Arguments:
+        X: The entire matrix of features
+    """
+    token = '{}:{}'.format(os.getpid(), id(X))
+    _DATASETS[token] = X
+    return token
+
+
+class ModelSpec():
+    """The stages making up a model which the harness can cross validate.
+    """
+    def __init__(self, name, inputs, classifier, latent=None):
+        """
+        Arguments:
+            name: The name of the model
+            inputs: A function taking X, y and keepSeriesID and returning the
+                cleaned inputs and labels, eg. get_non_stat_inputs
+            classifier: The classifier stage. Must have a key() identifying
+                it and fit(X, y) returning a model with a predict(X) method.
+                If it also has block_stats(X, y, blocks) and
+                fit_excluding(stats, k), then models without a latent stage
+                are fit from the statistics of every fold's held out block,
+                which are only computed once.
+            latent: The optional latent feature stage. Must have a key()
+                identifying it, fit(X) returning a model over the inputs with
+                the series id, and transform(model, X) returning the columns
+                that replace the series id for the classifier
+        """
+        self.name = name
+        self.inputs = inputs
+        self.classifier = classifier
+        self.latent = latent
+
+    def input_key(self):
+        """The key of the input selection stage. Every model with the same
+        selection shares its cleaned inputs, which keep the series id for the
+        temporal models' latent stage while the others drop it.
+        """
+        return (self.inputs.__name__,)
+
+
+def fit_spec(X, y, train_idx, token, spec, blocks):
+    """Fits a single model on the fold's training rows, reusing any stage
+    already computed for this fold. Returns the classifier and the latent
+    model (None if the model has no latent stage).
+
+    Arguments:
+        X: The cleaned inputs, with the series id
+        y: The labels
+        train_idx: The rows to train on
+        token: Identifies the cleaned inputs, and the fold as its last entry
+        spec: The ModelSpec to fit
+        blocks: A function returning the held out rows of every fold
+    """
+    fold = token[-1]
+
+    if spec.latent is not None:
+        X_train = X[train_idx]
+        latent_key = spec.latent.key()
+        latent = memoize(token + ('latent',) + latent_key,
+                         lambda: spec.latent.fit(X_train), 'latent')
+
+        # replace the series id with the latent features
+        X_train = np.hstack((X_train[:, 1:], memoize(
+            token + ('latent_train',) + latent_key,
+            lambda: spec.latent.transform(latent, X_train), 'transform')))
+
+        clf = memoize(token + ('classifier',) + latent_key +
+                      spec.classifier.key(),
+                      lambda: spec.classifier.fit(X_train, y[train_idx]),
+                      'classifier')
+        return clf, latent
+
+    # only the latent stage uses the series id
+    X = X[:, 1:]
+    if hasattr(spec.classifier, 'fit_excluding'):
+        # the inputs are the same on every fold, so the statistics of each
+        # held out block are computed once and the fold's model is made
+        # from them without another pass over the training rows
+        stats = memoize(token[:-1] + ('block_stats',) +
+                        spec.classifier.key(),
+                        lambda: spec.classifier.block_stats(X, y, blocks()),
+                        'block_stats')
+        clf = memoize(token + ('classifier',) + spec.classifier.key(),
+                      lambda: spec.classifier.fit_excluding(stats, fold),
+                      'classifier')
+    else:
+        clf = memoize(token + ('classifier',) + spec.classifier.key(),
+                      lambda: spec.classifier.fit(X[train_idx], y[train_idx]),
+                      'classifier')
+    return clf, None
+
+
+def classifier_inputs(spec, latent, X):
+    """Returns the classifier's inputs for rows of the cleaned inputs, which
+    replace the series id with the latent features if the model has them
+
+    Arguments:
+        spec: The ModelSpec
+        latent: The fitted latent model, from fit_spec
+        X: The rows of the cleaned inputs, with the series id
+    """
+    if spec.latent is None:
+        return X[:, 1:]
+    return np.hstack((X[:, 1:], spec.latent.transform(latent, X)))
+
+
+def _score_spec(X, y, train_idx, test_idx, token, spec, blocks):
+    """Fits a single model on the fold and returns its accuracy, reusing any
+    stage already computed for this fold.
+
+    Arguments:
+        X: The cleaned inputs
+        y: The labels
+        train_idx: The rows to train on
+        test_idx: The rows to test on
+        token: Identifies the cleaned inputs, and the fold as its last entry
+        spec: The ModelSpec to score
+        blocks: A function returning the held out rows of every fold
+    """
+    clf, latent = fit_spec(X, y, train_idx, token, spec, blocks)
+
+    X_test = X[test_idx]
+    if spec.latent is not None:
+        X_test = np.hstack((X_test[:, 1:], memoize(
+            token + ('latent_test',) + spec.latent.key(),
+            lambda: spec.latent.transform(latent, X_test), 'transform')))
+    else:
+        X_test = X_test[:, 1:]
+
+    return np.mean(np.asarray(clf.predict(X_test)).flatten() ==
+                   y[test_idx].flatten())
+
+
+def _score_fold(X, y, train_idx, test_idx, token, specs, n_folds, fold):
+    """Scores all the models sharing these cleaned inputs on a single fold.
+
+    Arguments:
+        X: The cleaned inputs
+        y: The labels
+        train_idx: The rows to train on
+        test_idx: The rows to test on
+        token: Identifies the cleaned inputs
+        specs: The ModelSpecs to score, all with the same input stage
+        n_folds: The number of folds
+        fold: The index of the fold
+    """
+    def blocks():
+        from sklearn.model_selection import KFold
+        return [test for _, test in KFold(n_splits=n_folds).split(X, y)]
+
+    return [_score_spec(X, y, train_idx, test_idx, token + (fold,), spec,
+                        blocks)
+            for spec in specs]
+
+
+class SpecResults():
+    """The pending fold accuracies of one of the models scheduled together.
+    """
+    def __init__(self, folds, idx, shape):
+        """
+        Arguments:
+            folds: The FoldResults of the group of models
+            idx: The index of this model within its group
+            shape: The shape of the model's cleaned inputs
+        """
+        self._folds = folds
+        self._idx = idx
+        self.shape = shape
+
+    def result(self):
+        """Waits for every fold and returns this model's accuracies in fold
+        order (or the order of the folds scheduled)
+        """
+        return [scores[self._idx] for scores in self._folds.result()]
+
+
+def plan(specs):
+    """Returns the models grouped by their input stage, in the order each
+    input stage first appears. Each group is a branch of the computation:
+    its cleaned inputs and folds are shared by all of its models, and each of
+    its folds is independent of every other fold and branch.
+
+    Arguments:
+        specs: The ModelSpecs to cross validate
+    """
+    groups = {}
+    for spec in specs:
+        groups.setdefault(spec.input_key(), []).append(spec)
+    return groups
+
+
+def schedule(X, y, specs, executor, n_splits=5, token=None, folds=None):
+    """Schedules the K-fold cross validation of every model on the executor
+    and returns their SpecResults in the same order. Models with the same
+    input stage (eg. naive_stat and temporal_stat) are scored together on the
+    same folds of the same cleaned inputs, so that those and any shared
+    latent or classifier stages are only computed once, while the folds of
+    every group run concurrently on the executor.
+
+    Arguments:
+        X: The features generated by feature_gen.py
+        y: The labels
+        specs: The ModelSpecs to cross validate
+        executor: The ParallelCV to run the folds on
+        n_splits: The number of folds to use during KFold cross validation
+        token: Identifies the dataset in the cache. Default is given by
+            dataset_token.
+        folds: The indices of the folds to score, eg. to score a model on
+            only some folds first. Default is every fold.
+    """
+    if token is None:
+        token = dataset_token(X)
+
+    results = {}
+    for key, group in plan(specs).items():
+        _X, _y = memoize((token, 'inputs') + key,
+                         lambda: group[0].inputs(X, y, keepSeriesID=True),
+                         'inputs')
+        pending = executor.submit(_score_fold, _X, _y, n_splits=n_splits,
+                                  pass_fold=True, folds=folds,
+                                  token=(token, n_splits) + key,
+                                  specs=group, n_folds=n_splits)
+        for j, spec in enumerate(group):
+            shape = _X.shape if spec.latent is not None else \
+                (_X.shape[0], _X.shape[1] - 1)
+            results[id(spec)] = SpecResults(pending, j, shape)
+
+    return [results[id(spec)] for spec in specs]
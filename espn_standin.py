@@ -0,0 +1,368 @@
+# espn_standin.py
+# A local stand in for the ESPN endpoints scrape.py uses, so that the scraper
+# can be run, benchmarked and tested offline. It answers from a synthetic
+# league (synthetic.py) or from responses recorded from ESPN, and can slow
+# down and break its responses on purpose: added latency, a bandwidth cap,
+# 429 and 5xx errors and truncated JSON. The faults are decided by hashing the
+# request and how many times it has been made, so the same scrape sees the
+# same faults however its requests are interleaved
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import synthetic
+
+
+# the paths of the endpoints, as in DESIGN.md
+SITE_PREFIX = '/apis/site/v2/sports/basketball/mens-college-basketball'
+BOXSCORE_PATH = '/core/mens-college-basketball/boxscore'
+
+# the errors injected, 429 being ESPN's rate limit
+ERROR_STATUSES = (429, 500, 502, 503)
+
+
+def request_key(path):
+    """Returns the path of a request with its query sorted, so that requests
+    for the same thing are recorded and replayed under the same key
+
+    Arguments:
+        path: The path and query of the request
+    """
+    url = urlparse(path)
+    query = sorted(parse_qs(url.query).items())
+    return url.path + ('?' + urlencode(query, doseq=True) if query else '')
+
+
+class SyntheticSource():
+    """Answers every endpoint from the boxscores of a synthetic league. The
+    teams are split evenly between the conferences.
+    """
+    def __init__(self, boxscores, n_conferences=32):
+        """
+        Arguments:
+            boxscores: An iterable of the (year, game id, boxscore JSON) of
+                every game, as from synthetic.generate_boxscores
+            n_conferences: The number of conferences
+        """
+        self.n_conferences = n_conferences
+        self.games = {}
+        self.schedules = {}
+        teams = set()
+        for year, gid, payload in boxscores:
+            self.games[gid] = payload
+            package = payload['__gamepackage__']
+            for side in ('homeTeam', 'awayTeam'):
+                tid = int(package[side]['id'])
+                teams.add(tid)
+                self.schedules.setdefault((tid, year), []).append(gid)
+        self.teams = sorted(teams)
+
+    def respond(self, path):
+        """Returns the (status, body text) of the request
+
+        Arguments:
+            path: The path and query of the request
+        """
+        url = urlparse(path)
+        query = {key: values[0]
+                 for key, values in parse_qs(url.query).items()}
+        parts = url.path[len(SITE_PREFIX):].strip('/').split('/')
+
+        if url.path == BOXSCORE_PATH:
+            # ESPN answers unknown games without a game package
+            body = self.games.get(int(query.get('gameId', -1)), {})
+        elif not url.path.startswith(SITE_PREFIX):
+            return 404, json.dumps({'error': 'Unknown path ' + url.path})
+        elif parts == ['scoreboard', 'conferences']:
+            # the first is the whole of Division I, which scrape.py skips
+            body = {'conferences': [{'groupId': '50',
+                                     'name': 'NCAA Division I'}] +
+                    [{'groupId': str(g), 'name': 'Conference {}'.format(g)}
+                     for g in range(1, self.n_conferences + 1)]}
+        elif parts == ['teams']:
+            group = int(query.get('groups', 0))
+            body = {'sports': [{'leagues': [{'teams': [
+                {'team': {'id': str(tid), 'location': 'Team',
+                          'name': str(tid)}}
+                for tid in self.teams
+                if tid % self.n_conferences + 1 == group]}]}]}
+        elif len(parts) == 3 and parts[0] == 'teams' and \
+                parts[2] == 'schedule':
+            # only the regular season is synthesized
+            gids = [] if query.get('seasontype') != '2' else \
+                self.schedules.get((int(parts[1]),
+                                    int(query.get('season', 0))), [])
+            body = {'events': [{'id': str(gid)} for gid in gids]}
+        else:
+            return 404, json.dumps({'error': 'Unknown path ' + url.path})
+        return 200, json.dumps(body)
+
+
+class RecordedSource():
+    """Answers from responses recorded from ESPN, one JSON object per line
+    with the request's key, status and body. If recording, requests which
+    weren't recorded yet are made to ESPN and added to the file.
+    """
+    def __init__(self, path, record=False):
+        """
+        Arguments:
+            path: The file of recorded responses
+            record: Whether to fetch and record the responses missing from it
+        """
+        self.path = path
+        self.record = record
+        self.responses = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        response = json.loads(line)
+                        self.responses[response['key']] = \
+                            (response['status'], response['body'])
+        except IOError:
+            if not record:
+                raise
+
+    def _fetch(self, key):
+        """Makes the request to ESPN, returning its (status, body text)
+
+        Arguments:
+            key: The request_key of the request
+        """
+        host = 'http://cdn.espn.com' if key.startswith(BOXSCORE_PATH) \
+            else 'https://site.web.api.espn.com'
+        try:
+            with urllib.request.urlopen(host + key, timeout=30) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode()
+
+    def respond(self, path):
+        """Returns the (status, body text) of the request
+
+        Arguments:
+            path: The path and query of the request
+        """
+        key = request_key(path)
+        if key in self.responses:
+            return self.responses[key]
+        if not self.record:
+            return 404, json.dumps({'error': 'Not recorded ' + key})
+
+        status, body = self._fetch(key)
+        with self._lock:
+            self.responses[key] = (status, body)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'status': status,
+                                    'body': body}) + '\n')
+        return status, body
+
+
+class Faults():
+    """Decides the latency and any fault of each request
+    """
+    def __init__(self, latency=0., jitter=0., bandwidth=None, error_rate=0.,
+                 malformed_rate=0., seed=0):
+        """
+        Arguments:
+            latency: The delay before every response, in seconds
+            jitter: The most extra delay, drawn uniformly, in seconds
+            bandwidth: The most bytes per second of each response, or None
+            error_rate: The probability of a 429 or 5xx error
+            malformed_rate: The probability that the JSON is cut short
+            seed: The seed of the decisions
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+
+    def decide(self, key, attempt):
+        """Returns the (delay in seconds, error status or None, whether to
+        malform the body) of a request, the same every time for the same
+        request and attempt
+
+        Arguments:
+            key: The request_key of the request
+            attempt: How many times the request was made before this one
+        """
+        digest = hashlib.sha256('{}:{}:{}'.format(self.seed, key, attempt)
+                                .encode()).digest()
+        rng = random.Random(int.from_bytes(digest[:8], 'little'))
+        delay = self.latency + self.jitter * rng.random()
+        error = rng.choice(ERROR_STATUSES) \
+            if rng.random() < self.error_rate else None
+        return delay, error, rng.random() < self.malformed_rate
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Answers the ESPN endpoints from the server's source, with its faults,
+    and GET /_standin/stats with how many requests got each outcome
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, text, headers=()):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+
+        # sent in pieces to keep under the bandwidth cap
+        bandwidth = self.server.faults.bandwidth
+        piece = len(body) if not bandwidth else max(1, int(bandwidth / 20))
+        for start in range(0, len(body), max(piece, 1)):
+            self.wfile.write(body[start:start + piece])
+            if bandwidth:
+                time.sleep(len(body[start:start + piece]) / float(bandwidth))
+
+    def do_GET(self):
+        server = self.server
+        if urlparse(self.path).path == '/_standin/stats':
+            with server.lock:
+                self._send(200, json.dumps(server.stats))
+            return
+
+        key = request_key(self.path)
+        with server.lock:
+            attempt = server.attempts.get(key, 0)
+            server.attempts[key] = attempt + 1
+        delay, error, malformed = server.faults.decide(key, attempt)
+        time.sleep(delay)
+
+        if error is not None:
+            outcome = str(error)
+            headers = [('Retry-After', '1')] if error == 429 else []
+            self._send(error, json.dumps({'error': 'Injected'}), headers)
+        else:
+            status, body = server.source.respond(self.path)
+            outcome = str(status)
+            if malformed and status == 200:
+                outcome = 'malformed'
+                body = body[:len(body) // 2]
+            self._send(status, body)
+
+        with server.lock:
+            server.stats[outcome] = server.stats.get(outcome, 0) + 1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(source, address, faults=None, verbose=False):
+    """Makes the stand in server
+
+    Arguments:
+        source: The SyntheticSource or RecordedSource to answer from
+        address: The (host, port) to listen on
+        faults: The Faults to inject, default none
+        verbose: Whether to log every request
+    """
+    server = ThreadingHTTPServer(address, StandinHandler)
+    server.daemon_threads = True
+    server.source = source
+    server.faults = faults if faults is not None else Faults()
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.attempts = {}
+    server.stats = {}
+    return server
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Stand in for ESPN\'s endpoints with a synthetic league '
+                    'or recorded responses, for running scrape.py offline.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The address to listen on.')
+    parser.add_argument('--port', type=int, default=8001,
+                        help='The port to listen on.')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Answer from the responses recorded in this '
+                             'file instead of a synthetic league.')
+    parser.add_argument('--record', type=str, default=None,
+                        help='Like --replay, but fetch the responses missing '
+                             'from the file from ESPN and add them to it.')
+    parser.add_argument('--teams', type=int,
+                        default=synthetic.REAL_SIZE['n_teams'],
+                        help='The number of teams of the synthetic league.')
+    parser.add_argument('--games', type=int,
+                        default=synthetic.REAL_SIZE['games_per_team'],
+                        help='The games each team plays a season.')
+    parser.add_argument('--seasons', type=int,
+                        default=synthetic.REAL_SIZE['n_seasons'],
+                        help='The number of seasons, from 2006.')
+    parser.add_argument('--missing-rate', type=float, default=0.01,
+                        help='The probability that each boxscore total is '
+                             'unknown.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the synthetic league.')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='The delay before every response, in '
+                             'milliseconds.')
+    parser.add_argument('--jitter', type=float, default=0.,
+                        help='The most random extra delay, in milliseconds.')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='The most bytes per second of each response.')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='The probability of a 429 or 5xx error.')
+    parser.add_argument('--malformed-rate', type=float, default=0.,
+                        help='The probability that a response\'s JSON is '
+                             'cut short.')
+    parser.add_argument('--fault-seed', type=int, default=0,
+                        help='The seed of the injected faults.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    if args.replay is not None or args.record is not None:
+        try:
+            source = RecordedSource(args.record or args.replay,
+                                    record=args.record is not None)
+        except:
+            print('COULDN\'T OPEN', args.replay)
+            exit(1)
+    else:
+        source = SyntheticSource(synthetic.generate_boxscores(
+            args.teams, args.games, args.seasons, args.missing_rate,
+            args.seed))
+
+    faults = Faults(args.latency / 1000., args.jitter / 1000., args.bandwidth,
+                    args.error_rate, args.malformed_rate, args.fault_seed)
+    server = make_server(source, (args.host, args.port), faults,
+                         args.verbose)
+    print('STANDING IN FOR ESPN ON http://{}:{}'.format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# extract.py
+# Extracts the team and player stat lines from whole ESPN boxscores, as kept
+# by scrape.py --raw (or synthetic.py --boxscores) with one [game id,
+# boxscore] per line, into compact typed arrays. The file is split into
+# ranges of lines which a pool of processes read, decode and extract, so that
+# new features from the players can be built without downloading the games
+# again
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+
+import numpy as np
+
+import instrument
+
+
+# the labels of ESPN's boxscores which are given as made-attempted, each of
+# which becomes two columns
+MADE_ATTEMPTED = ('FG', '3PT', 'FT')
+
+# the columns of every stat line, in order
+STAT_COLUMNS = ('MIN', 'FGM', 'FGA', '3PTM', '3PTA', 'FTM', 'FTA', 'OREB',
+                'DREB', 'REB', 'AST', 'STL', 'BLK', 'TO', 'PF', 'PTS')
+
+# the value of a stat which is unknown ('--') or isn't in the boxscore
+MISSING = -1
+
+TEAM_DTYPE = np.dtype([('game_id', np.int64), ('team_id', np.int32),
+                       ('home', np.bool_)] +
+                      [(column, np.int16) for column in STAT_COLUMNS])
+
+PLAYER_DTYPE = np.dtype([('game_id', np.int64), ('team_id', np.int32),
+                         ('player_id', np.int64), ('starter', np.bool_)] +
+                        [(column, np.int16) for column in STAT_COLUMNS])
+
+_COLUMN_INDEX = {column: k for k, column in enumerate(STAT_COLUMNS)}
+
+
+def _stat_line(labels, values):
+    """Returns the stats of a line in the order of STAT_COLUMNS, with MISSING
+    for any that are unknown
+
+    Arguments:
+        labels: ESPN's labels of the values, eg. 'MIN' or 'FG'
+        values: ESPN's strings of the values, eg. '31', '5-11' or '--'
+    """
+    line = [MISSING] * len(STAT_COLUMNS)
+    for label, value in zip(labels, values):
+        try:
+            if label in MADE_ATTEMPTED:
+                made, attempted = value.split('-')
+                line[_COLUMN_INDEX[label + 'M']] = int(made)
+                line[_COLUMN_INDEX[label + 'A']] = int(attempted)
+            elif label in _COLUMN_INDEX:
+                line[_COLUMN_INDEX[label]] = int(value)
+        except ValueError:
+            pass  # unknown, so left missing
+    return line
+
+
+def extract_game(gid, data):
+    """Returns the rows of the teams and of the players who played in a game
+    as lists of tuples of TEAM_DTYPE and PLAYER_DTYPE. Raises an exception if
+    the boxscore has no game.
+
+    Arguments:
+        gid: The game id that ESPN uses to refer to the game
+        data: The decoded boxscore JSON
+    """
+    home_id = int(data['__gamepackage__']['homeTeam']['id'])
+    away_id = int(data['__gamepackage__']['awayTeam']['id'])
+
+    teams, players = [], []
+    for k, side in enumerate(data['gamepackageJSON']['boxscore']['players']):
+        # the first is the home team, as in scrape.parse_game, unless ESPN
+        # says otherwise
+        tid = int(side['team']['id']) if 'team' in side else \
+            (home_id, away_id)[k]
+        statistics = side['statistics'][0]
+        labels = statistics['labels']
+
+        teams.append((gid, tid, tid == home_id) +
+                     tuple(_stat_line(labels, statistics['totals'])))
+        for athlete in statistics.get('athletes', []):
+            if athlete.get('didNotPlay') or not athlete.get('stats'):
+                continue
+            players.append((gid, tid, int(athlete['athlete']['id']),
+                            bool(athlete.get('starter'))) +
+                           tuple(_stat_line(labels, athlete['stats'])))
+    return teams, players
+
+
+def line_ranges(path, lines_per_range=1000):
+    """Returns the (start, end) byte offsets of ranges of whole lines of a
+    file, so that each range can be read separately
+
+    Arguments:
+        path: The file
+        lines_per_range: The number of lines in each range
+    """
+    ranges = []
+    start = end = n_lines = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            end += len(line)
+            n_lines += 1
+            if n_lines == lines_per_range:
+                ranges.append((start, end))
+                start, n_lines = end, 0
+    if end > start:
+        ranges.append((start, end))
+    return ranges
+
+
+def _extract_range(task):
+    """Extracts every game in a range of lines of the file, for the pool.
+    Returns the team and player arrays and the number of games which failed.
+
+    Arguments:
+        task: The (path, start, end) of the range
+    """
+    path, start, end = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+
+    teams, players, failed = [], [], 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            gid, data = json.loads(line)
+            game_teams, game_players = extract_game(int(gid), data)
+        except:
+            failed += 1
+            continue
+        teams.extend(game_teams)
+        players.extend(game_players)
+    return (np.array(teams, dtype=TEAM_DTYPE),
+            np.array(players, dtype=PLAYER_DTYPE), failed)
+
+
+def _first(array, fields):
+    """Returns the rows of the array whose fields weren't seen in an earlier
+    row, in their original order, since a game may have been kept twice
+
+    Arguments:
+        array: The structured array
+        fields: The fields which identify a row
+    """
+    _, first = np.unique(array[list(fields)], return_index=True)
+    return array[np.sort(first)]
+
+
+def extract(path, n_jobs=1, lines_per_range=1000):
+    """Extracts every game of a file of whole boxscores, returning the team
+    stat lines as an array of TEAM_DTYPE, the player stat lines as an array
+    of PLAYER_DTYPE (both in the order of the file) and the number of games
+    which couldn't be extracted
+
+    Arguments:
+        path: The file, with one [game id, boxscore] per line
+        n_jobs: The number of processes, where None or below 1 is every cpu
+        lines_per_range: The number of games each process extracts at a time
+    """
+    tasks = [(path, start, end)
+             for start, end in line_ranges(path, lines_per_range)]
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1 or len(tasks) <= 1:
+        results = list(map(_extract_range, tasks))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as pool:
+            results = list(pool.map(_extract_range, tasks))
+
+    teams = np.concatenate([np.empty(0, dtype=TEAM_DTYPE)] +
+                           [result[0] for result in results])
+    players = np.concatenate([np.empty(0, dtype=PLAYER_DTYPE)] +
+                             [result[1] for result in results])
+    failed = sum(result[2] for result in results)
+    return (_first(teams, ('game_id', 'team_id')),
+            _first(players, ('game_id', 'player_id')), failed)
+
+
+def save(path, teams, players):
+    """Saves the extracted arrays to a .npz file
+
+    Arguments:
+        path: The file
+        teams: The team stat lines from extract
+        players: The player stat lines from extract
+    """
+    np.savez(path, teams=teams, players=players)
+
+
+def load(path):
+    """Returns the (teams, players) arrays saved by save
+
+    Arguments:
+        path: The file
+    """
+    with np.load(path) as saved:
+        return saved['teams'], saved['players']
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Extract the team and player stat lines of the whole '
+                    'boxscores kept by scrape.py --raw into typed arrays.')
+    parser.add_argument('boxscores', type=str,
+                        help='The file of boxscores, one [game id, boxscore] '
+                             'per line.')
+    parser.add_argument('outfile', type=str,
+                        help='The .npz file to save the arrays to.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes, or 0 for every cpu.')
+    parser.add_argument('--lines', type=int, default=1000,
+                        help='The number of games each process extracts at a '
+                             'time.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print how many lines were extracted.')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    instrument.start(args, 'extract')
+
+    try:
+        with instrument.span('extract.extract'):
+            teams, players, failed = extract(args.boxscores, args.jobs,
+                                             args.lines)
+    except IOError:
+        print('COULDN\'T OPEN', args.boxscores)
+        exit(1)
+    instrument.count('extract.games', len(np.unique(teams['game_id'])))
+    instrument.count('extract.games_failed', failed)
+
+    if args.verbose:
+        print('EXTRACTED {} GAMES, {} TEAM LINES AND {} PLAYER LINES, {} '
+              'FAILED'.format(len(np.unique(teams['game_id'])), len(teams),
+                              len(players), failed))
+
+    with instrument.span('extract.save'):
+        save(args.outfile, teams, players)
+
+
+if __name__ == '__main__':
+    main()
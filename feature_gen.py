@@ -6,11 +6,22 @@
 
 import argparse
 import datetime
+import itertools
 import json
 
 import numpy as np
 
-from pomegranate import HiddenMarkovModel, MultivariateGaussianDistribution
+import instrument
+import scan_kernels
+
+from batched_hmm import series_bounds
+from hmm_cache import series_hashes
+
+
+# The version of the generated features. Must be incremented whenever the
+# features change, so that saved models can tell if they are given features
+# they weren't trained on
+FEATURE_SET_VERSION = 1
 
 
 def _teamWon(game, tid):
@@ -251,7 +262,8 @@ class FeatureGenerators():
             }
 
     @classmethod
-    def HiddenSpaceGenerator(cls, X, n_components):
+    def HiddenSpaceGenerator(cls, X, n_components, cache=None, init=None,
+                             **kwargs):
         """This method creates more features by training a HiddenMarkovModel
         on the game statistics, then returns the hidden state space of each
         timestep/game as a new feature. HOWEVER, note that this doesn't
@@ -265,24 +277,143 @@ class FeatureGenerators():
                 continuous HMMs, so it will discretize every continuous
                 variable by K-means so then the outputted space will be
                 discrete.
+            cache: An HMMCache. If it has a model trained on exactly these
+                features then that is returned without any training, and
+                otherwise training starts from its model trained on the most
+                similar features (if any) rather than from K-means.
+            init: A trained HMM to continue training from rather than the
+                cache's nearest model or K-means, eg. the HMM trained on the
+                seasons before the latest one in X.
+            kwargs: Passed on to pomegranate's training, eg. max_iterations
         """
-        # the last series id, none are negative so we will get a new one
-        last_series_idx = -1
-        # restrict down, but since a temporal we need to make a list of entries
-        _X = []
-        for row in X:
-            if row[0] != last_series_idx:
-                # create a new series to train on, start with empty input
-                # series then add to them while the row has the same index
-                last_series_idx = row[0]
-                _X.append(np.full((0, X.shape[1] - 1), None, dtype=None))
+        X = np.asarray(X, dtype=float)
+
+        key = None
+        series = None
+        if cache is not None:
+            key = cache.key(X, n_components)
+            hmm = cache.get(key)
+            if hmm is not None:
+                return hmm
+            series = series_hashes(X)
+
+        # restrict down, but since a temporal we need to make a list of
+        # entries, with a new series wherever the series id changes
+        starts, _ = series_bounds(X[:, 0])
+        _X = np.split(X[:, 1:], starts[1:])
+
+        warm = init
+        if warm is None and cache is not None:
+            warm = cache.nearest(X, n_components, series)
+
+        # imported here as it takes seconds, which every command line tool
+        # importing this module would otherwise pay
+        from pomegranate import HiddenMarkovModel, \
+            MultivariateGaussianDistribution
+
+        if warm is not None:
+            # continue EM from a copy of the nearest model, which is already
+            # close so needs far fewer iterations
+            hmm = HiddenMarkovModel.from_json(warm.to_json())
+            hmm.fit(_X, **kwargs)
+        else:
+            # now train an HMM to the data
+            hmm = HiddenMarkovModel.from_samples(
+                MultivariateGaussianDistribution, n_components, _X, **kwargs)
+
+        if cache is not None:
+            cache.put(key, hmm, X, n_components, series)
+        return hmm
+
+
+def feature_names(exclude_features=()):
+    """Returns the names of the generated features in the order of their
+    columns, which is the same for the target team and the opposition.
+
+    Arguments:
+        exclude_features: A list of features to exclude
+    """
+    return sorted(name for name in FeatureGenerators.ALL
+                  if name not in exclude_features)
+
+
+# the features which are sequential scans over each season, which
+# scan_kernels computes for every season at once rather than their generators
+_SCANNED = ('streak', 'seasonWin%Ranked')
 
-            # add the datapoint to the current series
-            _X[-1] = np.vstack((_X[-1], row[1:]))
 
-        # now train an HMM to the data
-        return HiddenMarkovModel.from_samples(MultivariateGaussianDistribution,
-                                              n_components, _X)
+def _scan_features(seasons, features):
+    """Computes the features in _SCANNED for every season at once. Returns a
+    dict from each of their names to a dict from each season's key to its
+    values, or None for a season which is left to the generator: one with no
+    games, or whose games can't be read (so it fails just as it would).
+
+    Arguments:
+        seasons: A dict of the (game ids, games) of each team's season, keyed
+            by the (season, team id) as in generate_features
+        features: The names of the features being generated
+    """
+    names = [name for name in _SCANNED if name in features]
+    if not names:
+        return {}
+
+    # each game is in both teams' seasons, so its fields are read once into
+    # columns by its position, keeping no object per game (which would set
+    # off the garbage collector over all of data)
+    position = {}
+    home_ids, home_scores, away_scores, home_ranks, away_ranks = \
+        [], [], [], [], []
+    for series_gids, series in seasons.values():
+        for gid, game in zip(series_gids, series):
+            if gid in position:
+                continue
+            try:
+                home_id, score = game['homeId'], game['score']
+                home_score, away_score = score[0], score[1]
+                home_rank, away_rank = game['homeRank'], game['awayRank']
+            except:
+                position[gid] = None
+                continue
+            position[gid] = len(home_ids)
+            home_ids.append(home_id)
+            home_scores.append(home_score)
+            away_scores.append(away_score)
+            home_ranks.append(home_rank)
+            away_ranks.append(away_rank)
+
+    # the seasons with games which could all be read, with their games'
+    # positions one season after another
+    keys, tids, lengths, games = [], [], [], []
+    for key, (series_gids, _) in seasons.items():
+        positions = [position[gid] for gid in series_gids]
+        if positions and None not in positions:
+            keys.append(key)
+            tids.append(int(key[1]))
+            lengths.append(len(positions))
+            games.extend(positions)
+
+    games = np.array(games, dtype=int)
+    home_ids = np.array(home_ids, dtype=np.int64)[games]
+    tids = np.repeat(np.array(tids, dtype=np.int64), lengths)
+    won = scan_kernels.team_won(home_ids, tids,
+                                np.array(home_scores)[games],
+                                np.array(away_scores)[games])
+    ranked = np.where(home_ids == tids, np.array(away_ranks)[games] > 0,
+                      np.array(home_ranks)[games] > 0)
+
+    scanned = {}
+    for name in names:
+        if name == 'streak':
+            flat = scan_kernels.streaks(won, lengths)
+        else:
+            flat = scan_kernels.ranked_win_pcts(won, ranked, lengths)
+        values = dict.fromkeys(seasons)
+        start = 0
+        for key, n in zip(keys, lengths):
+            values[key] = flat[start:start + n]
+            start += n
+        scanned[name] = values
+    return scanned
 
 
 def generate_features(data, **kwargs):
@@ -296,6 +427,10 @@ def generate_features(data, **kwargs):
                      If greater than 1 gives other useful debug messages
             exclude_features: A list of features to exclude (must match a key
                 from the POSSIBLE_FEATURES dictionary)
+            with_schema: If True, then also returns a third value describing
+                the columns: a dict with the FEATURE_SET_VERSION, the
+                feature names and the [year, team id] of each series id
+                (series id i is at index i - 1). Default False.
     """
     def printveryverbose(*msg):
         if kwargs.get('verbose', 0) > 1:
@@ -329,6 +464,36 @@ def generate_features(data, **kwargs):
 
     # the time-series unique id discussed below
     series_idx = 0
+    # the season and team of each series id
+    series_keys = []
+    # the number of series each generator failed on
+    failures = {}
+
+    # every team's season of games in order, gathered first so that the
+    # features which are sequential scans can be computed for all of them at
+    # once, keyed by the season and team as they are in data['teams']
+    seasons = {}
+    for year in data['years']:
+        for tid in data['teams']:
+            # json compatibility
+            if year not in data['teams'][tid]:
+                year = str(year)
+
+            # preprocess the list we have, make sure they exist in the table
+            gids = data['teams'][tid][year]['reg']
+            for gid in gids:
+                if str(gid) not in data and int(gid) not in data:
+                    data['teams'][tid][year]['reg'].remove(gid)
+
+            # sort all the games this season
+            series_gids = sorted(data['teams'][tid][year]['reg'],
+                                 key=_json_date)
+            series = [data[str(gid)] if gid not in data else data[gid]
+                      for gid in series_gids]
+            seasons[year, tid] = (series_gids, series)
+
+    with instrument.span('feature_gen.scan'):
+        scanned = _scan_features(seasons, features)
 
     for year in data['years']:
         # we generate quite a few different features. While we borrow some from
@@ -367,21 +532,12 @@ def generate_features(data, **kwargs):
             if year not in data['teams'][tid]:
                 year = str(year)
 
-            # preprocess the list we have, make sure they exist in the table
-            gids = data['teams'][tid][year]['reg']
-            for gid in gids:
-                if str(gid) not in data and int(gid) not in data:
-                    data['teams'][tid][year]['reg'].remove(gid)
-
-            # sort all the games this season
-            series_gids = sorted(data['teams'][tid][year]['reg'],
-                                 key=_json_date)
+            series_gids, series = seasons[year, tid]
+            scanned_values = {name: values[year, tid]
+                              for name, values in scanned.items()}
             # for json compatibility since keys turn to ints
             tid = int(tid)
 
-            series = [data[str(gid)] if gid not in data else data[gid]
-                      for gid in series_gids]
-
             for game in series:
                 printveryverbose('Series ordering check:', tid, year,
                                  game['date'])  # sanity check for sorting
@@ -391,26 +547,37 @@ def generate_features(data, **kwargs):
             # same order on every datapoint
             for j, (name, fGen) in enumerate(sorted(features.items())):
                 try:
-                    for i, v in enumerate(fGen(series, tid)):
-                        # if the game has no values, then create its entry
-                        if series_gids[i] not in features_unmatched:
-                            features_unmatched[series_gids[i]] = \
-                                {series[i]['homeId']: [None] * len(features),
-                                 series[i]['awayId']: [None] * len(features)}
-                        # insert the value
-                        features_unmatched[series_gids[i]][tid][j] = v
+                    with instrument.span('feature_gen.' + name,
+                                         cat='generator'):
+                        values = scanned_values.get(name)
+                        if values is None:
+                            values = fGen(series, tid)
+                        for i, v in enumerate(values):
+                            # if the game has no values, then create its
+                            # entry
+                            if series_gids[i] not in features_unmatched:
+                                features_unmatched[series_gids[i]] = \
+                                    {series[i]['homeId']:
+                                     [None] * len(features),
+                                     series[i]['awayId']:
+                                     [None] * len(features)}
+                            # insert the value
+                            features_unmatched[series_gids[i]][tid][j] = v
                 except:
+                    instrument.swallowed('feature_gen.' + name)
                     # it failed for that generator, so we just continue on the
                     # rest of them and don't bother setting any values for
                     # this specific generator for that series. The rest will
                     # fill in if they succeed in generating
                     printveryverbose('ERROR generating:', tid, year, name)
+                    failures[name] = failures.get(name, 0) + 1
 
         # now that we have all the features for every team for every game,
         # we can generate the final tables
         for tid in data['teams']:
             # increment so that a new series (aka team's season) is identified
             series_idx += 1
+            series_keys.append([int(year), int(tid)])
 
             # since each season is so short, it is better to just recompute
             # the sorting of the games since otherwise the memory becomes too
@@ -452,11 +619,120 @@ def generate_features(data, **kwargs):
             X_series.append(teamX)
             y_series.append(teamY)
 
+    for name, n in sorted(failures.items()):
+        printverbose('Generator', name, 'failed on', n, 'series')
+
     # stack all the series so that we can train on individual games instead
     # of just series of games
+    if kwargs.get('with_schema', False):
+        schema = {'version': FEATURE_SET_VERSION,
+                  'features': feature_names(kwargs.get('exclude_features',
+                                                       [])),
+                  'series': series_keys}
+        return (np.vstack(X_series), np.vstack(y_series), schema)
     return (np.vstack(X_series), np.vstack(y_series))
 
 
+def games_before(data, date):
+    """Returns a copy of the raw data where each team's seasons only have the
+    games played before the date, eg. to get the features as they were on
+    that day. The games themselves are shared with data.
+
+    Arguments:
+        data: The raw data dictionary as given by scrape.py
+        date: The date, as YYYY-MM-DD
+    """
+    def _before(gid):
+        # json compatibility, since the keys may have become strings
+        game = data[gid] if gid in data else data.get(str(gid), None)
+        # the dates are ISO formatted so compare the same as strings
+        return game is not None and game['date'] < date
+
+    cut = dict(data)
+    cut['teams'] = {tid: {year: dict(season, reg=[gid for gid in season['reg']
+                                                  if _before(gid)])
+                          for year, season in seasons.items()}
+                    for tid, seasons in data['teams'].items()}
+    return cut
+
+
+def current_features(data, year, exclude_features=()):
+    """Returns each team's features going into its next game of the season,
+    ie. after every game played so far, as a dict from the team id to its
+    values in the order of feature_names. These are the values the target
+    team (or the opposition) would have in the next row generate_features
+    makes for it. Since the next game isn't known, atHome is False.
+
+    Arguments:
+        data: The raw data dictionary as given by scrape.py
+        year: The season
+        exclude_features: A list of features to exclude
+    """
+    names = feature_names(exclude_features)
+
+    states = {}
+    for tid in data['teams']:
+        seasons = data['teams'][tid]
+        season = seasons.get(year, seasons.get(str(year), None))
+        if season is None:
+            continue
+
+        # json compatibility, since the keys may have become strings
+        series = [data[str(gid)] if gid not in data else data[gid]
+                  for gid in season['reg']
+                  if gid in data or str(gid) in data]
+        # the dates are ISO formatted so sort the same as strings
+        series.sort(key=lambda game: game['date'])
+
+        # a placeholder next game at a neutral site, so that each generator
+        # yields one more value than there are games: the one after them all
+        upcoming = {'homeId': int(tid), 'awayId': -1, 'neutralSite': True}
+
+        values = []
+        for name in names:
+            try:
+                generator = FeatureGenerators.ALL[name](series + [upcoming],
+                                                        int(tid))
+                values.append(list(itertools.islice(
+                    generator, len(series) + 1))[-1])
+            except:
+                # as in generate_features, a failed generator leaves the
+                # value unknown
+                values.append(None)
+        states[int(tid)] = values
+    return states
+
+
+def save_features_npy(path, X, y, schema, chunk_rows=65536):
+    """Saves the features as a single float .npy file with the label as the
+    last column and nan for unknown values, with the schema beside it in
+    path + '.json'. Unlike the JSON format this can be memory mapped, so that
+    out_of_core.py can train on it a chunk of rows at a time.
+
+    Arguments:
+        path: The .npy file to save to
+        X: The features from generate_features
+        y: The labels
+        schema: The schema of the features
+        chunk_rows: The number of rows converted to floats at once
+    """
+    from numpy.lib.format import open_memmap
+
+    y = np.asarray(y).reshape(len(y), -1)
+    out = open_memmap(path, mode='w+', dtype=np.float64,
+                      shape=(X.shape[0], X.shape[1] + 1))
+    for start in range(0, X.shape[0], chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        block = np.hstack((X[rows], y[rows, :1]))
+        out[rows] = np.where(np.equal(block, None), np.nan,
+                             block).astype(float)
+    out.flush()
+    del out
+
+    with open(path + '.json', 'w') as f:
+        json.dump(schema, f)
+
+
 def parse_args():
     """Get the necessary arguments when called from the command line instead
     of when loaded from another script
@@ -467,13 +743,16 @@ def parse_args():
     parser.add_argument('infile', type=str,
                         help='The file which the raw downloaded data is in.')
     parser.add_argument('outfile', type=str,
-                        help='The file to save the generated features to.')
+                        help='The file to save the generated features to. '
+                             'If it ends with .npy then they are saved as a '
+                             'float array for out of core training.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Whether to output a verbose, but not complete, '
                              'messages during generation.')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Whether to output the debugging level of '
                              'verbose messages during execution.')
+    instrument.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -481,19 +760,27 @@ def main():
     """Called when using from the command line
     """
     args = parse_args()
+    instrument.start(args, 'feature_gen')
 
     data = {}
-    with open(args.infile, 'r') as f:
-        data = json.load(f)
+    with instrument.span('feature_gen.load'):
+        with open(args.infile, 'r') as f:
+            data = json.load(f)
 
     verbose = 0
     if args.verbose:
         verbose = 1
     if args.debug:
         verbose = 2
-    X, y = generate_features(data, verbose=verbose)
-    with open(args.outfile, 'w') as f:
-        json.dump((X.tolist(), y.tolist()), f)
+    with instrument.span('feature_gen.generate_features'):
+        X, y, schema = generate_features(data, verbose=verbose,
+                                         with_schema=True)
+    with instrument.span('feature_gen.save'):
+        if args.outfile.endswith('.npy'):
+            save_features_npy(args.outfile, X, y, schema)
+            return
+        with open(args.outfile, 'w') as f:
+            json.dump((X.tolist(), y.tolist(), schema), f)
 
 
 if __name__ == '__main__':
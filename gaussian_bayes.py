@@ -0,0 +1,253 @@
+# gaussian_bayes.py
+# A bayesian classifier with a multivariate gaussian for each class, fit in
+# closed form from sufficient statistics. Since the statistics of a dataset
+# are the sums of the statistics of its parts, then the model for any training
+# fold can be made by subtracting the held out block from the whole dataset
+
+import numpy as np
+
+
+class GaussianStats():
+    """The sufficient statistics of a multivariate gaussian for each class:
+    the number of samples, the sum of the samples and the sum of the outer
+    products of the samples. The samples are shifted by a fixed offset before
+    summing so that the outer products don't lose precision, so only stats with
+    the same classes and shift can be added or subtracted.
+    """
+    def __init__(self, classes, shift, counts, sums, outers):
+        """
+        Arguments:
+            classes: The labels of the classes, sorted
+            shift: The offset subtracted from every sample
+            counts: The number of samples of each class
+            sums: The sum of each class' shifted samples
+            outers: The sum of the outer products of each class' shifted
+                samples
+        """
+        self.classes = classes
+        self.shift = shift
+        self.counts = counts
+        self.sums = sums
+        self.outers = outers
+
+    @classmethod
+    def from_samples(cls, X, y, classes=None, shift=None):
+        """Computes the statistics in a single pass over the samples
+
+        Arguments:
+            X: The inputs
+            y: The classes of each input
+            classes: The labels of the classes. Default is the ones in y
+            shift: The offset to subtract from each sample. Default is the
+                mean of X.
+        """
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y).flatten()
+        if classes is None:
+            classes = np.unique(y)
+        if shift is None:
+            shift = X.mean(axis=0) if X.shape[0] else np.zeros(X.shape[1])
+
+        X = X - shift
+        # one hot matrix of the classes so that every class is summed at once
+        onehot = (y[:, None] == classes[None, :]).astype(float)
+
+        return cls(classes, shift, onehot.sum(axis=0), onehot.T.dot(X),
+                   np.einsum('nc,ni,nj->cij', onehot, X, X))
+
+    def _check(self, other):
+        if not (np.array_equal(self.classes, other.classes) and
+                np.array_equal(self.shift, other.shift)):
+            raise ValueError('Can only combine statistics with the same '
+                             'classes and shift')
+
+    def __add__(self, other):
+        self._check(other)
+        return GaussianStats(self.classes, self.shift,
+                             self.counts + other.counts,
+                             self.sums + other.sums,
+                             self.outers + other.outers)
+
+    def __sub__(self, other):
+        self._check(other)
+        return GaussianStats(self.classes, self.shift,
+                             self.counts - other.counts,
+                             self.sums - other.sums,
+                             self.outers - other.outers)
+
+
+def block_stats(X, y, blocks):
+    """Computes the statistics of each block of rows with the same classes and
+    shift, so that they can be combined.
+
+    Arguments:
+        X: The inputs
+        y: The classes of each input
+        blocks: A list of arrays of row indices, eg. the test rows of each
+            fold or the rows of each season
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y).flatten()
+    classes = np.unique(y)
+    shift = X.mean(axis=0)
+    return [GaussianStats.from_samples(X[rows], y[rows], classes, shift)
+            for rows in blocks]
+
+
+class GaussianBayesClassifier():
+    """A bayesian classifier where each class has a multivariate gaussian over
+    the inputs and the prior is given by how often each class occurs. This is
+    the same model as pomegranate's BayesClassifier with a
+    MultivariateGaussianDistribution, but it is fit in closed form.
+    """
+    def __init__(self, classes, priors, means, covs, reg=1e-6):
+        """
+        Arguments:
+            classes: The labels of the classes
+            priors: The prior probability of each class
+            means: The mean of each class' gaussian
+            covs: The covariance of each class' gaussian
+            reg: Added to the diagonal of the covariances so that constant
+                features don't make them singular
+        """
+        self.classes = np.asarray(classes)
+        self.priors = np.asarray(priors, dtype=float)
+        self.means = np.asarray(means, dtype=float)
+        self.covs = np.asarray(covs, dtype=float)
+        self.reg = reg
+
+        covs = self.covs + reg * np.eye(self.covs.shape[-1])
+        # precompute everything needed for the log likelihoods
+        self._chol = np.linalg.cholesky(covs)
+        self._log_norm = (np.log(self.priors) -
+                          np.log(np.diagonal(self._chol, axis1=1,
+                                             axis2=2)).sum(axis=1) -
+                          0.5 * self.means.shape[1] * np.log(2 * np.pi))
+
+    def to_dict(self):
+        """Returns the parameters as a dict of numpy arrays, for saving
+        """
+        return {'classes': self.classes, 'priors': self.priors,
+                'means': self.means, 'covs': self.covs,
+                'reg': np.array(self.reg)}
+
+    @classmethod
+    def from_dict(cls, params):
+        """Makes the classifier from the result of to_dict
+
+        Arguments:
+            params: The dict of parameters
+        """
+        return cls(params['classes'], params['priors'], params['means'],
+                   params['covs'], float(params['reg']))
+
+    @classmethod
+    def from_stats(cls, stats, reg=1e-6):
+        """Gets the maximum likelihood classifier for the statistics. Raises a
+        ValueError if a class has no samples, eg. a training fold with only
+        wins, since it would have no mean or covariance.
+
+        Arguments:
+            stats: The GaussianStats of the training data
+            reg: See __init__
+        """
+        counts = stats.counts
+        if (counts <= 0).any():
+            # its mean and covariance would be 0 / 0
+            raise ValueError('No training samples of class {}'.format(
+                ', '.join(str(c) for c in stats.classes[counts <= 0])))
+        means = stats.sums / counts[:, None]
+        covs = (stats.outers / counts[:, None, None] -
+                np.einsum('ci,cj->cij', means, means))
+        return cls(stats.classes, counts / counts.sum(), means + stats.shift,
+                   covs, reg)
+
+    @classmethod
+    def from_samples(cls, X, y, reg=1e-6):
+        """Fits the classifier on the samples
+
+        Arguments:
+            X: The inputs
+            y: The classes of each input
+            reg: See __init__
+        """
+        return cls.from_stats(GaussianStats.from_samples(X, y), reg)
+
+    def marginal(self, columns):
+        """Returns the classifier over only some of the inputs. Since the
+        marginal of a gaussian is the gaussian of those columns, then this is
+        exactly the classifier fit on those columns of the same samples.
+
+        Arguments:
+            columns: The indices of the inputs to keep
+        """
+        columns = np.asarray(columns, dtype=int)
+        return GaussianBayesClassifier(
+            self.classes, self.priors, self.means[:, columns],
+            self.covs[:, columns][:, :, columns], self.reg)
+
+    def predict_log_proba(self, X):
+        """Returns the log posterior probability of each class for each input,
+        with a column for each class
+
+        Arguments:
+            X: The inputs
+        """
+        # imported here as only predicting needs it
+        from scipy.linalg import solve_triangular
+
+        X = np.asarray(X, dtype=float)
+        log_joint = np.empty((X.shape[0], len(self.classes)))
+        for c in range(len(self.classes)):
+            # solving against the cholesky factor gives the whitened inputs,
+            # by substitution since it is lower triangular
+            z = solve_triangular(self._chol[c], (X - self.means[c]).T,
+                                 lower=True, check_finite=False)
+            log_joint[:, c] = self._log_norm[c] - 0.5 * (z * z).sum(axis=0)
+
+        top = log_joint.max(axis=1, keepdims=True)
+        return log_joint - top - np.log(np.exp(log_joint - top).sum(
+            axis=1, keepdims=True))
+
+    def predict_proba(self, X):
+        """Returns the posterior probability of each class for each input,
+        with a column for each class
+
+        Arguments:
+            X: The inputs
+        """
+        return np.exp(self.predict_log_proba(X))
+
+    def predict(self, X):
+        """Returns the most probable class for each input
+
+        Arguments:
+            X: The inputs
+        """
+        return self.classes[np.argmax(self.predict_log_proba(X), axis=1)]
+
+
+def block_cross_validate(X, y, blocks, reg=1e-6):
+    """Holds out each block in turn, training on the rest of the blocks, and
+    returns the accuracy on each held out block. The statistics are computed
+    once, so this is roughly a single pass over the data regardless of the
+    number of blocks. With a block per season this gives leave one season out
+    evaluation.
+
+    Arguments:
+        X: The inputs
+        y: The classes of each input
+        blocks: A list of arrays of row indices which partition the rows
+        reg: See GaussianBayesClassifier.__init__
+    """
+    y = np.asarray(y).flatten()
+    stats = block_stats(X, y, blocks)
+    total = stats[0]
+    for block in stats[1:]:
+        total = total + block
+
+    accs = []
+    for rows, held_out in zip(blocks, stats):
+        clf = GaussianBayesClassifier.from_stats(total - held_out, reg)
+        accs.append(np.mean(clf.predict(np.asarray(X)[rows]) == y[rows]))
+    return accs
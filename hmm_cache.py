@@ -0,0 +1,173 @@
+# hmm_cache.py
+# A cache of the HMMs trained by FeatureGenerators.HiddenSpaceGenerator, kept
+# in memory and optionally on disk so that it persists between runs. Models are
+# keyed by a hash of their training rows and their number of hidden states,
+# and when there is no exact match then the cached model trained on the most
+# similar data (eg. a neighbouring fold) is used as a warm start
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from batched_hmm import series_bounds
+
+
+def _hash(array):
+    """Returns a hash of the values and shape of the array
+
+    Arguments:
+        array: The numpy array to hash
+    """
+    array = np.ascontiguousarray(array, dtype=float)
+    h = hashlib.sha1(str(array.shape).encode())
+    h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def series_hashes(X):
+    """Returns the hash of every series in the features
+
+    Arguments:
+        X: The features with first column the series id
+    """
+    X = np.asarray(X, dtype=float)
+    starts, lengths = series_bounds(X[:, 0])
+    return [_hash(X[start:start + length, 1:])[:16]
+            for start, length in zip(starts, lengths)]
+
+
+class HMMCache():
+    """The cache of trained HMMs. Each entry is stored with the hashes of the
+    series it was trained on, so that the closest entry to new training data
+    can be found by how many series they share.
+    """
+    def __init__(self, directory=None):
+        """
+        Arguments:
+            directory: If given, the folder to persist the models to. Each
+                entry is written as its own pair of files, so that several
+                processes may share the same folder.
+        """
+        self.directory = directory
+        # the loaded models and the metadata of every known entry by key
+        self._models = {}
+        self._meta = {}
+        if directory is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self._scan()
+
+    def _scan(self):
+        """Reads the metadata of the entries on disk which aren't known yet
+        """
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.meta.json'):
+                key = fname[:-len('.meta.json')]
+                if key not in self._meta:
+                    try:
+                        with open(os.path.join(self.directory, fname)) as f:
+                            self._meta[key] = json.load(f)
+                    except (OSError, ValueError):
+                        continue  # still being written by another process
+
+    @staticmethod
+    def key(X, n_components):
+        """The key of the HMM trained on exactly these rows
+
+        Arguments:
+            X: The training features with first column the series id
+            n_components: The number of hidden states
+        """
+        return '{}-{}'.format(_hash(X), n_components)
+
+    def get(self, key):
+        """Returns the cached model for the key, or None if there isn't one
+
+        Arguments:
+            key: The result of HMMCache.key
+        """
+        if key in self._models:
+            return self._models[key]
+        if self.directory is None:
+            return None
+
+        path = os.path.join(self.directory, key + '.json')
+        if not os.path.exists(path):
+            return None
+        from pomegranate import HiddenMarkovModel
+        with open(path) as f:
+            self._models[key] = HiddenMarkovModel.from_json(f.read())
+        return self._models[key]
+
+    def nearest(self, X, n_components, series=None):
+        """Returns the cached model with the same number of hidden states and
+        inputs which was trained on the most similar series, or None if no
+        cached model shares any series with X.
+
+        Arguments:
+            X: The training features with first column the series id
+            n_components: The number of hidden states
+            series: The series_hashes of X, if already computed
+        """
+        if self.directory is not None:
+            self._scan()
+        if series is None:
+            series = series_hashes(X)
+        series = set(series)
+
+        best, best_overlap = None, 0.
+        for key, meta in self._meta.items():
+            if meta['n_components'] != n_components or \
+                    meta['n_columns'] != X.shape[1]:
+                continue
+            other = set(meta['series'])
+            overlap = len(series & other) / float(len(series | other))
+            if overlap > best_overlap:
+                best, best_overlap = key, overlap
+        return None if best is None else self.get(best)
+
+    def put(self, key, model, X, n_components, series=None):
+        """Adds the trained model to the cache
+
+        Arguments:
+            key: The result of HMMCache.key
+            model: The trained HiddenMarkovModel
+            X: The features it was trained on
+            n_components: The number of hidden states
+            series: The series_hashes of X, if already computed
+        """
+        self._models[key] = model
+        self._meta[key] = {'n_components': n_components,
+                           'n_columns': X.shape[1],
+                           'series': series if series is not None
+                           else series_hashes(X)}
+        if self.directory is None:
+            return
+
+        # write to a temporary file then move it so that other processes
+        # never read a partially written entry
+        for suffix, text in (('.json', model.to_json()),
+                             ('.meta.json', json.dumps(self._meta[key]))):
+            path = os.path.join(self.directory, key + suffix)
+            with open(path + '.tmp{}'.format(os.getpid()), 'w') as f:
+                f.write(text)
+            os.replace(path + '.tmp{}'.format(os.getpid()), path)
+
+
+# the caches of this process by their directory, so that each worker process
+# of a ParallelCV opens each cache only once
+_CACHES = {}
+
+
+def get_cache(directory=None):
+    """Gets this process' cache for the directory, or its in memory only cache
+    if no directory is given
+
+    Arguments:
+        directory: The folder the cache persists to
+    """
+    if directory not in _CACHES:
+        _CACHES[directory] = HMMCache(directory)
+    return _CACHES[directory]
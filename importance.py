@@ -0,0 +1,293 @@
+# importance.py
+# Estimates how much each of the features a model uses is worth, without
+# cross validating it again for every feature left out. Each fold's model is
+# fit once (sharing the stages of cv_harness), then every copy of its test
+# rows with one feature's columns shuffled is stacked and scored in a single
+# vectorized call, which gives the permutation importance. The drop from
+# leaving a feature out (ablation) comes from the same fitted classifier,
+# since the gaussian of the columns left is exactly what would be fit on them
+# alone. Both are reported with confidence intervals over the test rows
+
+import argparse
+import json
+import statistics
+
+import numpy as np
+
+import cv_harness
+import instrument
+import workqueue
+
+from feature_gen import feature_names
+from train_models import _MODEL_STAGES, get_comp_stat_inputs, \
+    get_input_masks, get_model_spec, get_non_stat_inputs, load_data
+
+
+def input_columns(X, inputs, names):
+    """Returns the columns of the cleaned inputs (with the series id first)
+    which come from each feature, as a dict from its name to them. A feature
+    the input selection leaves out has no entry.
+
+    Arguments:
+        X: The features generated by feature_gen.py
+        inputs: The input selection, eg. get_non_stat_inputs
+        names: The names of the features of X in order
+    """
+    if inputs is get_comp_stat_inputs:
+        # whether the team is home, then the difference in each other
+        # feature, in order
+        return {name: [1 + i] for i, name in enumerate(names)}
+
+    kept = np.ones(X.shape[1], dtype=bool)
+    if inputs is get_non_stat_inputs:
+        kept = get_input_masks(X)['non_stat_cols'].copy()
+    kept[0] = True
+
+    columns = {}
+    for column, raw in enumerate(np.flatnonzero(kept)):
+        if raw > 0:
+            # the target team's then the opposition's columns of each feature
+            columns.setdefault(names[(raw - 1) % len(names)], []).append(
+                column)
+    return columns
+
+
+def _permuted_variants(X, groups, n_repeats, rng):
+    """Returns the copies of the rows with the columns of each group shuffled
+    together, n_repeats times each, stacked group after group, and with the
+    series ids of each copy moved past the last so that the latent stages see
+    each copy as its own series
+
+    Arguments:
+        X: The rows of the cleaned inputs, with the series id
+        groups: The columns of each group
+        n_repeats: The number of shuffles of each group
+        rng: The numpy random Generator
+    """
+    n = len(X)
+    stacked = np.tile(X, (len(groups) * n_repeats, 1))
+    offset = X[:, 0].max() + 1 if n else 0
+    for g, columns in enumerate(groups):
+        for r in range(n_repeats):
+            v = g * n_repeats + r
+            rows = slice(v * n, (v + 1) * n)
+            stacked[rows, columns] = X[rng.permutation(n)][:, columns]
+            stacked[rows, 0] += (v + 1) * offset
+    return stacked
+
+
+def _importance_fold(X, y, train_idx, test_idx, token, spec, groups,
+                     n_repeats, seed, batch_rows, n_folds, fold):
+    """Fits the model on the fold once and returns, for every test row,
+    whether it was predicted correctly as is, on average with each group's
+    columns shuffled, and with each group's columns left out
+
+    Arguments:
+        X: The cleaned inputs, with the series id
+        y: The labels
+        train_idx: The rows to train on
+        test_idx: The rows to test on
+        token: Identifies the cleaned inputs
+        spec: The ModelSpec
+        groups: The columns of each feature
+        n_repeats: The number of shuffles of each feature
+        seed: The seed of the shuffles, with the fold
+        batch_rows: The most rows scored in one call
+        n_folds: The number of folds
+        fold: The index of the fold
+    """
+    def blocks():
+        from sklearn.model_selection import KFold
+        return [test for _, test in KFold(n_splits=n_folds).split(X, y)]
+
+    clf, latent = cv_harness.fit_spec(X, y, train_idx, token + (fold,), spec,
+                                      blocks)
+    X_test = X[test_idx]
+    y_test = np.asarray(y[test_idx]).flatten()
+    n = len(test_idx)
+
+    with instrument.span('importance.baseline'):
+        base = cv_harness.classifier_inputs(spec, latent, X_test)
+        correct = clf.predict(base) == y_test
+
+    # every shuffled copy is scored at once, in batches of whole copies so
+    # the stack doesn't outgrow memory
+    rng = np.random.default_rng([seed, fold])
+    with instrument.span('importance.permuted'):
+        stacked = _permuted_variants(X_test, groups, n_repeats, rng)
+        per_batch = max(1, batch_rows // max(n, 1))
+        permuted = np.concatenate(
+            [clf.predict(cv_harness.classifier_inputs(
+                spec, latent, stacked[start * n:(start + per_batch) * n]))
+             for start in range(0, len(groups) * n_repeats, per_batch)] +
+            [np.empty(0)])
+        permuted = (permuted.reshape(len(groups) * n_repeats, n) ==
+                    y_test).reshape(len(groups), n_repeats, n).mean(axis=1)
+
+    # leaving the columns out of the classifier, whose inputs are those of
+    # the cleaned inputs without the series id
+    with instrument.span('importance.ablated'):
+        n_inputs = base.shape[1]
+        ablated = np.array([
+            clf.marginal([c for c in range(n_inputs)
+                          if c + 1 not in columns]).predict(
+                base[:, [c for c in range(n_inputs) if c + 1 not in columns]])
+            == y_test for columns in groups]).reshape(len(groups), n)
+    return correct, permuted, ablated
+
+
+def _interval(drops, confidence):
+    """Returns the mean of the drops in accuracy of each row and the lower
+    and upper ends of its confidence interval, by the normal approximation
+
+    Arguments:
+        drops: The drop of each row
+        confidence: The probability the interval covers the mean
+    """
+    mean = float(np.mean(drops))
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.)
+    half = z * float(np.std(drops, ddof=1)) / np.sqrt(len(drops)) \
+        if len(drops) > 1 else float('nan')
+    return mean, mean - half, mean + half
+
+
+def importance(X, y, spec, names, executor, n_splits=5, n_repeats=5,
+               seed=0, confidence=0.95, batch_rows=1 << 16, token=None):
+    """Returns the cross validated accuracy of the model and the importance
+    of each feature it uses as a list of dicts, most important first. The
+    importance of a feature is the drop in accuracy when its columns are
+    shuffled between the test rows (permutation) or left out of the
+    classifier (ablation). Each is the mean over every row of the cross
+    validation of the drop in whether the row was predicted correctly, with
+    its confidence interval.
+
+    Arguments:
+        X: The features generated by feature_gen.py
+        y: The labels
+        spec: The ModelSpec of the model
+        names: The names of the features of X in order
+        executor: The ParallelCV (or workqueue.QueueCV) to run the folds on
+        n_splits: The number of folds
+        n_repeats: The number of shuffles of each feature on each fold
+        seed: The seed of the shuffles
+        confidence: The probability each interval covers the importance
+        batch_rows: The most rows scored in one call
+        token: Identifies the dataset in the cache, as cv_harness.schedule
+    """
+    if token is None:
+        token = cv_harness.dataset_token(X)
+
+    key = spec.input_key()
+    _X, _y = cv_harness.memoize(
+        (token, 'inputs') + key,
+        lambda: spec.inputs(X, y, keepSeriesID=True), 'inputs')
+    columns = input_columns(X, spec.inputs, names)
+    features = [name for name in names if name in columns]
+    groups = [columns[name] for name in features]
+
+    pending = executor.submit(_importance_fold, _X, _y, n_splits=n_splits,
+                              pass_fold=True, token=(token, n_splits) + key,
+                              spec=spec, groups=groups, n_repeats=n_repeats,
+                              seed=seed, batch_rows=batch_rows,
+                              n_folds=n_splits)
+    results = pending.result()
+    correct = np.concatenate([r[0] for r in results]).astype(float)
+    permuted = np.hstack([r[1] for r in results])
+    ablated = np.hstack([r[2] for r in results]).astype(float)
+
+    rows = []
+    for g, name in enumerate(features):
+        permutation = _interval(correct - permuted[g], confidence)
+        ablation = _interval(correct - ablated[g], confidence)
+        rows.append({'feature': name,
+                     'permutation': permutation[0],
+                     'permutation_interval': permutation[1:],
+                     'ablation': ablation[0],
+                     'ablation_interval': ablation[1:]})
+    rows.sort(key=lambda row: -row['permutation'])
+    # as train_models.py reports it, the mean of the folds' accuracies
+    return float(np.mean([r[0].mean() for r in results])), rows
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Estimate how much each feature is worth to a model by '
+                    'permutation and ablation, fitting each fold only once.')
+    parser.add_argument('data', type=str,
+                        help='The features generated by feature_gen.py')
+    parser.add_argument('model', type=str,
+                        help='The model, one of ' +
+                             ', '.join(sorted(_MODEL_STAGES)) + '.')
+    parser.add_argument('-o', '--outfile', type=str, default=None,
+                        help='Also write the results to this JSON file.')
+    parser.add_argument('--n-splits', type=int, default=5,
+                        help='The number of folds.')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='The number of shuffles of each feature on each '
+                             'fold.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the shuffles.')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='The confidence of the intervals.')
+    parser.add_argument('--latent', choices=('hmm', 'kalman', 'both'),
+                        default='hmm',
+                        help='The latent features of the temporal models.')
+    parser.add_argument('--hmm-cache', type=str, default=None,
+                        help='A folder to cache the trained HMMs in.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes, or 0 for every cpu.')
+    workqueue.add_arguments(parser)
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    instrument.start(args, 'importance')
+
+    try:
+        with instrument.span('importance.load_data'):
+            X, y, schema = load_data(args.data)
+    except:
+        print('COULDN\'T OPEN', args.data)
+        exit(1)
+    if args.model not in _MODEL_STAGES:
+        print('INVALID MODEL')
+        exit(1)
+
+    names = schema['features'] if schema is not None else feature_names()
+    spec = get_model_spec(args.model, latent=args.latent,
+                          hmm_cache=args.hmm_cache)
+    with workqueue.make_executor(args, args.jobs) as executor:
+        with instrument.span('importance.importance', model=args.model):
+            accuracy, rows = importance(X, y, spec, names, executor,
+                                        n_splits=args.n_splits,
+                                        n_repeats=args.repeats,
+                                        seed=args.seed,
+                                        confidence=args.confidence)
+
+    print('Cumulative accuracy after {} folds: {}'.format(args.n_splits,
+                                                          accuracy))
+    print('{:<20} {:>28} {:>28}'.format('FEATURE', 'PERMUTATION', 'ABLATION'))
+    for row in rows:
+        print('{:<20} {:>28} {:>28}'.format(
+            row['feature'],
+            '{:+.4f} [{:+.4f}, {:+.4f}]'.format(
+                row['permutation'], *row['permutation_interval']),
+            '{:+.4f} [{:+.4f}, {:+.4f}]'.format(
+                row['ablation'], *row['ablation_interval'])))
+
+    if args.outfile is not None:
+        with open(args.outfile, 'w') as f:
+            json.dump({'model': args.model, 'accuracy': accuracy,
+                       'confidence': args.confidence, 'features': rows}, f,
+                      indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+# instrument.py
+# Profiling shared by the command line tools. Stages of the pipeline are
+# wrapped in spans, and counters, latency histograms and swallowed exceptions
+# are recorded alongside them. Everything is off unless profiling is enabled,
+# and until then a span is one check of a global giving a shared do nothing
+# object, so the instrumentation can stay in the hot paths. The results are
+# written as a JSON summary or as a Chrome trace (chrome://tracing or
+# https://ui.perfetto.dev)
+
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+# the upper bounds of the buckets of the latency histograms, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+              float('inf'))
+
+# the most spans kept for a Chrome trace, past which they are only summed
+MAX_EVENTS = 1000000
+
+
+class _NullSpan():
+    """The span given when profiling is disabled, which does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span():
+    """Times the code run within it for the Profiler
+    """
+    def __init__(self, profiler, name, cat, args):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._end(self, time.perf_counter())
+        return False
+
+
+def _max_rss():
+    """The high water mark of this process's memory in bytes
+    """
+    # in kilobytes on linux, but bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Profiler():
+    """Collects the spans, counters, histograms and swallowed exceptions of a
+    single run
+    """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        # the wall clock time of the origin, to line up the spans of other
+        # processes when merging them
+        self.wall_origin = time.time()
+        self.spans = {}
+        self.counters = {}
+        self.histograms = {}
+        self.swallowed = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    def span(self, name, cat, args):
+        return _Span(self, name, cat, args)
+
+    def _end(self, span, end):
+        seconds = end - span.start
+        args = span.args
+        if span.cat == 'stage':
+            args = dict(args or {}, max_rss_bytes=_max_rss())
+        with self._lock:
+            total = self.spans.setdefault(span.name, [0, 0., 0.])
+            total[0] += 1
+            total[1] += seconds
+            total[2] = max(total[2], seconds)
+            if len(self.events) < MAX_EVENTS:
+                event = {'name': span.name, 'cat': span.cat, 'ph': 'X',
+                         'ts': (span.start - self.origin) * 1e6,
+                         'dur': seconds * 1e6, 'pid': os.getpid(),
+                         'tid': threading.get_ident()}
+                if args:
+                    event['args'] = args
+                self.events.append(event)
+
+    def count(self, name, n):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, ms):
+        with self._lock:
+            counts = self.histograms.setdefault(name, [0] * len(BUCKETS_MS))
+            counts[next(i for i, bound in enumerate(BUCKETS_MS)
+                        if ms <= bound)] += 1
+
+    def swallow(self, where, exc_type):
+        key = '{}: {}'.format(where, getattr(exc_type, '__name__', exc_type))
+        with self._lock:
+            self.swallowed[key] = self.swallowed.get(key, 0) + 1
+
+    def records(self):
+        """Returns everything recorded as a picklable dict, which another
+        process's Profiler can merge
+        """
+        with self._lock:
+            return {'wall_origin': self.wall_origin,
+                    'spans': {name: list(total)
+                              for name, total in self.spans.items()},
+                    'counters': dict(self.counters),
+                    'histograms': {name: list(counts) for name, counts
+                                   in self.histograms.items()},
+                    'swallowed': dict(self.swallowed),
+                    'events': list(self.events)}
+
+    def merge(self, records):
+        """Adds what another profiler recorded, eg. in a worker process, to
+        what this one has. Its spans are moved onto this profiler's timeline.
+
+        Arguments:
+            records: The result of the other Profiler's records
+        """
+        shift = (records['wall_origin'] - self.wall_origin) * 1e6
+        with self._lock:
+            for name, (calls, seconds, longest) in records['spans'].items():
+                total = self.spans.setdefault(name, [0, 0., 0.])
+                total[0] += calls
+                total[1] += seconds
+                total[2] = max(total[2], longest)
+            for name, n in records['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, counts in records['histograms'].items():
+                total = self.histograms.setdefault(name,
+                                                   [0] * len(BUCKETS_MS))
+                for i, n in enumerate(counts):
+                    total[i] += n
+            for key, n in records['swallowed'].items():
+                self.swallowed[key] = self.swallowed.get(key, 0) + n
+            for event in records['events'][:MAX_EVENTS - len(self.events)]:
+                self.events.append(dict(event, ts=event['ts'] + shift))
+
+    def summary(self):
+        """Returns the totals of everything recorded as a dict
+        """
+        return {
+            'wall_seconds': time.perf_counter() - self.origin,
+            'max_rss_bytes': _max_rss(),
+            'spans': {name: {'calls': calls, 'seconds': seconds,
+                             'max_seconds': longest}
+                      for name, (calls, seconds, longest)
+                      in sorted(self.spans.items())},
+            'counters': dict(sorted(self.counters.items())),
+            'histograms_ms': {name: {'buckets': [str(b) for b in BUCKETS_MS],
+                                     'counts': counts}
+                              for name, counts in
+                              sorted(self.histograms.items())},
+            'swallowed_exceptions': dict(sorted(self.swallowed.items())),
+        }
+
+    def chrome_trace(self):
+        """Returns the spans as a Chrome trace, with the counters at the end
+        and the summary as its metadata
+        """
+        end = (time.perf_counter() - self.origin) * 1e6
+        counters = [{'name': name, 'ph': 'C', 'ts': end, 'pid': os.getpid(),
+                     'args': {'value': value}}
+                    for name, value in sorted(self.counters.items())]
+        return {'traceEvents': self.events + counters,
+                'displayTimeUnit': 'ms', 'otherData': self.summary()}
+
+
+# the profiler of this process, None when profiling is disabled
+_PROFILER = None
+
+# writes the results of the run started by start, None if there isn't one
+_FINISH = None
+
+
+def enable():
+    """Starts profiling this process, forgetting anything recorded before
+    """
+    global _PROFILER
+    _PROFILER = Profiler()
+    return _PROFILER
+
+
+def disable():
+    """Stops profiling, returning the Profiler with what was recorded
+    """
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    return profiler
+
+
+def enabled():
+    """Whether this process is being profiled
+    """
+    return _PROFILER is not None
+
+
+def run_profiled(func, *args, **kwargs):
+    """Runs func(*args, **kwargs) with a profiler of its own and returns its
+    result and what was recorded, for the tasks of worker processes whose
+    profile would otherwise be lost. See merge.
+
+    Arguments:
+        func: The function
+        args: Its arguments
+        kwargs: Its keyword arguments
+    """
+    global _PROFILER
+    previous = _PROFILER
+    profiler = _PROFILER = Profiler()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        _PROFILER = previous
+    return result, profiler.records()
+
+
+def merge(records):
+    """Adds what was recorded by run_profiled to this process's profile, if
+    it is being profiled
+
+    Arguments:
+        records: The records returned by run_profiled
+    """
+    if _PROFILER is not None:
+        _PROFILER.merge(records)
+
+
+def span(name, cat='stage', **args):
+    """Returns a context manager timing the code within it as the named span.
+    The spans of category 'stage' also record the memory high water mark as
+    they finish.
+
+    Arguments:
+        name: The name of the span, where every span of the same name is
+            summed together in the summary
+        cat: The category of the span, eg. 'stage', 'generator' or 'http'
+        args: Any details of this span for the Chrome trace
+    """
+    if _PROFILER is None:
+        return _NULL_SPAN
+    return _PROFILER.span(name, cat, args)
+
+
+def count(name, n=1):
+    """Adds to the named counter
+
+    Arguments:
+        name: The counter
+        n: The amount to add
+    """
+    if _PROFILER is not None:
+        _PROFILER.count(name, n)
+
+
+def observe(name, ms):
+    """Adds a latency to the named histogram
+
+    Arguments:
+        name: The histogram
+        ms: The latency in milliseconds
+    """
+    if _PROFILER is not None:
+        _PROFILER.observe(name, ms)
+
+
+def swallowed(where):
+    """Counts the exception being handled as swallowed at where, for the
+    except blocks which carry on past a failure. Call from within the except
+    block.
+
+    Arguments:
+        where: Where the exception was swallowed, eg. the generator's name
+    """
+    if _PROFILER is not None:
+        _PROFILER.swallow(where, sys.exc_info()[0])
+
+
+def write(profiler, path, fmt='json'):
+    """Writes what the profiler recorded to a file
+
+    Arguments:
+        profiler: The Profiler
+        path: The file to write to
+        fmt: Either 'json' for the summary or 'chrome' for a Chrome trace
+    """
+    with open(path, 'w') as f:
+        json.dump(profiler.chrome_trace() if fmt == 'chrome' else
+                  profiler.summary(), f, indent=1)
+
+
+def add_arguments(parser):
+    """Adds the --profile options to a command line parser
+
+    Arguments:
+        parser: The argparse.ArgumentParser
+    """
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Profile the run and write the results to this '
+                             'file.')
+    parser.add_argument('--profile-format', choices=('json', 'chrome'),
+                        default='json',
+                        help='Write the profile as a JSON summary or as a '
+                             'Chrome trace.')
+
+
+def start(args, name):
+    """Starts profiling the rest of the run if --profile was given, writing
+    the results when the process exits however it does (including by exit())
+    or when finish is called
+
+    Arguments:
+        args: The parsed command line arguments with the --profile options
+        name: The name of the span of the whole run
+    """
+    global _FINISH
+    if getattr(args, 'profile', None) is None:
+        return
+
+    profiler = enable()
+    run = span(name)
+    run.__enter__()
+
+    def _finish():
+        run.__exit__(None, None, None)
+        disable()
+        write(profiler, args.profile, args.profile_format)
+    _FINISH = _finish
+    atexit.register(_finish)
+
+
+def finish():
+    """Ends the run started by start now rather than when the process exits,
+    for processes which run one command after another (eg. worker.py)
+    """
+    global _FINISH
+    if _FINISH is not None:
+        atexit.unregister(_FINISH)
+        finish_, _FINISH = _FINISH, None
+        finish_()
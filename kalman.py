@@ -0,0 +1,334 @@
+# kalman.py
+# A linear gaussian state space model (Kalman filter) of a team's latent form
+# over its season. Every team season is filtered and smoothed at once by
+# padding them into a single array, and the parameters are learnt with EM.
+# Since the covariances of the filter only depend on how far into the season
+# each game is, then they are shared by every series and only the means need
+# to be computed per series
+
+import numpy as np
+
+from batched_hmm import pad_series, series_bounds
+
+
+class KalmanModel():
+    """The state space model
+
+        z_1 ~ N(mu0, P0)
+        z_t = A z_{t-1} + w,  w ~ N(0, Q)
+        x_t = C z_t + v,      v ~ N(0, R)
+
+    where x_t are the standardized inputs of the t-th game of a series, z_t
+    is the latent form of the team and R is diagonal.
+    """
+    def __init__(self, n_dims=2, n_iter=20, tol=1e-4, min_noise=1e-2):
+        """
+        Arguments:
+            n_dims: The dimension of the latent state
+            n_iter: The maximum number of EM iterations while fitting
+            tol: Stop fitting once the log likelihood improves by less than
+                this fraction
+            min_noise: The smallest variance of the noise of each standardized
+                input, so that a nearly deterministic input (eg. atHome)
+                can't be fit exactly by the latent state
+        """
+        self.n_dims = n_dims
+        self.n_iter = n_iter
+        self.tol = tol
+        self.min_noise = min_noise
+
+    # the learnt parameters, as saved by to_dict
+    _PARAMS = ('C', 'R', 'A', 'Q', 'mu0', 'P0', 'shift', 'scale')
+
+    def to_dict(self):
+        """Returns the learnt parameters as a dict of numpy arrays, for saving
+        """
+        params = {name: getattr(self, name) for name in self._PARAMS}
+        params['n_dims'] = np.array(self.n_dims)
+        return params
+
+    @classmethod
+    def from_dict(cls, params):
+        """Makes the fitted model from the result of to_dict
+
+        Arguments:
+            params: The dict of parameters
+        """
+        model = cls(int(params['n_dims']))
+        for name in cls._PARAMS:
+            setattr(model, name, np.asarray(params[name]))
+        return model
+
+    def _init_params(self, X):
+        """Initializes the parameters from the principal components of the
+        inputs
+
+        Arguments:
+            X: The standardized inputs, without the series id
+        """
+        d = X.shape[1]
+        m = self.n_dims
+        cov = np.cov(X.T) if X.shape[0] > 1 else np.eye(d)
+        vals, vecs = np.linalg.eigh(np.atleast_2d(cov))
+        top = np.argsort(vals)[::-1][:m]
+        C = np.zeros((d, m))
+        C[:, :len(top)] = vecs[:, top] * np.sqrt(np.maximum(vals[top], 1e-6))
+
+        self.C = C
+        self.R = np.maximum(np.diag(np.atleast_2d(cov)) -
+                            (C * C).sum(axis=1), self.min_noise)
+        self.A = 0.9 * np.eye(m)
+        self.Q = 0.1 * np.eye(m)
+        self.mu0 = np.zeros(m)
+        self.P0 = np.eye(m)
+
+    def _standardize(self, X):
+        """Pads the series and standardizes the inputs
+
+        Arguments:
+            X: The inputs with first column the series id
+        """
+        padded, lengths, idx = pad_series(X)
+        return (padded - self.shift) / self.scale, lengths, idx
+
+    def _filter(self, padded, lengths):
+        """Runs the Kalman filter over every series at once. Returns the
+        filtered means (series, timesteps, dims), the predicted means, the
+        shared filtered and predicted covariances for each timestep and the
+        log likelihood of the inputs.
+
+        Arguments:
+            padded: The standardized padded inputs
+            lengths: The length of each series
+        """
+        S, T, d = padded.shape
+        m = self.n_dims
+        C, R = self.C, np.diag(self.R)
+
+        m_pred = np.zeros((S, T, m))
+        m_filt = np.zeros((S, T, m))
+        P_pred = np.zeros((T, m, m))
+        P_filt = np.zeros((T, m, m))
+        loglik = 0.
+
+        for t in range(T):
+            active = t < lengths
+            if t == 0:
+                m_pred[:, 0] = self.mu0
+                P_pred[0] = self.P0
+            else:
+                m_pred[:, t] = m_filt[:, t - 1].dot(self.A.T)
+                P_pred[t] = self.A.dot(P_filt[t - 1]).dot(self.A.T) + self.Q
+
+            # the gain is the same for every series at this step
+            innov_cov = C.dot(P_pred[t]).dot(C.T) + R
+            innov_chol = np.linalg.cholesky(innov_cov)
+            gain = np.linalg.solve(innov_cov, C.dot(P_pred[t])).T
+
+            resid = padded[:, t] - m_pred[:, t].dot(C.T)
+            m_filt[:, t] = m_pred[:, t] + resid.dot(gain.T)
+            P_filt[t] = (np.eye(m) - gain.dot(C)).dot(P_pred[t])
+
+            z = np.linalg.solve(innov_chol, resid[active].T)
+            log_norm = (np.log(np.diag(innov_chol)).sum() +
+                        0.5 * d * np.log(2 * np.pi))
+            loglik += -0.5 * (z * z).sum() - active.sum() * log_norm
+
+        return m_filt, m_pred, P_filt, P_pred, loglik
+
+    def _smooth(self, m_filt, m_pred, P_filt, P_pred, lengths):
+        """Runs the Rauch-Tung-Striebel smoother backwards from the end of
+        every series at once. Returns the smoothed means, and for every
+        distinct series length the smoothed covariances and the lag one
+        cross covariances of each timestep.
+
+        Arguments:
+            m_filt, m_pred, P_filt, P_pred: The results of _filter
+            lengths: The length of each series
+        """
+        S, T, m = m_filt.shape
+
+        # the smoother gains only depend on the timestep
+        J = np.zeros((T, m, m))
+        for t in range(T - 1):
+            J[t] = np.linalg.solve(P_pred[t + 1].T,
+                                   self.A.dot(P_filt[t].T)).T
+
+        m_smooth = m_filt.copy()
+        for t in range(T - 2, -1, -1):
+            inside = (t + 1 < lengths)[:, None]
+            step = m_filt[:, t] + \
+                (m_smooth[:, t + 1] - m_pred[:, t + 1]).dot(J[t].T)
+            m_smooth[:, t] = np.where(inside, step, m_smooth[:, t])
+
+        # the covariances depend on where the series ends, so are computed
+        # once for each distinct length
+        covs = {}
+        for L in np.unique(lengths):
+            V = np.zeros((L, m, m))
+            V_lag = np.zeros((L, m, m))
+            V[L - 1] = P_filt[L - 1]
+            for t in range(L - 2, -1, -1):
+                V[t] = P_filt[t] + J[t].dot(V[t + 1] - P_pred[t + 1]).dot(
+                    J[t].T)
+                # covariance of z_{t+1} and z_t
+                V_lag[t + 1] = V[t + 1].dot(J[t].T)
+            covs[L] = (V, V_lag)
+
+        return m_smooth, covs
+
+    def fit(self, X, warm_start=False):
+        """Learns the parameters with EM, returning itself
+
+        Arguments:
+            X: The inputs with first column the series id
+            warm_start: If True and the model has already been fit, then EM
+                continues from its current parameters (and standardization)
+                rather than from the principal components of X, eg. when X
+                is the data it was fit on plus some more.
+        """
+        X = np.asarray(X, dtype=float)
+        if not (warm_start and hasattr(self, 'C')):
+            self.shift = X[:, 1:].mean(axis=0)
+            self.scale = X[:, 1:].std(axis=0)
+            self.scale[self.scale == 0] = 1.
+            self._init_params((X[:, 1:] - self.shift) / self.scale)
+
+        padded, lengths, (series, steps) = self._standardize(X)
+        S, T, d = padded.shape
+        m = self.n_dims
+        active = np.arange(T)[None, :] < lengths[:, None]
+        n_obs = active.sum()
+
+        # the inputs' own statistics don't change between iterations
+        x = padded[series, steps]
+        Sxx = (x * x).sum(axis=0)
+
+        self.loglik_ = []
+        for it in range(self.n_iter):
+            m_filt, m_pred, P_filt, P_pred, loglik = \
+                self._filter(padded, lengths)
+            self.loglik_.append(loglik)
+            if it > 0 and abs(loglik - self.loglik_[-2]) < \
+                    self.tol * abs(self.loglik_[-2]):
+                break
+
+            m_smooth, covs = self._smooth(m_filt, m_pred, P_filt, P_pred,
+                                          lengths)
+
+            # the sums of the expected sufficient statistics over every step
+            # of every series, with the covariances weighted by how many
+            # series share them
+            mz = m_smooth[series, steps]
+            Szz = mz.T.dot(mz)
+            Sprev = np.zeros((m, m))
+            Scur = np.zeros((m, m))
+            Slag = np.zeros((m, m))
+            counts = dict(zip(*np.unique(lengths, return_counts=True)))
+            for L, (V, V_lag) in covs.items():
+                Szz += counts[L] * V.sum(axis=0)
+                Sprev += counts[L] * V[:-1].sum(axis=0)
+                Scur += counts[L] * V[1:].sum(axis=0)
+                Slag += counts[L] * V_lag[1:].sum(axis=0)
+
+            later = steps > 0
+            cur = mz[later]
+            prev = m_smooth[series[later], steps[later] - 1]
+            Sprev += prev.T.dot(prev)
+            Scur += cur.T.dot(cur)
+            Slag += cur.T.dot(prev)
+            Sxz = x.T.dot(mz)
+
+            first = m_smooth[:, 0]
+            V_first = sum(counts[L] * covs[L][0][0] for L in covs)
+
+            # the M step, all in closed form
+            self.C = np.linalg.solve(Szz.T, Sxz.T).T
+            self.R = np.maximum((Sxx - (self.C * Sxz).sum(axis=1)) / n_obs,
+                                self.min_noise)
+            if later.any():
+                self.A = np.linalg.solve(Sprev.T, Slag.T).T
+                self.Q = (Scur - self.A.dot(Slag.T)) / later.sum()
+                self.Q = 0.5 * (self.Q + self.Q.T) + 1e-6 * np.eye(m)
+            self.mu0 = first.mean(axis=0)
+            diff = first - self.mu0
+            self.P0 = (V_first + diff.T.dot(diff)) / S + 1e-6 * np.eye(m)
+
+        return self
+
+    def filter(self, X):
+        """Returns the filtered mean of the latent state at every row of X,
+        which only uses the rows of the series up to and including it.
+
+        Arguments:
+            X: The inputs with first column the series id
+        """
+        padded, lengths, (series, steps) = \
+            self._standardize(np.asarray(X, dtype=float))
+        m_filt = self._filter(padded, lengths)[0]
+        return m_filt[series, steps]
+
+    def smooth(self, X):
+        """Returns the smoothed mean of the latent state at every row of X,
+        which uses the whole of each series.
+
+        Arguments:
+            X: The inputs with first column the series id
+        """
+        padded, lengths, (series, steps) = \
+            self._standardize(np.asarray(X, dtype=float))
+        m_smooth, _ = self._smooth(*self._filter(padded, lengths)[:4],
+                                   lengths=lengths)
+        return m_smooth[series, steps]
+
+    def next_state(self, X, ids):
+        """Returns what is needed to filter a game appended to the end of each
+        of the given series without filtering the series again: the predicted
+        mean of the latent state at the next step and the gain of that step.
+        Use with filter_next.
+
+        Arguments:
+            X: The inputs with first column the series id
+            ids: The series ids to get the state of. Ids with no rows in X
+                are treated as empty series.
+        """
+        X = np.asarray(X, dtype=float)
+        means = np.tile(self.mu0, (len(ids), 1))
+        covs = np.tile(self.P0, (len(ids), 1, 1))
+
+        if X.shape[0]:
+            padded, lengths, _ = self._standardize(X)
+            m_filt, _, P_filt, _, _ = self._filter(padded, lengths)
+            last = m_filt[np.arange(len(lengths)), lengths - 1]
+            # the covariances are shared by every series of the same length
+            P_next = np.einsum('ij,tjk,lk->til', self.A, P_filt,
+                               self.A) + self.Q
+
+            starts, _ = series_bounds(X[:, 0])
+            where = {sid: i for i, sid in enumerate(X[starts, 0])}
+            for i, sid in enumerate(ids):
+                if sid in where:
+                    means[i] = last[where[sid]].dot(self.A.T)
+                    covs[i] = P_next[lengths[where[sid]] - 1]
+
+        # the gain of each series' next step, as in _filter
+        C, R = self.C, np.diag(self.R)
+        innov = np.einsum('ij,njk,lk->nil', C, covs, C) + R
+        gains = np.transpose(np.linalg.solve(
+            innov, np.einsum('ij,njk->nik', C, covs)), (0, 2, 1))
+        return means, gains
+
+    def filter_next(self, state, which, X):
+        """Returns the filtered mean of the latent state of each row of X as
+        the next step of a series. Gives the same means as filter on the
+        series with the row appended.
+
+        Arguments:
+            state: The result of next_state
+            which: For each row of X, the index of its series in next_state
+            X: The inputs of the new steps, without a series id
+        """
+        means, gains = state[0][which], state[1][which]
+        resid = (np.asarray(X, dtype=float) - self.shift) / self.scale - \
+            means.dot(self.C.T)
+        return means + np.einsum('nij,nj->ni', gains, resid)
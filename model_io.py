@@ -0,0 +1,266 @@
+# model_io.py
+# Fits the models of train_models.py on the whole dataset, saves them to disk
+# and loads them back for predicting new matchups. A saved model is a single
+# numpy .npz file with the classifier's and latent models' parameters and the
+# schema of the features it expects, so loading it doesn't need any training
+
+import json
+
+import numpy as np
+
+from batched_hmm import HMMParams, next_log_prior, predict as hmm_predict, \
+    predict_next
+from feature_gen import FEATURE_SET_VERSION
+from gaussian_bayes import GaussianBayesClassifier
+from kalman import KalmanModel
+from train_models import get_comp_stat_columns, get_input_masks, \
+    get_model_spec
+
+
+# Incremented whenever the layout of the saved files changes
+MODEL_FORMAT_VERSION = 1
+
+
+class TrainedModel():
+    """A model fit on the whole dataset, which scores rows in the same layout
+    as the features from feature_gen.py (series id, then the target team's
+    features, then the opposition's).
+    """
+    def __init__(self, name, inputs, columns, classifier, latent=(),
+                 schema=None):
+        """
+        Arguments:
+            name: The name of the model, one of train_models._MODELS
+            inputs: The name of its input selection, eg. get_stat_inputs
+            columns: The columns of the features it uses (not counting the
+                series id), before any input transform
+            classifier: The fitted GaussianBayesClassifier
+            latent: The fitted latent models in order, each either HMMParams
+                or a KalmanModel. Empty for the non temporal models.
+            schema: The schema of the features it was trained on, with at
+                least their 'version'
+        """
+        self.name = name
+        self.inputs = inputs
+        self.columns = np.asarray(columns, dtype=int)
+        self.classifier = classifier
+        self.latent = list(latent)
+        self.schema = schema if schema is not None else \
+            {'version': FEATURE_SET_VERSION}
+
+    def _check_schema(self, schema):
+        """Raises a ValueError if the features aren't the ones trained on
+
+        Arguments:
+            schema: The schema of the features to predict on
+        """
+        if schema is None:
+            return
+        for key in ('version', 'features'):
+            if key in schema and key in self.schema and \
+                    schema[key] != self.schema[key]:
+                raise ValueError('The model was trained on features with a '
+                                 'different {}'.format(key))
+
+    def _inputs(self, X):
+        """Returns the series id and the inputs of the classifier before any
+        latent features, with nan for unknown values
+
+        Arguments:
+            X: The features with first column the series id
+        """
+        X = np.asarray(X)
+        if X.dtype == object:
+            X = np.where(np.equal(X, None), np.nan, X).astype(float)
+        X = X.astype(float)
+
+        _X = np.column_stack((X[:, 0], X[:, 1 + self.columns]))
+        if self.inputs == 'get_comp_stat_inputs':
+            _X = np.column_stack((_X[:, 0], get_comp_stat_columns(_X)))
+        return _X
+
+    def transform(self, X):
+        """Returns the classifier's inputs for every row of X. Rows with
+        unknown values in the features used get nan inputs.
+
+        Arguments:
+            X: The features with first column the series id. For the temporal
+                models the rows of each team's season must be in order,
+                since the latent features depend on the previous games.
+        """
+        _X = self._inputs(X)
+        if not self.latent:
+            return _X[:, 1:]
+
+        # the latent models only see the usable rows, as when fitting, so
+        # that an unknown row doesn't carry into the rest of its series.
+        # Their features are then put back in place, nan for the others
+        known = ~np.isnan(_X[:, 1:]).any(axis=1)
+        latent = [hmm_predict(model, _X[known])
+                  if isinstance(model, HMMParams)
+                  else model.filter(_X[known])
+                  for model in self.latent]
+        columns = []
+        for values in latent:
+            values = np.asarray(values, dtype=float)
+            values = values.reshape(len(values), -1)
+            full = np.full((len(_X), values.shape[1]), np.nan)
+            full[known] = values
+            columns.append(full)
+        return np.hstack([_X[:, 1:]] + columns)
+
+    def next_states(self, X, ids):
+        """Returns the state of each latent model at the end of the given
+        series, for scoring games appended to them with predict_proba_next.
+        Empty for the non temporal models.
+
+        Arguments:
+            X: The features with first column the series id, only with rows
+                whose features the model uses are all known
+            ids: The series ids to get the states of. Ids with no rows in X
+                are treated as series with no games yet.
+        """
+        _X = self._inputs(X)
+        return [next_log_prior(model, _X, ids)
+                if isinstance(model, HMMParams) else model.next_state(_X, ids)
+                for model in self.latent]
+
+    def predict_proba_next(self, states, which, X, schema=None):
+        """Returns the probability that the target team wins each row of X,
+        where each row is the next game of a series. This gives the same as
+        predict_proba on the series with the row appended, but only the new
+        rows are computed.
+
+        Arguments:
+            states: The result of next_states
+            which: For each row of X, the index of its series in next_states
+            X: The features, as for transform (the series id is ignored)
+            schema: See predict_proba
+        """
+        self._check_schema(schema)
+        _X = self._inputs(X)[:, 1:]
+        inputs = np.hstack([_X] + [
+            predict_next(model, state, which, _X)
+            if isinstance(model, HMMParams)
+            else model.filter_next(state, which, _X)
+            for model, state in zip(self.latent, states)])
+        win = np.flatnonzero(self.classifier.classes == 1)[0]
+        return self.classifier.predict_proba(inputs)[:, win]
+
+    def predict_proba(self, X, schema=None):
+        """Returns the probability that the target team wins each row, in one
+        vectorized pass over all the rows.
+
+        Arguments:
+            X: The features, as for transform
+            schema: The schema of the features if known, which is checked
+                against the model's
+        """
+        self._check_schema(schema)
+        win = np.flatnonzero(self.classifier.classes == 1)[0]
+        return self.classifier.predict_proba(self.transform(X))[:, win]
+
+    def predict(self, X, schema=None):
+        """Returns whether the target team is predicted to win each row, or -1
+        for rows missing a feature the model uses, which can't be predicted
+
+        Arguments:
+            X: The features, as for transform
+            schema: See predict_proba
+        """
+        probs = self.predict_proba(X, schema)
+        return np.where(np.isnan(probs), -1, probs > 0.5).astype(int)
+
+    def save(self, path):
+        """Saves the model to a .npz file
+
+        Arguments:
+            path: The file to save to
+        """
+        arrays = {'columns': self.columns}
+        arrays.update({'classifier_' + key: val for key, val in
+                       self.classifier.to_dict().items()})
+        kinds = []
+        for i, model in enumerate(self.latent):
+            kinds.append('hmm' if isinstance(model, HMMParams) else 'kalman')
+            arrays.update({'latent{}_{}'.format(i, key): val for key, val in
+                           model.to_dict().items()})
+
+        meta = {'format': MODEL_FORMAT_VERSION, 'name': self.name,
+                'inputs': self.inputs, 'latent': kinds,
+                'schema': self.schema}
+        with open(path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a model saved by save
+
+        Arguments:
+            path: The saved file
+        """
+        with np.load(path) as saved:
+            arrays = dict(saved.items())
+        meta = json.loads(str(arrays.pop('meta')))
+        if meta['format'] != MODEL_FORMAT_VERSION:
+            raise ValueError('Unknown model format {}'.format(meta['format']))
+
+        def params(prefix):
+            return {key[len(prefix):]: val for key, val in arrays.items()
+                    if key.startswith(prefix)}
+
+        latent = [(HMMParams if kind == 'hmm' else KalmanModel).from_dict(
+                      params('latent{}_'.format(i)))
+                  for i, kind in enumerate(meta['latent'])]
+        return cls(meta['name'], meta['inputs'], arrays['columns'],
+                   GaussianBayesClassifier.from_dict(params('classifier_')),
+                   latent, meta['schema'])
+
+
+def fit_model(name, X, y, schema=None, **kwargs):
+    """Fits the named model on the whole dataset and returns its TrainedModel
+
+    Arguments:
+        name: One of train_models._MODELS
+        X: The features generated by feature_gen.py
+        y: The labels
+        schema: The schema of the features from feature_gen.py, if known
+        kwargs: The same as the train_* functions, eg. n_components or latent
+    """
+    spec = get_model_spec(name, **kwargs)
+    masks = get_input_masks(X)
+
+    # the columns and rows the input selection keeps, not counting the
+    # series id
+    columns = np.arange(X.shape[1] - 1)
+    rows = masks['complete_rows']
+    if spec.inputs.__name__ == 'get_non_stat_inputs':
+        columns = np.flatnonzero(masks['non_stat_cols'][1:])
+        rows = masks['non_stat_rows']
+    X = X[rows].astype(float)
+    y = y[rows]
+
+    # the inputs are made exactly as they will be when predicting, so that
+    # the two can't differ
+    model = TrainedModel(name, spec.inputs.__name__, columns, None, (),
+                         schema)
+    if spec.latent is not None:
+        _X = np.column_stack((X[:, 0], model.transform(X)))
+        for stage in getattr(spec.latent, 'stages', (spec.latent,)):
+            latent = stage.fit(_X)
+            if stage.key()[0] == 'hmm':
+                latent = HMMParams.from_pomegranate(latent)
+            model.latent.append(latent)
+
+    model.classifier = GaussianBayesClassifier.from_samples(
+        model.transform(X), y)
+    return model
+
+
+def load_model(path):
+    """Loads a model saved by TrainedModel.save
+
+    Arguments:
+        path: The saved file
+    """
+    return TrainedModel.load(path)
@@ -0,0 +1,447 @@
+# neighbours.py
+# An index of every team's features going into each game of its seasons, for
+# finding the historical teams which looked most like a team at the same point
+# of its season. Each row is keyed by its (season, team id, game number),
+# where the game number is how many games the team had played, and the
+# features are normalized by the mean and spread of those the index was built
+# from, so that no one feature dominates the distance. The rows are kept in a
+# k-d tree, with rows added since it was built searched directly until there
+# are enough of them to build it again, and the index is saved as a .npz file
+
+import argparse
+import json
+
+import numpy as np
+
+import instrument
+
+from batched_hmm import series_bounds
+from feature_gen import FEATURE_SET_VERSION, current_features, feature_names
+
+
+# Incremented whenever the layout of the saved files changes
+INDEX_FORMAT_VERSION = 1
+
+# the features which aren't about the team itself, so are left out by default
+NON_TEAM_FEATURES = ('atHome',)
+
+
+class NeighbourIndex():
+    """The nearest neighbour index of team feature vectors, keyed by (season,
+    team id, game number)
+    """
+    def __init__(self, features, mean, scale, keys=(), vectors=None,
+                 rebuild_fraction=0.1, rebuild_min=256):
+        """
+        Arguments:
+            features: The names of the features of each vector, in order
+            mean: The mean of each feature, subtracted when normalizing
+            scale: The spread of each feature, divided by when normalizing
+            keys: The (season, team id, game number) of each row
+            vectors: The normalized vector of each row, as from normalize
+            rebuild_fraction: How many rows can be added, as a fraction of
+                those in the tree, before the tree is built again
+            rebuild_min: How many rows can be added before the tree is built
+                again however few are in it
+        """
+        self.features = list(features)
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.rebuild_fraction = rebuild_fraction
+        self.rebuild_min = rebuild_min
+
+        self._keys = []
+        self._rows = {}
+        self._series = {}
+        self._vectors = np.empty((0, len(self.features)))
+        self._key_array = np.empty((0, 3), dtype=np.int64)
+        self._n = 0
+        # the rows [0, _n_tree) are in the tree, unless it is stale since one
+        # of them changed
+        self._tree = None
+        self._n_tree = 0
+        self._stale = False
+        if len(keys):
+            self.add_normalized(keys, vectors)
+
+    @classmethod
+    def from_features(cls, X, schema, exclude_features=NON_TEAM_FEATURES,
+                      **kwargs):
+        """Builds the index from the features generated by feature_gen.py,
+        with a row for the target team of every row of X
+
+        Arguments:
+            X: The features with first column the series id
+            schema: The schema of the features, which has the season and team
+                of each series id
+            exclude_features: The features to leave out of the vectors
+            kwargs: The same as __init__, eg. rebuild_fraction
+        """
+        names = schema['features']
+        features = [name for name in names if name not in exclude_features]
+        columns = [1 + names.index(name) for name in features]
+
+        X = np.asarray(X)
+        values = _floats(X[:, columns])
+        mean = np.nanmean(values, axis=0) if len(values) else \
+            np.zeros(len(features))
+        scale = np.nanstd(values, axis=0) if len(values) else \
+            np.ones(len(features))
+        # a feature which never varies (or is never known) adds no distance
+        mean = np.where(np.isnan(mean), 0., mean)
+        scale = np.where(np.isnan(scale) | (scale == 0), 1., scale)
+
+        # the rows of each series are its games in order, and the series ids
+        # count from 1
+        keys = []
+        starts, lengths = series_bounds(X[:, 0].astype(int))
+        for start, n in zip(starts, lengths):
+            season, tid = schema['series'][int(X[start, 0]) - 1]
+            keys.extend((int(season), int(tid), game) for game in range(n))
+
+        index = cls(features, mean, scale, **kwargs)
+        index.add_normalized(keys, index.normalize(values))
+        return index
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, key):
+        return tuple(key) in self._rows
+
+    def keys(self):
+        """Returns the (season, team id, game number) of every row, in the
+        order they were added
+        """
+        return list(self._keys)
+
+    def normalize(self, values):
+        """Returns the vectors of feature values as the index compares them,
+        with unknown values (None or nan) at the mean
+
+        Arguments:
+            values: The features of each vector, in the order of features
+        """
+        values = (_floats(np.atleast_2d(values)) - self.mean) / self.scale
+        return np.where(np.isnan(values), 0., values)
+
+    def vector(self, key):
+        """Returns the normalized vector of a row
+
+        Arguments:
+            key: Its (season, team id, game number)
+        """
+        return self._vectors[self._rows[tuple(key)]].copy()
+
+    def latest(self, season, tid):
+        """Returns the key of the last game of a team's season in the index,
+        or None if it has none
+
+        Arguments:
+            season: The season
+            tid: The team id
+        """
+        games = self._series.get((season, tid), ())
+        return (season, tid, max(games)) if games else None
+
+    def add(self, keys, values):
+        """Adds rows of feature values, eg. as new games are played. A key
+        already in the index has its vector replaced.
+
+        Arguments:
+            keys: The (season, team id, game number) of each row
+            values: The features of each row, in the order of features
+        """
+        self.add_normalized(keys, self.normalize(values))
+
+    def add_normalized(self, keys, vectors):
+        """Adds rows whose vectors are already normalized, as add
+
+        Arguments:
+            keys: The (season, team id, game number) of each row
+            vectors: The normalized vector of each row
+        """
+        vectors = np.asarray(vectors, dtype=float).reshape(
+            len(keys), len(self.features))
+        new = []
+        for key, vector in zip(keys, vectors):
+            key = tuple(int(k) for k in key)
+            if key in self._rows:
+                row = self._rows[key]
+                if row >= self._n:
+                    new[row - self._n] = vector  # twice in these keys
+                    continue
+                self._vectors[row] = vector
+                self._stale |= row < self._n_tree
+            else:
+                self._rows[key] = self._n + len(new)
+                self._keys.append(key)
+                self._series.setdefault(key[:2], set()).add(key[2])
+                new.append(vector)
+        if not new:
+            return
+
+        # grown by doubling so that adding a game at a time stays cheap
+        needed = self._n + len(new)
+        if needed > len(self._vectors):
+            grown = np.empty((max(needed, 2 * len(self._vectors)),
+                              len(self.features)))
+            grown[:self._n] = self._vectors[:self._n]
+            self._vectors = grown
+            grown = np.empty((len(grown), 3), dtype=np.int64)
+            grown[:self._n] = self._key_array[:self._n]
+            self._key_array = grown
+        self._vectors[self._n:needed] = new
+        self._key_array[self._n:needed] = self._keys[self._n:]
+        self._n = needed
+
+    def rebuild(self):
+        """Builds the tree over every row
+        """
+        from scipy.spatial import cKDTree
+
+        self._tree = cKDTree(self._vectors[:self._n]) if self._n else None
+        self._n_tree = self._n
+        self._stale = False
+
+    def _needs_rebuild(self):
+        added = self._n - self._n_tree
+        return self._stale or self._tree is None and self._n or \
+            added > max(self.rebuild_min,
+                        self.rebuild_fraction * self._n_tree)
+
+    def query(self, vector, k=10, exclude=None, before=None):
+        """Returns the k rows nearest the normalized vector as a list of
+        (distance, key), nearest first
+
+        Arguments:
+            vector: The normalized vector, eg. from normalize or vector
+            k: The number of rows
+            exclude: A (season, team id) whose rows are skipped, eg. the
+                team's own season
+            before: If given, only rows of seasons before it
+        """
+        if self._needs_rebuild():
+            self.rebuild()
+        vector = np.asarray(vector, dtype=float).ravel()
+
+        keys = self._key_array[:self._n]
+        allowed = np.ones(self._n, dtype=bool)
+        if exclude is not None:
+            allowed &= (keys[:, 0] != exclude[0]) | (keys[:, 1] != exclude[1])
+        if before is not None:
+            allowed &= keys[:, 0] < before
+
+        # the rows added since the tree was built are few, so are searched
+        # directly
+        found = [self._nearest(vector, self._n_tree +
+                               np.flatnonzero(allowed[self._n_tree:]), k)]
+
+        # of the k + (rows skipped) rows of the tree nearest the vector, at
+        # least k aren't skipped. If that's most of the tree (eg. only the
+        # earliest seasons are allowed) then the allowed rows are searched
+        # directly instead
+        in_tree = allowed[:self._n_tree]
+        n_tree = min(self._n_tree, k + self._n_tree - int(in_tree.sum()))
+        if n_tree > self._n_tree // 4:
+            found.append(self._nearest(vector, np.flatnonzero(in_tree), k))
+        elif n_tree > 0:
+            distances, rows = self._tree.query(vector, k=n_tree)
+            rows = np.atleast_1d(rows)
+            found.append((np.atleast_1d(distances)[allowed[rows]],
+                          rows[allowed[rows]]))
+
+        distances = np.concatenate([d for d, _ in found])
+        rows = np.concatenate([r for _, r in found])
+        return [(float(distances[i]), self._keys[rows[i]])
+                for i in np.argsort(distances, kind='stable')[:k]]
+
+    def _nearest(self, vector, rows, k):
+        """Returns the distances and rows of the (at most) k of the rows
+        nearest the vector, in no order, by comparing it with every one
+
+        Arguments:
+            vector: The normalized vector
+            rows: The rows to search
+            k: The number of rows
+        """
+        distances = np.sqrt(((self._vectors[rows] - vector) ** 2).sum(axis=1))
+        if len(rows) > k:
+            nearest = np.argpartition(distances, k)[:k]
+            distances, rows = distances[nearest], rows[nearest]
+        return distances, rows
+
+    def save(self, path):
+        """Saves the index to a .npz file
+
+        Arguments:
+            path: The file to save to
+        """
+        meta = {'format': INDEX_FORMAT_VERSION,
+                'version': FEATURE_SET_VERSION,
+                'features': self.features,
+                'rebuild_fraction': self.rebuild_fraction,
+                'rebuild_min': self.rebuild_min}
+        with open(path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)),
+                     keys=np.array(self._keys, dtype=np.int64).reshape(-1, 3),
+                     vectors=self._vectors[:self._n], mean=self.mean,
+                     scale=self.scale)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved by save. The tree is built again when first
+        queried, which takes far less time than building the index did.
+
+        Arguments:
+            path: The saved file
+        """
+        with np.load(path) as saved:
+            arrays = dict(saved.items())
+        meta = json.loads(str(arrays['meta']))
+        if meta['format'] != INDEX_FORMAT_VERSION:
+            raise ValueError('Unknown index format {}'.format(meta['format']))
+        if meta['version'] != FEATURE_SET_VERSION:
+            raise ValueError('The index was built from features with a '
+                             'different version')
+        return cls(meta['features'], arrays['mean'], arrays['scale'],
+                   arrays['keys'].tolist(), arrays['vectors'],
+                   meta['rebuild_fraction'], meta['rebuild_min'])
+
+
+def _floats(values):
+    """Returns the values as floats with nan for unknown (None) values
+
+    Arguments:
+        values: An array, possibly of objects
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = np.where(np.equal(values, None), np.nan, values)
+    return values.astype(float)
+
+
+def current_rows(data, year, features):
+    """Returns the keys and feature values of every team going into its next
+    game of the season, to add to an index as the games are played
+
+    Arguments:
+        data: The raw data dictionary as given by scrape.py
+        year: The season
+        features: The names of the features of the index
+    """
+    names = feature_names()
+    columns = [names.index(name) for name in features]
+
+    keys, values = [], []
+    for tid, state in current_features(data, year).items():
+        seasons = data['teams'].get(tid, data['teams'].get(str(tid)))
+        season = seasons.get(year, seasons.get(str(year)))
+        # the games played so far, as current_features counts them
+        played = sum(gid in data or str(gid) in data for gid in season['reg'])
+        keys.append((int(year), tid, played))
+        values.append([state[c] for c in columns])
+    return keys, values
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Find the historical teams whose features looked most '
+                    'like a team\'s at the same point of its season.')
+    parser.add_argument('index', type=str,
+                        help='The .npz file of the index.')
+    parser.add_argument('--build', type=str, default=None,
+                        help='Build the index from this features file from '
+                             'feature_gen.py and save it.')
+    parser.add_argument('--add', type=str, default=None,
+                        help='Add every team\'s features going into its next '
+                             'game from this raw data from scrape.py and '
+                             'save the index.')
+    parser.add_argument('--year', type=int, default=None,
+                        help='The season of --add. Default is the latest.')
+    parser.add_argument('--team', type=int, default=None,
+                        help='Find the teams most like this team.')
+    parser.add_argument('--season', type=int, default=None,
+                        help='The season of --team. Default is the latest '
+                             'in the index.')
+    parser.add_argument('--game', type=int, default=None,
+                        help='The game number of --team, ie. how many games '
+                             'it had played. Default is its latest.')
+    parser.add_argument('-k', type=int, default=10,
+                        help='The number of teams to find.')
+    parser.add_argument('--earlier', action='store_true',
+                        help='Only find teams from seasons before --season.')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    instrument.start(args, 'neighbours')
+
+    if args.build is not None:
+        from train_models import load_data
+
+        try:
+            X, _, schema = load_data(args.build)
+        except:
+            print('COULDN\'T OPEN', args.build)
+            exit(1)
+        if schema is None:
+            print('NO SCHEMA IN', args.build)
+            exit(1)
+        with instrument.span('neighbours.build'):
+            index = NeighbourIndex.from_features(X, schema)
+    else:
+        try:
+            index = NeighbourIndex.load(args.index)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        except:
+            print('COULDN\'T OPEN', args.index)
+            exit(1)
+
+    if args.add is not None:
+        try:
+            with open(args.add, 'r') as f:
+                data = json.load(f)
+        except:
+            print('COULDN\'T OPEN', args.add)
+            exit(1)
+        year = args.year if args.year is not None else \
+            max(int(year) for year in data['years'])
+        with instrument.span('neighbours.add'):
+            index.add(*current_rows(data, year, index.features))
+
+    if args.build is not None or args.add is not None:
+        index.save(args.index)
+        print('SAVED', len(index), 'ROWS TO', args.index)
+
+    if args.team is None:
+        return
+
+    season = args.season if args.season is not None else \
+        max(key[0] for key in index.keys())
+    key = (season, args.team, args.game) if args.game is not None else \
+        index.latest(season, args.team)
+    if key is None or key not in index:
+        print('NO ROW FOR', season, args.team, args.game)
+        exit(1)
+
+    with instrument.span('neighbours.query'):
+        found = index.query(index.vector(key), args.k,
+                            exclude=(season, args.team),
+                            before=season if args.earlier else None)
+    print('SEASON TEAM GAME DISTANCE')
+    for distance, (s, tid, game) in found:
+        print(s, tid, game, '{:.4f}'.format(distance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+# out_of_core.py
+# Trains and cross validates the models on features too large to load at
+# once. The features are saved by feature_gen.py as a float .npy file which is
+# memory mapped and read a chunk of rows at a time, and everything the models
+# learn is a sum over the rows: the classifier's sufficient statistics and
+# the expected statistics of the HMM's EM. So the memory used is bounded by
+# the size of a chunk rather than of the dataset.
+
+import json
+
+import numpy as np
+
+from batched_hmm import HMMParams, expected_statistics
+from gaussian_bayes import GaussianBayesClassifier, GaussianStats
+from model_io import TrainedModel
+from train_models import HiddenSpaceStage, get_model_spec
+
+
+class FeatureFile():
+    """The features saved by feature_gen.save_features_npy, memory mapped
+    """
+    def __init__(self, path):
+        """
+        Arguments:
+            path: The .npy file, with its schema in path + '.json'
+        """
+        self.array = np.load(path, mmap_mode='r')
+        try:
+            with open(path + '.json', 'r') as f:
+                self.schema = json.load(f)
+        except IOError:
+            self.schema = None
+
+    @property
+    def n_rows(self):
+        return self.array.shape[0]
+
+    @property
+    def n_columns(self):
+        """The number of columns of the features, without the label
+        """
+        return self.array.shape[1] - 1
+
+    def chunks(self, chunk_rows):
+        """Yields the (first row, features, labels) of each chunk of about
+        chunk_rows rows, as in memory arrays. A chunk is extended to the end
+        of the series it stops in, so that no series is split between chunks.
+
+        Arguments:
+            chunk_rows: The number of rows to read at once
+        """
+        start = 0
+        while start < self.n_rows:
+            stop = min(start + chunk_rows, self.n_rows)
+            # carry on until the series id of the last row changes
+            while stop < self.n_rows:
+                ahead = self.array[stop:stop + chunk_rows, 0]
+                changes = np.flatnonzero(ahead != self.array[stop - 1, 0])
+                if len(changes):
+                    stop += changes[0]
+                    break
+                stop += len(ahead)
+            block = np.array(self.array[start:stop])
+            yield start, block[:, :-1], block[:, -1]
+            start = stop
+
+
+class ChunkedInputs():
+    """The rows and columns of a FeatureFile used by one of the models'
+    input selections, read a chunk at a time. The columns are found in one
+    pass over the file the same way as train_models.get_input_masks, then
+    another pass counts the rows used and the mean of their inputs.
+    """
+    def __init__(self, features, model, chunk_rows):
+        """
+        Arguments:
+            features: The FeatureFile
+            model: The TrainedModel being trained, whose columns are set here
+            chunk_rows: The number of rows to read at once
+        """
+        self.features = features
+        self.model = model
+        self.chunk_rows = chunk_rows
+
+        num_features = int(features.n_columns / 2)
+        columns = np.arange(features.n_columns - 1)
+        if model.inputs == 'get_non_stat_inputs':
+            # the features whose target team's column is always known
+            known = np.ones(num_features, dtype=bool)
+            for _, X, _ in features.chunks(chunk_rows):
+                known &= ~np.isnan(X[:, 1:num_features + 1]).any(axis=0)
+            columns = np.flatnonzero(np.concatenate((known, known)))
+        model.columns = columns
+
+        self.n_rows = 0
+        sums = 0.
+        classes = set()
+        for _, X, y in self.chunks():
+            self.n_rows += len(y)
+            sums = sums + model.transform(X).sum(axis=0)
+            classes.update(np.unique(y).tolist())
+        self.classes = np.array(sorted(classes))
+        self.mean = sums / max(self.n_rows, 1)
+
+    def chunks(self):
+        """Yields the (first row, features, labels) of each chunk, keeping only
+        the rows used, where the first row counts only the rows used
+        """
+        used = 0
+        for _, X, y in self.features.chunks(self.chunk_rows):
+            # every other model needs the rows known throughout
+            cols = np.concatenate(([0], 1 + self.model.columns)) \
+                if self.model.inputs == 'get_non_stat_inputs' else \
+                np.arange(X.shape[1])
+            rows = ~np.isnan(X[:, cols]).any(axis=1)
+            yield used, X[rows], y[rows]
+            used += int(rows.sum())
+
+    def fold_bounds(self, n_splits):
+        """Returns the first and last (exclusive) used row of each fold, the
+        same contiguous folds as sklearn's KFold without shuffling
+
+        Arguments:
+            n_splits: The number of folds
+        """
+        sizes = np.full(n_splits, self.n_rows // n_splits)
+        sizes[:self.n_rows % n_splits] += 1
+        stops = np.cumsum(sizes)
+        return list(zip(stops - sizes, stops))
+
+    def split(self, start, stop):
+        """Yields the (train, test) features and labels of each chunk for the
+        fold holding out the used rows from start to stop. As with the in
+        memory folds, the training rows of a chunk are the rows before and
+        after the held out ones put together.
+
+        Arguments:
+            start: The first held out row
+            stop: The last held out row (exclusive)
+        """
+        for first, X, y in self.chunks():
+            test = np.zeros(len(y), dtype=bool)
+            test[max(start - first, 0):max(stop - first, 0)] = True
+            yield (X[~test], y[~test]), (X[test], y[test])
+
+
+def _check_latent(spec):
+    """Raises a ValueError unless the model's latent stage can be trained out
+    of core, ie. it has none or is an HMM
+
+    Arguments:
+        spec: The cv_harness.ModelSpec of the model
+    """
+    if spec.latent is not None and \
+            not isinstance(spec.latent, HiddenSpaceStage):
+        raise ValueError('Only the HMM latent features can be trained out '
+                         'of core')
+
+
+def _kmeans(X, n_components, n_iter=10):
+    """Returns the centres of a few iterations of k-means on X, started from
+    evenly spaced rows so that it is repeatable
+
+    Arguments:
+        X: The inputs
+        n_components: The number of centres
+        n_iter: The number of iterations
+    """
+    centres = X[np.linspace(0, len(X) - 1, n_components).astype(int)]
+    for _ in range(n_iter):
+        nearest = np.argmin(((X[:, None] - centres[None]) ** 2).sum(axis=2),
+                            axis=1)
+        for k in range(n_components):
+            if (nearest == k).any():
+                centres[k] = X[nearest == k].mean(axis=0)
+    return centres
+
+
+def fit_hmm(chunks, n_components, n_iter=100, tol=0.1, reg=1e-6):
+    """Trains an HMM with a multivariate gaussian for each state by EM, where
+    each iteration sums the expected statistics of every chunk. It starts
+    from k-means on the first chunk and stops once the log likelihood improves
+    by less than tol, and returns the HMMParams.
+
+    Arguments:
+        chunks: A function returning an iterable of the inputs of each chunk,
+            with first column the series id, called once per iteration
+        n_components: The number of hidden states
+        n_iter: The most iterations to run
+        tol: The improvement in the log likelihood to stop at
+        reg: Added to the diagonal of the covariances so they stay invertible
+    """
+    first = next(X for X in chunks() if len(X))[:, 1:]
+    d = first.shape[1]
+    cov = np.atleast_2d(np.cov(first, rowvar=False)) + reg * np.eye(d)
+    params = HMMParams(np.full(n_components, -np.log(n_components)),
+                       np.full((n_components, n_components),
+                               -np.log(n_components)),
+                       _kmeans(first, n_components),
+                       np.repeat(cov[None], n_components, axis=0))
+
+    last = -np.inf
+    for _ in range(n_iter):
+        totals = None
+        for X in chunks():
+            if not len(X):
+                continue
+            stats = expected_statistics(params, X)
+            totals = stats if totals is None else \
+                {key: totals[key] + stats[key] for key in stats}
+
+        weights = np.maximum(totals['weights'], 1e-12)
+        means = totals['sums'] / weights[:, None]
+        covs = totals['outers'] / weights[:, None, None] - \
+            np.einsum('ki,kj->kij', means, means) + reg * np.eye(d)[None]
+        with np.errstate(divide='ignore'):
+            params = HMMParams(
+                np.log(totals['start'] / totals['start'].sum()),
+                np.log(totals['trans'] /
+                       np.maximum(totals['trans'].sum(axis=1,
+                                                      keepdims=True), 1e-12)),
+                means, covs)
+
+        if totals['loglik'] - last < tol:
+            break
+        last = totals['loglik']
+    return params
+
+
+def _fit_latent(spec, chunks, model):
+    """Trains the model's HMM on the given chunks, if it has one
+
+    Arguments:
+        spec: The cv_harness.ModelSpec of the model
+        chunks: A function returning an iterable of the features of each chunk
+        model: The TrainedModel, whose latent models are replaced
+    """
+    model.latent = []
+    if spec.latent is None:
+        return
+    base = TrainedModel(model.name, model.inputs, model.columns, None)
+    model.latent = [fit_hmm(
+        lambda: (np.column_stack((X[:, 0], base.transform(X)))
+                 for X in chunks()),
+        spec.latent.n_components)]
+
+
+def _classifier_stats(model, chunks, classes, shift):
+    """Sums the classifier's statistics over the chunks
+
+    Arguments:
+        model: The TrainedModel, with its latent models fit
+        chunks: An iterable of the (features, labels) of each chunk
+        classes: The labels of the classes
+        shift: The offset subtracted from the inputs
+    """
+    total = None
+    for X, y in chunks:
+        if not len(y):
+            continue
+        stats = GaussianStats.from_samples(model.transform(X), y, classes,
+                                           shift)
+        total = stats if total is None else total + stats
+    return total
+
+
+def _shift(model, data):
+    """The offset of the classifier's inputs, their mean with 0 for the
+    latent features
+
+    Arguments:
+        model: The TrainedModel
+        data: The ChunkedInputs
+    """
+    return np.concatenate((data.mean, np.zeros(len(model.latent))))
+
+
+def fit(features, name, chunk_rows=65536, **kwargs):
+    """Fits the named model on the whole FeatureFile a chunk at a time and
+    returns its TrainedModel, the same as model_io.fit_model
+
+    Arguments:
+        features: The FeatureFile
+        name: One of train_models._MODELS
+        chunk_rows: The number of rows to read at once
+        kwargs: The same as the train_* functions, eg. n_components
+    """
+    spec = get_model_spec(name, **kwargs)
+    _check_latent(spec)
+    model = TrainedModel(name, spec.inputs.__name__, [], None, (),
+                         features.schema)
+    data = ChunkedInputs(features, model, chunk_rows)
+
+    _fit_latent(spec, lambda: (X for _, X, _ in data.chunks()), model)
+    stats = _classifier_stats(model, ((X, y) for _, X, y in data.chunks()),
+                              data.classes, _shift(model, data))
+    model.classifier = GaussianBayesClassifier.from_stats(stats)
+    return model
+
+
+def cross_validate(features, name, n_splits=5, chunk_rows=65536,
+                   verbose=False, **kwargs):
+    """Runs the K-fold cross validation of the named model a chunk at a time
+    and returns the accuracy of each fold.
+
+    The non temporal models need two passes for all of the folds: one summing
+    the statistics of each fold's rows, from which every fold's classifier is
+    the total less its own, and one scoring them. These give the same
+    accuracies as the in memory harness. The temporal models train an HMM for
+    each fold by EM over the training rows, so take a pass per iteration.
+
+    Arguments:
+        features: The FeatureFile
+        name: One of train_models._MODELS
+        n_splits: The number of folds
+        chunk_rows: The number of rows to read at once
+        verbose: Whether to print the accuracy of each fold
+        kwargs: The same as the train_* functions, eg. n_components
+    """
+    spec = get_model_spec(name, **kwargs)
+    _check_latent(spec)
+    model = TrainedModel(name, spec.inputs.__name__, [], None, (),
+                         features.schema)
+    data = ChunkedInputs(features, model, chunk_rows)
+    bounds = data.fold_bounds(n_splits)
+    if verbose:
+        print('Training on {} samples'.format(data.n_rows))
+
+    def score(k, clf):
+        correct = 0
+        for _, (X, y) in data.split(*bounds[k]):
+            if len(y):
+                correct += np.sum(clf.predict(model.transform(X)) == y)
+        return correct / float(bounds[k][1] - bounds[k][0])
+
+    accuracies = []
+    if spec.latent is None:
+        shift = _shift(model, data)
+        blocks = [None] * n_splits
+        for first, X, y in data.chunks():
+            for k, (start, stop) in enumerate(bounds):
+                rows = slice(max(start - first, 0), max(stop - first, 0))
+                if len(y[rows]):
+                    stats = GaussianStats.from_samples(
+                        model.transform(X[rows]), y[rows], data.classes,
+                        shift)
+                    blocks[k] = stats if blocks[k] is None else \
+                        blocks[k] + stats
+        total = blocks[0]
+        for block in blocks[1:]:
+            total = total + block
+        classifiers = [GaussianBayesClassifier.from_stats(total - block)
+                       for block in blocks]
+    else:
+        classifiers = None
+
+    for k in range(n_splits):
+        if classifiers is not None:
+            clf = classifiers[k]
+        else:
+            _fit_latent(spec, lambda: (train[0] for train, _
+                                       in data.split(*bounds[k])), model)
+            clf = GaussianBayesClassifier.from_stats(_classifier_stats(
+                model, (train for train, _ in data.split(*bounds[k])),
+                data.classes, _shift(model, data)))
+        accuracies.append(score(k, clf))
+        if verbose:
+            print('Fold {} accuracy: {}'.format(k + 1, accuracies[-1]))
+    return accuracies
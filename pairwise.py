@@ -0,0 +1,131 @@
+# pairwise.py
+# Precomputes the probability that each team beats every other team going
+# into their next game, at home, away and at a neutral site, for tools which
+# need the same pairwise probabilities many times (eg. bracket analysis). The
+# matrix is saved as a .npy file so that it can be memory mapped
+
+import argparse
+import json
+
+import numpy as np
+
+from feature_gen import games_before
+from model_io import load_model
+from serve import MatchupPredictor, combine
+
+
+# the sites of the first axis of the matrix, relative to the row team
+SITES = ('home', 'away', 'neutral')
+
+
+def pairwise_probabilities(predictor):
+    """Returns a (3, teams, teams) array where [s, i, j] is the probability
+    that team i beats team j at site SITES[s] relative to team i, in the
+    order of predictor.teams. Every ordered pair at every site is scored in
+    one vectorized call, then each probability is averaged with the one from
+    the other team's point of view. The diagonal is nan.
+
+    Arguments:
+        predictor: The serve.MatchupPredictor
+    """
+    n = len(predictor.teams)
+    targets = np.tile(np.repeat(np.arange(n), n), len(SITES))
+    opps = np.tile(np.tile(np.arange(n), n), len(SITES))
+    sites = np.repeat(SITES, n * n)
+
+    # probs[s, i, j] is from the point of view of team i only
+    probs = predictor.score(targets, opps, sites).reshape(len(SITES), n, n)
+
+    # from team j's point of view, i at home is j away and vice versa
+    home, away, neutral = probs
+    matrix = np.stack((combine(home, away.T), combine(away, home.T),
+                       combine(neutral, neutral.T)))
+    matrix[:, np.arange(n), np.arange(n)] = np.nan
+    return matrix
+
+
+def save_matrix(path, matrix, teams, **meta):
+    """Saves the matrix as a .npy file and the teams of its rows (and any
+    other information) to path + '.json'
+
+    Arguments:
+        path: The file to save the matrix to
+        matrix: The result of pairwise_probabilities
+        teams: The id of the team of each row and column
+        meta: Anything else to save with the teams, eg. the year or date
+    """
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=matrix.dtype,
+                                    shape=matrix.shape)
+    out[:] = matrix
+    out.flush()
+    del out
+
+    meta.update({'teams': [int(tid) for tid in teams], 'sites': SITES})
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def load_matrix(path):
+    """Returns the matrix saved by save_matrix memory mapped (read only),
+    the index of each team id in it and the rest of its saved information
+
+    Arguments:
+        path: The saved .npy file
+    """
+    with open(path + '.json', 'r') as f:
+        meta = json.load(f)
+    index = {tid: i for i, tid in enumerate(meta['teams'])}
+    return np.load(path, mmap_mode='r'), index, meta
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Compute the probability that each team beats every '
+                    'other team at home, away and at a neutral site.')
+    parser.add_argument('model', type=str,
+                        help='The model saved by train_models.py --save')
+    parser.add_argument('data', type=str,
+                        help='The raw data from scrape.py.')
+    parser.add_argument('outfile', type=str,
+                        help='The .npy file to save the matrix to. The team '
+                             'of each row is saved to outfile.json')
+    parser.add_argument('--year', type=int, default=None,
+                        help='The season to use. Default is the latest.')
+    parser.add_argument('--date', type=str, default=None,
+                        help='Only use the games played before this date, '
+                             'as YYYY-MM-DD. Default is every game.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    try:
+        model = load_model(args.model)
+    except:
+        print('COULDN\'T LOAD', args.model)
+        exit(1)
+
+    try:
+        with open(args.data, 'r') as f:
+            data = json.load(f)
+    except:
+        print('COULDN\'T OPEN', args.data)
+        exit(1)
+
+    if args.date is not None:
+        data = games_before(data, args.date)
+
+    predictor = MatchupPredictor(model, data, args.year)
+    matrix = pairwise_probabilities(predictor)
+    save_matrix(args.outfile, matrix, predictor.teams, model=model.name,
+                year=predictor.year, date=args.date)
+    print('SAVED', matrix.shape, 'TO', args.outfile)
+
+
+if __name__ == '__main__':
+    main()
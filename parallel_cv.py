@@ -0,0 +1,254 @@
+# parallel_cv.py
+# Runs the folds of the K-fold cross validation done in train_models.py across
+# a pool of processes. The cleaned feature matrices are placed into shared
+# memory once, so that the workers can read them without having them pickled.
+# When profiling, each fold is profiled in its worker and what it recorded is
+# sent back with its result
+
+import concurrent.futures
+import multiprocessing
+
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import instrument
+
+
+# the shared memory blocks that this worker process has attached to, keyed by
+# their names so that each one is only attached once per worker
+_ATTACHED = {}
+
+
+class SharedArray():
+    """A numpy array which is copied into a block of shared memory once, so
+    that worker processes can attach to it by name rather than receive a copy.
+    """
+    def __init__(self, array):
+        """Copies the array into a new block of shared memory
+
+        Arguments:
+            array: The numpy array to share. Must not have an object dtype,
+                so the features must be cleaned before sharing.
+        """
+        array = np.ascontiguousarray(array)
+        if array.dtype == object:
+            raise ValueError('Can\'t share an object array, clean it first')
+
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=max(array.nbytes, 1))
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self.shm.buf)
+        self.array[...] = array
+
+    def descriptor(self):
+        """Returns what a worker needs to attach to the array, which is small
+        enough to be sent along with every task.
+        """
+        return (self.shm.name, self.shape, self.dtype)
+
+    def close(self):
+        """Releases and removes the shared memory block. The array can't be
+        used by any process after this is called.
+        """
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(descriptor):
+    """Gets the numpy array in shared memory that the descriptor refers to.
+    The block stays attached for the rest of the worker process' life.
+
+    Arguments:
+        descriptor: The result of SharedArray.descriptor
+    """
+    name, shape, dtype = descriptor
+    if name not in _ATTACHED:
+        try:
+            # newer versions of python allow not registering the block with
+            # the resource tracker, which otherwise removes it when the worker
+            # exits while the parent still needs it
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # older versions always register it, so registering is skipped
+            # while attaching. Unregistering after would instead drop the
+            # parent's registration, since the workers share its tracker
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args: None
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+        _ATTACHED[name] = shm
+    return np.ndarray(shape, dtype=dtype, buffer=_ATTACHED[name].buf)
+
+
+def _run_fold(fold_func, X_desc, y_desc, train_idx, test_idx, kwargs):
+    """Runs a single fold in the worker process on the shared arrays
+
+    Arguments:
+        fold_func: The function fitting and scoring the model on the fold
+        X_desc: The descriptor of the shared inputs
+        y_desc: The descriptor of the shared labels
+        train_idx: The rows to train on
+        test_idx: The rows to test on
+        kwargs: Any other arguments to fold_func
+    """
+    return fold_func(attach(X_desc), attach(y_desc), train_idx, test_idx,
+                     **kwargs)
+
+
+def fold_splits(X, y, n_splits=5, folds=None):
+    """Returns the (index, train rows, test rows) of the folds of the K-fold
+    cross validation
+
+    Arguments:
+        X: The cleaned inputs
+        y: The labels
+        n_splits: The number of folds
+        folds: The indices of the folds, in order. Default is every fold.
+    """
+    # imported here as sklearn takes over a second to import, which every
+    # command line tool importing this module would otherwise pay
+    from sklearn.model_selection import KFold
+    splits = list(KFold(n_splits=n_splits).split(X, y))
+    if folds is None:
+        folds = range(n_splits)
+    return [(k,) + splits[k] for k in folds]
+
+
+class ProfiledFold():
+    """The future of a fold run by instrument.run_profiled in a worker,
+    whose result is the fold's and whose profile is merged into this
+    process's once it finishes
+    """
+    def __init__(self, future):
+        """
+        Arguments:
+            future: The future of run_profiled
+        """
+        self._future = future
+        self._merged = False
+
+    def result(self):
+        result, records = self._future.result()
+        if not self._merged:
+            instrument.merge(records)
+            self._merged = True
+        return result
+
+
+class FoldResults():
+    """The pending results of the folds of a single model's cross validation.
+    """
+    def __init__(self, futures):
+        """
+        Arguments:
+            futures: The futures (or zero argument callables if not run in
+                parallel) giving the result of each fold, in fold order
+        """
+        self._futures = futures
+        self._results = None
+
+    def result(self):
+        """Waits for every fold to finish and returns their results in fold
+        order (or the order the folds were asked for), regardless of which
+        finished first.
+        """
+        if self._results is None:
+            self._results = [f.result() if hasattr(f, 'result') else f()
+                             for f in self._futures]
+        return self._results
+
+
+class ParallelCV():
+    """Executes the folds of any number of models' cross validations across a
+    single pool of processes. Each of the cleaned input matrices is placed into
+    shared memory once no matter how many folds or models use it.
+    """
+    def __init__(self, n_jobs=1):
+        """
+        Arguments:
+            n_jobs: The number of worker processes. If 1, then the folds are
+                run one after another in this process when their results are
+                asked for. If None or less than 1, uses every cpu.
+        """
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+        self._pool = None
+        if n_jobs > 1:
+            self._pool = concurrent.futures.ProcessPoolExecutor(n_jobs)
+        # the arrays shared so far, keyed by the id of the original array
+        self._shared = {}
+
+    def _share(self, array):
+        """Gets the descriptor of the array, sharing it if it hasn't been yet
+
+        Arguments:
+            array: The array to share.
+        """
+        if id(array) not in self._shared:
+            self._shared[id(array)] = (array, SharedArray(array))
+        return self._shared[id(array)][1].descriptor()
+
+    def submit(self, fold_func, X, y, n_splits=5, pass_fold=False, folds=None,
+               **kwargs):
+        """Schedules every fold of the K-fold cross validation of a model and
+        returns its FoldResults.
+
+        Arguments:
+            fold_func: A picklable function taking X, y, train_idx, test_idx
+                and kwargs, which fits the model and returns its score
+            X: The cleaned inputs
+            y: The labels
+            n_splits: The number of folds to use during KFold cross validation
+            pass_fold: Whether to also give fold_func the index of the fold
+                as the fold keyword argument.
+            folds: The indices of the folds to run, in the order their
+                results are returned. Default is every fold.
+            kwargs: Passed on to fold_func
+        """
+        splits = fold_splits(X, y, n_splits, folds)
+
+        def fold_kwargs(k):
+            if pass_fold:
+                return dict(kwargs, fold=k)
+            return kwargs
+
+        if self._pool is None:
+            return FoldResults([
+                (lambda tr=train_idx, te=test_idx, k=k:
+                    fold_func(X, y, tr, te, **fold_kwargs(k)))
+                for k, train_idx, test_idx in splits])
+
+        X_desc = self._share(X)
+        y_desc = self._share(y)
+        if instrument.enabled():
+            return FoldResults([ProfiledFold(self._pool.submit(
+                instrument.run_profiled, _run_fold, fold_func, X_desc,
+                y_desc, train_idx, test_idx, fold_kwargs(k)))
+                for k, train_idx, test_idx in splits])
+        return FoldResults([
+            self._pool.submit(_run_fold, fold_func, X_desc, y_desc,
+                              train_idx, test_idx, fold_kwargs(k))
+            for k, train_idx, test_idx in splits])
+
+    def close(self):
+        """Shuts down the pool and frees all the shared memory
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        for _, shared in self._shared.values():
+            shared.close()
+        self._shared = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
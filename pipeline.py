@@ -0,0 +1,504 @@
+# pipeline.py
+# Runs scrape.py, feature_gen.py and train_models.py end to end in a single
+# folder, keeping a manifest of what each file was made from: the hashes of
+# its inputs, its parameters and the hash of the code which made it. A stage
+# whose inputs, parameters and code are unchanged since its file was made is
+# skipped. The features are made a season at a time from that season's file,
+# so when a season is downloaded again only its features are regenerated (and
+# only if it actually changed), before everything made from all of them.
+# With --queue the seasons' features and the folds of the evaluations are run
+# on workqueue.py's workers
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import instrument
+import workqueue
+
+
+# the name of the manifest in the pipeline's folder
+MANIFEST = 'pipeline.json'
+
+# the source files whose code each stage runs, which decide its code version
+CODE = {
+    'features': ('feature_gen.py', 'scan_kernels.py', 'batched_hmm.py',
+                 'hmm_cache.py'),
+    'combine': ('pipeline.py',),
+    'merge': ('scrape.py',),
+    'train': ('train_models.py', 'model_io.py', 'cv_harness.py',
+              'gaussian_bayes.py', 'kalman.py', 'batched_hmm.py',
+              'hmm_cache.py', 'feature_gen.py'),
+    'evaluate': ('train_models.py', 'cv_harness.py', 'parallel_cv.py',
+                 'gaussian_bayes.py', 'kalman.py', 'batched_hmm.py',
+                 'hmm_cache.py', 'feature_gen.py'),
+}
+
+
+def file_hash(path):
+    """Returns the sha256 of a file's contents
+
+    Arguments:
+        path: The file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_version(stage):
+    """Returns the hash of the source of the code a stage runs
+
+    Arguments:
+        stage: One of CODE
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in CODE[stage]:
+        digest.update(name.encode())
+        digest.update(file_hash(os.path.join(here, name)).encode())
+    return digest.hexdigest()
+
+
+class Manifest():
+    """What each file of the pipeline was made from, saved as JSON in its
+    folder. Every file is recorded by its path relative to the folder with
+    the key of what made it and the hash of its contents.
+    """
+    def __init__(self, folder):
+        """
+        Arguments:
+            folder: The pipeline's folder
+        """
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST)
+        self.outputs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.outputs = json.load(f)
+
+    def save(self):
+        # written to the side first so that a run stopped part way through
+        # can't leave it half written
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.outputs, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+    def hash(self, output):
+        """Returns the hash of an output's contents, or None if it doesn't
+        exist or was changed since it was recorded
+
+        Arguments:
+            output: The path relative to the folder
+        """
+        path = os.path.join(self.folder, output)
+        if output not in self.outputs or not os.path.exists(path):
+            return None
+        digest = file_hash(path)
+        return digest if digest == self.outputs[output]['hash'] else None
+
+    def fresh(self, output, key):
+        """Whether the output exists, is unchanged and was made with the key
+
+        Arguments:
+            output: The path relative to the folder
+            key: The stage_key of what would make it now
+        """
+        return self.hash(output) is not None and \
+            self.outputs[output]['key'] == key
+
+    def record(self, output, key, **details):
+        """Records that the output was made with the key, and saves the
+        manifest
+
+        Arguments:
+            output: The path relative to the folder
+            key: The stage_key it was made with
+            details: Anything else to note, eg. the inputs and parameters
+        """
+        path = os.path.join(self.folder, output)
+        self.outputs[output] = dict(details, key=key, hash=file_hash(path))
+        self.save()
+
+
+def stage_key(stage, inputs, params):
+    """Returns the key of everything that decides a stage's output
+
+    Arguments:
+        stage: One of CODE, or None if the code doesn't matter
+        inputs: A dict of the hashes of the input files
+        params: A dict of the parameters, which must be JSON serializable
+    """
+    described = {'inputs': inputs, 'params': params,
+                 'code': code_version(stage) if stage is not None else None}
+    return hashlib.sha256(json.dumps(described, sort_keys=True)
+                          .encode()).hexdigest()
+
+
+def run_stage(manifest, stage, output, inputs, params, build, verbose=False):
+    """Makes an output unless it is up to date, and returns its hash
+
+    Arguments:
+        manifest: The Manifest
+        stage: One of CODE, or None if the code doesn't matter
+        output: The path relative to the folder
+        inputs: A dict of the hashes of the input files
+        params: A dict of the parameters
+        build: A function of the output's full path which makes it
+        verbose: Whether to print the stages which are up to date
+    """
+    key = stage_key(stage, inputs, params)
+    if manifest.fresh(output, key):
+        if verbose:
+            print('UP TO DATE:', output)
+        return manifest.outputs[output]['hash']
+
+    print('BUILDING:', output)
+    path = os.path.join(manifest.folder, output)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with instrument.span('pipeline.' + (stage or 'scrape'), output=output):
+        build(path)
+    manifest.record(output, key, stage=stage, inputs=inputs, params=params)
+    return manifest.outputs[output]['hash']
+
+
+def _write_json(path, value):
+    """Writes JSON to the side of a file first, so that a stage stopped part
+    way through leaves no output rather than half of one
+
+    Arguments:
+        path: The file
+        value: What to write
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(path + '.tmp', path)
+
+
+def scrape_season(manifest, year, refresh=False, base_url=None,
+                  verbose=False):
+    """Downloads a season unless it has been already, returning its hash. A
+    season's file which is already in the folder is kept (and recorded if it
+    wasn't yet), since it is what ESPN gave rather than something computed,
+    unless refreshing it.
+
+    Arguments:
+        manifest: The Manifest
+        year: The season
+        refresh: Whether to download it again, eg. if it is still being played
+        base_url: See scrape.set_base_url
+        verbose: Whether to print the stages which are up to date
+    """
+    output = '{}.json'.format(year)
+    path = os.path.join(manifest.folder, output)
+    if not refresh and os.path.exists(path):
+        if output not in manifest.outputs or \
+                manifest.hash(output) is None:
+            # eg. downloaded by scrape.py, or edited by hand
+            manifest.record(output, stage_key(None, {}, {'year': year}),
+                            stage=None, inputs={}, params={'year': year})
+        elif verbose:
+            print('UP TO DATE:', output)
+        return manifest.outputs[output]['hash']
+
+    def build(path):
+        import scrape
+        scrape.set_base_url(base_url)
+        _write_json(path, scrape.get_data(verbose=verbose, years=[year]))
+
+    # the key includes an unused counter of the downloads, so a refreshed
+    # season is always downloaded again
+    downloads = manifest.outputs.get(output, {}).get('params', {}) \
+        .get('downloads', 0) + 1
+    return run_stage(manifest, None, output, {},
+                     {'year': year, 'downloads': downloads}, build, verbose)
+
+
+def _season_features(data, exclude_features):
+    """Generates the features of one season's raw data, as they are saved,
+    eg. on a worker
+
+    Arguments:
+        data: The season's raw data
+        exclude_features: The features to exclude
+    """
+    from feature_gen import generate_features
+    X, y, schema = generate_features(
+        data, exclude_features=list(exclude_features), with_schema=True)
+    return X.tolist(), y.tolist(), schema
+
+
+def _load_season(manifest, year):
+    """Returns the raw data of a season in the folder
+
+    Arguments:
+        manifest: The Manifest
+        year: The season
+    """
+    with open(os.path.join(manifest.folder, '{}.json'.format(year))) as f:
+        return json.load(f)
+
+
+def _features_output(manifest, year, season_hash, exclude_features):
+    """Returns the path of a season's features and the key they are made
+    with, and whether they are up to date
+
+    Arguments:
+        manifest: The Manifest
+        year: The season
+        season_hash: The hash of the season's file
+        exclude_features: The features to exclude
+    """
+    output = os.path.join('features', '{}.json'.format(year))
+    inputs = {'season': season_hash}
+    params = {'exclude_features': sorted(exclude_features)}
+    fresh = manifest.fresh(output, stage_key('features', inputs, params))
+    return output, inputs, params, fresh
+
+
+def season_features(manifest, year, season_hash, exclude_features=(),
+                    verbose=False, pending=None):
+    """Generates the features of one season from its file unless they are up
+    to date, returning their hash
+
+    Arguments:
+        manifest: The Manifest
+        year: The season
+        season_hash: The hash of the season's file
+        exclude_features: The features to exclude
+        verbose: Whether to print the stages which are up to date
+        pending: A future of _season_features already submitted to the
+            workers, whose result is written instead of generating them here
+    """
+    def build(path):
+        if pending is not None:
+            _write_json(path, pending.result())
+        else:
+            _write_json(path, _season_features(_load_season(manifest, year),
+                                               exclude_features))
+
+    output, inputs, params, _ = _features_output(manifest, year, season_hash,
+                                                 exclude_features)
+    return run_stage(manifest, 'features', output, inputs, params, build,
+                     verbose)
+
+
+def combine_features(seasons):
+    """Joins the features of several seasons into one dataset as
+    feature_gen.py would make it, numbering the series of each season after
+    those of the seasons before. Returns X, y and the schema.
+
+    Arguments:
+        seasons: A list of the (X, y, schema) of each season, in order
+    """
+    Xs, ys, series = [], [], []
+    for X, y, schema in seasons:
+        # a season without games has no rows, or even columns once loaded
+        if len(X):
+            X = np.array(X, dtype=None)
+            X[:, 0] = X[:, 0] + len(series)
+            Xs.append(X)
+            ys.append(np.array(y, dtype=None))
+        series.extend(schema['series'])
+    return np.vstack(Xs), np.vstack(ys), dict(seasons[0][2], series=series)
+
+
+def run(folder, years, refresh=(), base_url=None, exclude_features=(),
+        models=(), latent='hmm', evaluate=False, n_jobs=1, verbose=False,
+        queue=None):
+    """Brings every stage of the pipeline up to date, downloading the seasons
+    missing from the folder
+
+    Arguments:
+        folder: The pipeline's folder
+        years: The seasons
+        refresh: The seasons to download again
+        base_url: See scrape.set_base_url
+        exclude_features: The features to exclude
+        models: The names of the models to fit and save
+        latent: The latent features of the temporal models
+        evaluate: Whether to also cross validate each model
+        n_jobs: The number of processes to cross validate on
+        verbose: Whether to print the stages which are up to date
+        queue: A workqueue.Coordinator to generate the features of the
+            seasons and cross validate on instead of this process
+    """
+    manifest = Manifest(folder)
+
+    seasons = {}
+    for year in years:
+        seasons[year] = scrape_season(manifest, year, year in refresh,
+                                      base_url, verbose)
+
+    # every season out of date is sent to the workers at once, then written
+    # as each finishes
+    pending = {}
+    if queue is not None:
+        for year in years:
+            if not _features_output(manifest, year, seasons[year],
+                                    exclude_features)[3]:
+                pending[year] = queue.submit(_season_features,
+                                             _load_season(manifest, year),
+                                             list(exclude_features))
+
+    features = {}
+    for year in years:
+        features[year] = season_features(manifest, year, seasons[year],
+                                         exclude_features, verbose,
+                                         pending.get(year, None))
+
+    # the raw data of every season, as scrape.py merges it, eg. for serve.py
+    def merge(path):
+        import scrape
+        _write_json(path, scrape.merge_seasons(folder, years))
+    run_stage(manifest, 'merge', 'all.json',
+              {str(year): seasons[year] for year in years}, {}, merge,
+              verbose)
+
+    def combine(path):
+        parts = []
+        for year in years:
+            with open(os.path.join(folder, 'features',
+                                   '{}.json'.format(year))) as f:
+                parts.append(json.load(f))
+        X, y, schema = combine_features(parts)
+        _write_json(path, (X.tolist(), y.tolist(), schema))
+    combined = run_stage(manifest, 'combine', 'features.json',
+                         {str(year): features[year] for year in years}, {},
+                         combine, verbose)
+
+    for name in models:
+        # the HMMs are warm started from the folder's cache, so which one is
+        # part of what makes the models
+        params = {'model': name, 'latent': latent, 'hmm_cache': 'hmm'}
+
+        def train(path, name=name):
+            import model_io
+            from train_models import load_data
+            X, y, schema = load_data(os.path.join(folder, 'features.json'))
+            model = model_io.fit_model(name, X, y, schema=schema,
+                                       latent=latent,
+                                       hmm_cache=os.path.join(
+                                           folder, params['hmm_cache']))
+            model.save(path)
+        run_stage(manifest, 'train',
+                  os.path.join('models', name + '.npz'),
+                  {'features': combined}, params, train, verbose)
+
+        if not evaluate:
+            continue
+
+        def cross_validate(path, name=name):
+            import cv_harness
+            from parallel_cv import ParallelCV
+            from train_models import get_model_spec, load_data
+            X, y, _ = load_data(os.path.join(folder, 'features.json'))
+            spec = get_model_spec(name, latent=latent,
+                                  hmm_cache=os.path.join(
+                                      folder, params['hmm_cache']))
+            executor = ParallelCV(n_jobs) if queue is None else \
+                workqueue.QueueCV(queue, own=False)
+            with executor:
+                results = cv_harness.schedule(X, y, [spec], executor)
+                accuracies = [float(a) for a in results[0].result()]
+            _write_json(path, {'model': name, 'accuracies': accuracies,
+                               'mean': float(np.mean(accuracies))})
+            print('Cumulative accuracy of {} after {} folds: {}'.format(
+                name, len(accuracies), np.mean(accuracies)))
+        run_stage(manifest, 'evaluate',
+                  os.path.join('evaluations', name + '.json'),
+                  {'features': combined}, params, cross_validate, verbose)
+
+    return manifest
+
+
+def _years(text):
+    """Parses seasons given as eg. 2006-2018 or 2016,2018 into a list
+
+    Arguments:
+        text: The seasons
+    """
+    years = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            years.extend(range(int(first), int(last) + 1))
+        elif part:
+            years.append(int(part))
+    return years
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Run scrape.py, feature_gen.py and train_models.py in a '
+                    'folder, only rerunning the stages whose inputs, '
+                    'parameters or code changed.')
+    parser.add_argument('folder', type=str,
+                        help='The folder of the pipeline, which may already '
+                             'have seasons downloaded by scrape.py.')
+    parser.add_argument('--years', type=str, default='2006-2018',
+                        help='The seasons, eg. 2006-2018 or 2016,2018.')
+    parser.add_argument('--refresh', type=str, default='',
+                        help='The seasons to download again, eg. one still '
+                             'being played.')
+    parser.add_argument('--base-url', type=str, default=None,
+                        help='Download from this server instead of ESPN, eg. '
+                             'espn_standin.py.')
+    parser.add_argument('--exclude', type=str, default='',
+                        help='The features to exclude, separated by commas.')
+    parser.add_argument('--models', type=str, default='',
+                        help='The models to fit and save, separated by '
+                             'commas.')
+    parser.add_argument('--latent', choices=('hmm', 'kalman', 'both'),
+                        default='hmm',
+                        help='The latent features of the temporal models.')
+    parser.add_argument('--evaluate', action='store_true',
+                        help='Also cross validate each model.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes to cross validate on.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Also print the stages which are up to date.')
+    workqueue.add_arguments(parser)
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+    instrument.start(args, 'pipeline')
+
+    if not os.path.isdir(args.folder):
+        print('INVALID FOLDER')
+        exit(1)
+
+    from train_models import _MODELS
+    models = [name for name in args.models.split(',') if name]
+    if any(name not in _MODELS for name in models):
+        print('INVALID MODEL')
+        exit(1)
+
+    queue = None
+    if args.queue is not None:
+        queue = workqueue.start_coordinator(args)
+    try:
+        run(args.folder, _years(args.years), _years(args.refresh),
+            args.base_url, [name for name in args.exclude.split(',') if name],
+            models, args.latent, args.evaluate, args.jobs, args.verbose,
+            queue)
+    finally:
+        if queue is not None:
+            queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# predict.py
+# Scores matchups with a model saved by train_models.py --save. Every row is
+# scored in a single vectorized pass, so thousands of matchups take about as
+# long as one
+
+import argparse
+import json
+
+from model_io import load_model
+from train_models import load_data
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Predict the probability that the target team wins each '
+                    'matchup using a saved model.')
+    parser.add_argument('model', type=str,
+                        help='The model saved by train_models.py --save')
+    parser.add_argument('matchups', type=str,
+                        help='The matchups to score, in the same format as '
+                             'the features from feature_gen.py (the labels '
+                             'are ignored).')
+    parser.add_argument('-o', '--outfile', type=str, default=None,
+                        help='The file to write the probabilities to as a '
+                             'JSON list, with null for matchups missing '
+                             'features the model needs. If not given they '
+                             'are printed.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    try:
+        model = load_model(args.model)
+    except:
+        print('COULDN\'T LOAD', args.model)
+        exit(1)
+
+    try:
+        X, _, schema = load_data(args.matchups)
+    except:
+        print('COULDN\'T OPEN', args.matchups)
+        exit(1)
+
+    # rows missing a feature the model uses can't be scored
+    probs = [None if p != p else float(p)
+             for p in model.predict_proba(X, schema)]
+
+    if args.outfile is None:
+        for p in probs:
+            print(p)
+    else:
+        with open(args.outfile, 'w') as f:
+            json.dump(probs, f)
+
+
+if __name__ == '__main__':
+    main()
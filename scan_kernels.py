@@ -0,0 +1,148 @@
+# scan_kernels.py
+# Kernels for the features of feature_gen.py which are sequential scans over
+# a team's season, the streak and the win percentage against ranked teams.
+# Each runs over every team's season at once, given flat arrays of the games
+# of all of them and the number of games in each, and gives exactly what its
+# generator in FeatureGenerators yields. They are compiled with numba if it
+# is installed, and otherwise run as plain python over lists, which still
+# saves building and stepping a generator per season
+
+import numpy as np
+
+
+def _streak_scan(won, lengths, out):
+    """The streak going into each game, as _streakFeature
+
+    Arguments:
+        won: Whether the team won each game, as _teamWon
+        lengths: The number of games in each season
+        out: Where to write the streaks, as long as won
+    """
+    k = 0
+    for n in lengths:
+        streak = 0
+        for i in range(k, k + n):
+            out[i] = streak
+            win = won[i]
+            if win and streak > 0:
+                streak += 1
+            elif not win and streak < 0:
+                streak -= 1
+            elif not win and streak > 0:
+                streak = -1
+            else:
+                streak = 1
+        k += n
+
+
+def _ranked_scan(won, ranked, lengths, out, known):
+    """The win percentage against ranked teams going into each game, as
+    _winPctRankedFeature
+
+    Arguments:
+        won: Whether the team won each game, as _teamWon
+        ranked: Whether the opposition of each game was ranked
+        lengths: The number of games in each season
+        out: Where to write the percentages, as long as won
+        known: Where to write whether any ranked team had been played yet,
+            since the generator gives the integer 0 until one has
+    """
+    k = 0
+    for n in lengths:
+        wins = 0
+        games = 0.
+        for i in range(k, k + n):
+            out[i] = wins / games if games > 0 else 0.
+            known[i] = games > 0
+            if ranked[i]:
+                games += 1.
+                if won[i]:
+                    wins += 1
+        k += n
+
+
+# the kernels once compiled has been called, or False if numba isn't
+# installed
+_COMPILED = None
+
+
+def compiled():
+    """Returns the kernels compiled by numba as a dict by name, or None if
+    numba isn't installed. numba is only imported (and the kernels compiled)
+    the first time, as it takes a while.
+    """
+    global _COMPILED
+    if _COMPILED is None:
+        try:
+            import numba
+            _COMPILED = {'streak': numba.njit(cache=True)(_streak_scan),
+                         'ranked': numba.njit(cache=True)(_ranked_scan)}
+        except ImportError:
+            _COMPILED = False
+    return _COMPILED or None
+
+
+def team_won(home_ids, tids, home_scores, away_scores):
+    """Whether the target team won each game, exactly as feature_gen._teamWon
+    decides it (which compares the home team's id to the target's id xor
+    whether the home team won)
+
+    Arguments:
+        home_ids: The home team's id of each game
+        tids: The target team's id of each game
+        home_scores: The home team's score of each game
+        away_scores: The away team's score of each game
+    """
+    home_win = np.asarray(home_scores) > np.asarray(away_scores)
+    return np.asarray(home_ids, dtype=np.int64) != \
+        (np.asarray(tids, dtype=np.int64) ^ home_win)
+
+
+def streaks(won, lengths, use_numba=True):
+    """Returns the streak going into every game as a list of ints, the same as
+    _streakFeature yields for each season one after another
+
+    Arguments:
+        won: Whether the team won each game, flattened over the seasons
+        lengths: The number of games in each season
+        use_numba: Whether to use the compiled kernel if there is one
+    """
+    kernels = compiled() if use_numba else None
+    if kernels is None:
+        out = [0] * len(won)
+        _streak_scan(np.asarray(won, dtype=bool).tolist(),
+                     np.asarray(lengths, dtype=int).tolist(), out)
+        return out
+    out = np.zeros(len(won), dtype=np.int64)
+    kernels['streak'](np.asarray(won, dtype=bool),
+                      np.asarray(lengths, dtype=np.int64), out)
+    return out.tolist()
+
+
+def ranked_win_pcts(won, ranked, lengths, use_numba=True):
+    """Returns the win percentage against ranked teams going into every game
+    as a list, the same as _winPctRankedFeature yields for each season one
+    after another: a float once a ranked team has been played, before which
+    the int 0
+
+    Arguments:
+        won: Whether the team won each game, flattened over the seasons
+        ranked: Whether the opposition of each game was ranked
+        lengths: The number of games in each season
+        use_numba: Whether to use the compiled kernel if there is one
+    """
+    kernels = compiled() if use_numba else None
+    if kernels is None:
+        out = [0.] * len(won)
+        known = [False] * len(won)
+        _ranked_scan(np.asarray(won, dtype=bool).tolist(),
+                     np.asarray(ranked, dtype=bool).tolist(),
+                     np.asarray(lengths, dtype=int).tolist(), out, known)
+    else:
+        out = np.zeros(len(won))
+        known = np.zeros(len(won), dtype=bool)
+        kernels['ranked'](np.asarray(won, dtype=bool),
+                          np.asarray(ranked, dtype=bool),
+                          np.asarray(lengths, dtype=np.int64), out, known)
+        out, known = out.tolist(), known.tolist()
+    return [value if k else 0 for value, k in zip(out, known)]
@@ -7,6 +7,45 @@ import argparse
 import json
 import requests
 import os.path
+import time
+
+import instrument
+
+
+# the hosts of ESPN's APIs, which set_base_url can point at a stand in such as
+# espn_standin.py instead
+_HOSTS = {'site': 'https://site.web.api.espn.com',
+          'cdn': 'http://cdn.espn.com'}
+
+
+def set_base_url(url):
+    """Sends every request to the given server instead of ESPN, eg. to a
+    stand in from espn_standin.py. None goes back to ESPN.
+
+    Arguments:
+        url: The scheme, host and port of the server, eg.
+            http://127.0.0.1:8001
+    """
+    _HOSTS['site'] = 'https://site.web.api.espn.com' if url is None \
+        else url.rstrip('/')
+    _HOSTS['cdn'] = 'http://cdn.espn.com' if url is None \
+        else url.rstrip('/')
+
+
+def _get(host, path):
+    """Makes a GET request, timing it for the profile
+
+    Arguments:
+        host: Which of ESPN's APIs, either 'site' or 'cdn'
+        path: The path and query of the request
+    """
+    url = _HOSTS[host] + path
+    start = time.perf_counter()
+    try:
+        with instrument.span('scrape.http', cat='http', url=url):
+            return requests.get(url)
+    finally:
+        instrument.observe('scrape.http', (time.perf_counter() - start) * 1e3)
 
 
 def get_teams():
@@ -15,7 +54,7 @@ def get_teams():
     """
     try:
         # the ESPN link to get all the conferences from
-        data = requests.get('https://site.web.api.espn.com/apis/site/v2/'
+        data = _get('site', '/apis/site/v2/'
                             'sports/basketball/mens-college-basketball/'
                             'scoreboard/conferences?groups=50').json()
         # specifically pull the each conferences' ids
@@ -24,7 +63,7 @@ def get_teams():
         teams = {}
         for conf_id in conf_ids:
             # the ESPN link to get the information for a conference from
-            data = requests.get('https://site.web.api.espn.com/apis/site/v2/'
+            data = _get('site', '/apis/site/v2/'
                                 'sports/basketball/mens-college-basketball/'
                                 'teams?groups={}'.format(conf_id)).json()
 
@@ -35,6 +74,7 @@ def get_teams():
 
         return teams
     except:
+        instrument.swallowed('scrape.get_teams')
         print('COULDN\'T GET TEAMS. ABORTING.')
         exit(1)
 
@@ -52,17 +92,19 @@ def get_team_season_gids(tid, season):
     # the ESPN link that contains all the season schedule information for team
     data = None
     try:
-        data = requests.get('https://site.web.api.espn.com/apis/site/v2/'
+        data = _get('site', '/apis/site/v2/'
                             'sports/basketball/mens-college-basketball/'
                             'teams/{}/schedule?lang=en&seasontype=2&'
                             'season={}'.format(tid, season))
     except:
+        instrument.swallowed('scrape.get_team_season_gids')
         print('NO TEAM DATA:', tid, season)
         return []
 
     try:
         data = data.json()
     except:
+        instrument.swallowed('scrape.get_team_season_gids')
         print('JSON PROCESSING ERROR TEAM:', tid, season)
         return []
 
@@ -89,17 +131,19 @@ def get_team_post_gids(tid, season):
     # the ESPN link that contains all the postseason schedule results for team
     data = None
     try:
-        data = requests.get('https://site.web.api.espn.com/apis/site/v2/'
+        data = _get('site', '/apis/site/v2/'
                             'sports/basketball/mens-college-basketball/'
                             'teams/{}/schedule?lang=en&seasontype=3&'
                             'season={}'.format(tid, season)).json()
     except:
+        instrument.swallowed('scrape.get_team_post_gids')
         print('NO POST TEAM DATA:', tid, season)
         return[]
 
     try:
         data = data.json()
     except:
+        instrument.swallowed('scrape.get_team_post_gids')
         print('JSON PROCESSING ERROR POST TEAM:', tid, season)
         return []
 
@@ -121,28 +165,51 @@ def get_game(gid, **kwargs):
         kwargs: Mostly just for debugging verbosity
 
             verbose: If positive then prints output on error, otherwise silence
+            raw: A file to also append the whole boxscore JSON to, as a line
+                of [gid, boxscore], for extract.py
     """
-
-    def printverbose(*args):
-        if kwargs.get('verbose', 0):
-            print(*args)
-
     # the ESPN link that contains all the game boxscores
     data = None
 
     try:
-        data = requests.get('http://cdn.espn.com/core/mens-college-basketball/'
-                            'boxscore?xhr=1&gameId={}'.format(gid))
+        data = _get('cdn', '/core/mens-college-basketball/'
+                           'boxscore?xhr=1&gameId={}'.format(gid))
     except:
+        instrument.swallowed('scrape.get_game')
         print('COULDN\'T CONNECT TO ESPN:', gid)
         return None
 
     try:
         data = data.json()
     except:
+        instrument.swallowed('scrape.get_game')
         print('JSON PROCESSING ERROR:', gid)
         return None
 
+    # keep everything ESPN gave, eg. the players' stat lines, so that it can
+    # be extracted later without downloading it again
+    if kwargs.get('raw') is not None:
+        kwargs['raw'].write(json.dumps([gid, data]) + '\n')
+
+    return parse_game(data, gid, **kwargs)
+
+
+def parse_game(data, gid, **kwargs):
+    """Gets the statistics of a game from ESPN's boxscore JSON, as get_game
+    does once it has downloaded it. Returns None if the boxscore has no game.
+
+    Arguments:
+        data: The decoded boxscore JSON
+        gid: The game id that ESPN uses to refer to the game
+        kwargs: Mostly just for debugging verbosity
+
+            verbose: If positive then prints output on error, otherwise silence
+    """
+
+    def printverbose(*args):
+        if kwargs.get('verbose', 0):
+            print(*args)
+
     if '__gamepackage__' not in data:
         return None  # didn't successfully pull the game data
 
@@ -156,6 +223,7 @@ def get_game(gid, **kwargs):
     try:
         stats['score'] = (int(homeTeam['score']), int(awayTeam['score']))
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on score: ', gid)
         return None
 
@@ -175,6 +243,7 @@ def get_game(gid, **kwargs):
         try:
             stats['home' + labels[k]] = val
         except:
+            instrument.swallowed('scrape.parse_game')
             printverbose('ERROR on home', labels[k], ':', gid)
             stats['home' + labels[k]] = -1
 
@@ -183,6 +252,7 @@ def get_game(gid, **kwargs):
         try:
             stats['away' + labels[k]] = val
         except:
+            instrument.swallowed('scrape.parse_game')
             printverbose('ERROR on away', labels[k], ':', gid)
             stats['away' + labels[k]] = -1
 
@@ -191,21 +261,25 @@ def get_game(gid, **kwargs):
     try:
         stats['homeId'] = int(homeTeam['id'])
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on home id: ', gid)
         return None
     try:
         stats['homeRecord'] = homeTeam['record'][0]['summary']
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on home record: ', gid)
         stats['homeRecord'] = '0-0'  # default if none is known
     try:
         stats['homeRank'] = int(homeTeam['rank']) if 'rank' in homeTeam else -1
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on home rank: ', gid)
         stats['homeRank'] = -1
     try:
         stats['homeHalfScores'] = homeTeam['linescores'][0]['displayValue']
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on home half scores: ', gid)
         stats['homeHalfScores'] = '0-0'  # default if none is known TODO
 
@@ -213,21 +287,25 @@ def get_game(gid, **kwargs):
     try:
         stats['awayId'] = int(awayTeam['id'])
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on away id: ', gid)
         return None
     try:
         stats['awayRecord'] = awayTeam['record'][0]['summary']
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on away record: ', gid)
         stats['awayRecord'] = '0-0'  # default if none is known
     try:
         stats['awayRank'] = int(awayTeam['rank']) if 'rank' in awayTeam else -1
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on away rank: ', gid)
         stats['awayRank'] = -1
     try:
         stats['awayHalfScores'] = awayTeam['linescores'][0]['displayValue']
     except:
+        instrument.swallowed('scrape.parse_game')
         printverbose('ERROR on away half scores: ', gid)
         stats['awayHalfScores'] = '0-0'  # default if none is known TODO
 
@@ -245,6 +323,7 @@ def get_data(**kwargs):
             or specific team ids to consider
 
             verbose: If positive then prints output otherwise silence
+            raw: A file to also append every game's whole boxscore to
             years: a list of years to consider, if none provided does 2006-2018
             teams: a dict of team ids and names to consider.
                 if none provided, does all.
@@ -267,7 +346,8 @@ def get_data(**kwargs):
 
         for tid in teams:
             # get all the games that this team played this season
-            gids = get_team_season_gids(tid, year)
+            with instrument.span('scrape.schedule'):
+                gids = get_team_season_gids(tid, year)
             data['teams'][tid][year]['reg'] = gids
 
             # add it to the data if it hasn't been already
@@ -275,10 +355,13 @@ def get_data(**kwargs):
                 if gid not in data:
                     # get the new game and add it if it has valid data,
                     # otherwise remove it
-                    game = get_game(gid, **kwargs)
+                    with instrument.span('scrape.game'):
+                        game = get_game(gid, **kwargs)
                     if game is not None:
+                        instrument.count('scrape.games')
                         data[gid] = game
                     else:
+                        instrument.count('scrape.games_failed')
                         data['teams'][tid][year]['reg'].remove(gid)
 
             continue  # TODO currently don't care about postseason
@@ -300,6 +383,37 @@ def get_data(**kwargs):
     return data
 
 
+def merge_seasons(folder, years=range(2006, 2019)):
+    """Merges the seasons saved by main, one file per year, into a single
+    data dictionary like get_data's for all of them
+
+    Arguments:
+        folder: The folder of the seasons' files
+        years: The seasons to merge
+    """
+    cum_data = {'years': list(years), 'teams': {}}
+    for year in years:
+        year_data = {}
+        with open(os.path.join(folder, str(year) + '.json'), 'r') as f:
+            year_data = json.load(f)
+        # update the catalog of game ids for each team, season
+        for tid, seasons in year_data['teams'].items():
+            if tid not in cum_data['teams']:
+                cum_data['teams'][tid] = seasons
+            else:
+                for year, games in seasons.items():
+                    if year not in cum_data['teams'][tid]:
+                        cum_data['teams'][tid][year] = games
+        # now add the game information, note that even though 'teams' and
+        # 'years' aren't game ids, they are already in cum_data so no
+        # overwrites will happen
+        for gid in year_data:
+            if gid not in cum_data:
+                cum_data[gid] = year_data[gid]
+        print('MERGED: ', year)
+    return cum_data
+
+
 def parse_args():
     """Get the arguments required for calling from the command line rather
     than from another python script.
@@ -313,6 +427,15 @@ def parse_args():
                              'One per year.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Whether to output the current process')
+    parser.add_argument('--base-url', type=str, default=None,
+                        help='Request everything from this server instead of '
+                             'ESPN, eg. espn_standin.py at '
+                             'http://127.0.0.1:8001')
+    parser.add_argument('--raw', type=str, default=None,
+                        help='Also append the whole boxscore JSON of every '
+                             'game downloaded to this file, one line each, '
+                             'for extract.py')
+    instrument.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -322,42 +445,40 @@ def main():
     """
     args = parse_args()
 
+    instrument.start(args, 'scrape')
+    set_base_url(args.base_url)
+
     if not os.path.exists(args.folder):
         print('INVALID FOLDER')
         exit(1)
 
+    raw = None
+    if args.raw is not None:
+        try:
+            raw = open(args.raw, 'a')
+        except:
+            print('COULDN\'T OPEN', args.raw)
+            exit(1)
+
     # save each year individually
     for year in range(2006, 2019):
         # don't download if we already have it
         if os.path.exists(os.path.join(args.folder, str(year) + '.json')):
             continue
         with open(os.path.join(args.folder, str(year) + '.json'), 'w') as f:
-            json.dump(get_data(verbose=args.verbose, years=[year]), f)
+            json.dump(get_data(verbose=args.verbose, years=[year], raw=raw),
+                      f)
+        if raw is not None:
+            raw.flush()
         print('DOWNLOADED: ', year)
 
+    if raw is not None:
+        raw.close()
+
     print('DONE DOWNLOADING, NOW MERGING RESULTS')
 
     # once done, merge all the results
-    cum_data = {'years': [i for i in range(2006, 2019)], 'teams': {}}
-    for year in range(2006, 2019):
-        year_data = {}
-        with open(os.path.join(args.folder, str(year) + '.json'), 'r') as f:
-            year_data = json.load(f)
-        # update the catalog of game ids for each team, season
-        for tid, seasons in year_data['teams'].items():
-            if tid not in cum_data['teams']:
-                cum_data['teams'][tid] = seasons
-            else:
-                for year, games in seasons.items():
-                    if year not in cum_data['teams'][tid]:
-                        cum_data['teams'][tid][year] = games
-        # now add the game information, note that even though 'teams' and
-        # 'years' aren't game ids, they are already in cum_data so no
-        # overwrites will happen
-        for gid in year_data:
-            if gid not in cum_data:
-                cum_data[gid] = year_data[gid]
-        print('MERGED: ', year)
+    cum_data = merge_seasons(args.folder)
 
     with open(os.path.join(args.folder, 'all.json'), 'w') as f:
         json.dump(cum_data, f)
@@ -0,0 +1,265 @@
+# search.py
+# Searches over the models of train_models.py, their hyperparameters and
+# subsets of the features with successive halving: every configuration is
+# first cross validated on a few folds, only the best fraction go on to be
+# scored on more folds, and so on until the survivors are scored on all of
+# them. The features are loaded and cleaned once and every trial shares the
+# same pool of processes
+
+import argparse
+import itertools
+import math
+
+import numpy as np
+
+import cv_harness
+import workqueue
+
+from feature_gen import feature_names
+from train_models import _MODEL_STAGES, get_model_spec, load_data
+
+
+class Trial():
+    """A single configuration of the search and the accuracies of the folds
+    it has been scored on so far
+    """
+    def __init__(self, model, n_splits, exclude=(), **kwargs):
+        """
+        Arguments:
+            model: One of train_models._MODELS
+            n_splits: The number of folds of its cross validation
+            exclude: The features to leave out
+            kwargs: The model's other options, as for the train_* functions
+        """
+        self.model = model
+        self.n_splits = n_splits
+        self.exclude = tuple(sorted(exclude))
+        self.kwargs = kwargs
+        self.scores = []
+        self.rung = 0
+
+    def key(self):
+        """Identifies the configuration, ignoring options its model doesn't use
+        """
+        return (self.model, self.n_splits, self.exclude,
+                tuple(sorted(self.kwargs.items())))
+
+    def accuracy(self):
+        return np.mean(self.scores) if self.scores else np.nan
+
+    def row(self):
+        """The configuration and its results for the results table
+        """
+        return [self.model, self.kwargs.get('latent', ''),
+                self.kwargs.get('n_components', ''),
+                self.kwargs.get('n_dims', ''), self.n_splits,
+                '+'.join(self.exclude), len(self.scores), self.rung,
+                '{:.4f}'.format(self.accuracy()),
+                '{:.4f}'.format(np.std(self.scores))]
+
+
+# the columns of the results table
+COLUMNS = ('model', 'latent', 'n_components', 'n_dims', 'n_splits',
+           'exclude', 'folds', 'rung', 'accuracy', 'std')
+
+
+def make_trials(models, n_splits, excludes, latents, n_components, n_dims):
+    """Returns every distinct configuration of the options. The non temporal
+    models ignore the latent options, so only get one trial per split and
+    feature subset, and only the HMM uses n_components and the Kalman filter
+    n_dims.
+
+    Arguments:
+        models: The names of the models
+        n_splits: The numbers of folds
+        excludes: The sets of features to leave out
+        latents: The latent forms of the temporal models, eg. hmm
+        n_components: The numbers of hidden states of the HMMs
+        n_dims: The dimensions of the Kalman filters' latent states
+    """
+    trials = {}
+    for model, k, exclude in itertools.product(models, n_splits, excludes):
+        options = [{}]
+        if _MODEL_STAGES[model][1]:
+            options = [dict([('latent', latent)] +
+                            [('n_components', n)] * (latent != 'kalman') +
+                            [('n_dims', m)] * (latent != 'hmm'))
+                       for latent in latents for n in n_components
+                       for m in n_dims]
+        for kwargs in options:
+            trial = Trial(model, k, exclude, **kwargs)
+            trials.setdefault(trial.key(), trial)
+    return list(trials.values())
+
+
+def select_features(X, names, exclude):
+    """Returns X without the columns of the excluded features, for both the
+    target team and the opposition
+
+    Arguments:
+        X: The features generated by feature_gen.py
+        names: The names of its features in order, as in its schema
+        exclude: The features to leave out
+    """
+    keep = [i for i, name in enumerate(names) if name not in exclude]
+    columns = [0] + [1 + i for i in keep] + \
+        [1 + len(names) + i for i in keep]
+    return X[:, columns]
+
+
+def successive_halving(X, y, trials, executor, names, eta=3, min_folds=1,
+                       verbose=False, **kwargs):
+    """Runs the search, updating the scores of the trials in place, and
+    returns them best first. Each rung scores the surviving trials on
+    eta times as many folds as the last (only the new folds are run), then
+    keeps the best 1 / eta of them.
+
+    Arguments:
+        X: The features generated by feature_gen.py
+        y: The labels
+        trials: The Trials to search over
+        executor: The ParallelCV (or workqueue.QueueCV) every fold is run on
+        names: The names of the features of X in order
+        eta: The factor the number of trials shrinks by each rung
+        min_folds: The number of folds of the first rung
+        verbose: Whether to print each rung
+        kwargs: Passed on to every model, eg. hmm_cache
+    """
+    # the features without each excluded subset, kept alive so that the
+    # cleaned inputs of each are only made and shared once
+    subsets = {}
+    alive = list(trials)
+
+    for rung in itertools.count():
+        n_folds = min_folds * eta ** rung
+
+        # schedule every trial's missing folds of this rung at once, with the
+        # trials on the same features and folds scored together
+        groups = {}
+        for trial in alive:
+            trial.rung = rung
+            folds = tuple(range(len(trial.scores),
+                                min(n_folds, trial.n_splits)))
+            if folds:
+                groups.setdefault((trial.exclude, trial.n_splits, folds),
+                                  []).append(trial)
+
+        pending = []
+        for (exclude, n_splits, folds), group in groups.items():
+            if exclude not in subsets:
+                subsets[exclude] = select_features(X, names, exclude)
+            specs = [get_model_spec(trial.model, **dict(kwargs,
+                                                        **trial.kwargs))
+                     for trial in group]
+            pending.extend(zip(group, cv_harness.schedule(
+                subsets[exclude], y, specs, executor, n_splits=n_splits,
+                folds=list(folds))))
+        for trial, results in pending:
+            trial.scores.extend(results.result())
+
+        alive.sort(key=lambda trial: -trial.accuracy())
+        if verbose:
+            print('RUNG', rung, 'WITH UP TO', n_folds, 'FOLDS:', len(alive),
+                  'TRIALS, BEST', alive[0].accuracy())
+        if all(len(trial.scores) == trial.n_splits for trial in alive):
+            break
+        alive = alive[:max(1, int(math.ceil(len(alive) / float(eta))))]
+
+    # the trials which made it furthest first, then by accuracy
+    return sorted(trials, key=lambda trial: (-trial.rung, -len(trial.scores),
+                                             -trial.accuracy()))
+
+
+def write_results(path, trials):
+    """Writes the results table as tab separated values
+
+    Arguments:
+        path: The file to write to
+        trials: The Trials, in the order of the rows
+    """
+    with open(path, 'w') as f:
+        f.write('\t'.join(COLUMNS) + '\n')
+        for trial in trials:
+            f.write('\t'.join(map(str, trial.row())) + '\n')
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    def _list(cast):
+        return lambda text: [cast(v) for v in text.split(',') if v]
+
+    parser = argparse.ArgumentParser(
+        description='Search over the models, their options and the features '
+                    'with successive halving on the folds.')
+    parser.add_argument('data', type=str,
+                        help='The features generated by feature_gen.py')
+    parser.add_argument('outfile', type=str,
+                        help='The file to write the results table to.')
+    parser.add_argument('--models', type=_list(str),
+                        default=sorted(_MODEL_STAGES),
+                        help='The models to search, separated by commas.')
+    parser.add_argument('--n-splits', type=_list(int), default=[5],
+                        help='The numbers of folds, separated by commas.')
+    parser.add_argument('--n-components', type=_list(int), default=[2],
+                        help='The numbers of hidden states of the HMMs.')
+    parser.add_argument('--n-dims', type=_list(int), default=[2],
+                        help='The dimensions of the Kalman filters\' latent '
+                             'states.')
+    parser.add_argument('--latent', type=_list(str), default=['hmm'],
+                        help='The latent forms of the temporal models, any '
+                             'of hmm, kalman and both.')
+    parser.add_argument('--exclude', type=_list(str), action='append',
+                        default=None,
+                        help='A set of features to leave out, separated by '
+                             'commas. May be given many times, and the full '
+                             'set of features is always tried too.')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='Keep the best 1 / eta of the trials each rung.')
+    parser.add_argument('--min-folds', type=int, default=1,
+                        help='The number of folds of the first rung.')
+    parser.add_argument('--hmm-cache', type=str, default=None,
+                        help='A folder to cache the trained HMMs in.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes, or 0 for every cpu.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the progress of each rung.')
+    workqueue.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    try:
+        X, y, schema = load_data(args.data)
+    except Exception:
+        print('COULDN\'T OPEN', args.data)
+        exit(1)
+
+    names = schema['features'] if schema is not None else feature_names()
+    unknown = [model for model in args.models if model not in _MODEL_STAGES]
+    unknown += [name for exclude in args.exclude or [] for name in exclude
+                if name not in names]
+    if unknown:
+        print('UNKNOWN', *unknown)
+        exit(1)
+
+    trials = make_trials(args.models, args.n_splits,
+                         [()] + (args.exclude or []), args.latent,
+                         args.n_components, args.n_dims)
+    with workqueue.make_executor(args, args.jobs) as executor:
+        trials = successive_halving(X, y, trials, executor, names,
+                                    eta=args.eta, min_folds=args.min_folds,
+                                    verbose=args.verbose,
+                                    hmm_cache=args.hmm_cache)
+    write_results(args.outfile, trials)
+
+    best = trials[0]
+    print('BEST', *best.row())
+
+
+if __name__ == '__main__':
+    main()
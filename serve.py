@@ -0,0 +1,449 @@
+# serve.py
+# A long running local server which answers the probability that one team
+# beats another. The model saved by train_models.py --save and every team's
+# current features are kept in memory, and concurrent requests are batched
+# into a single vectorized prediction
+
+import argparse
+import collections
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from feature_gen import FeatureGenerators, current_features, \
+    generate_features, feature_names
+from model_io import load_model
+
+
+# the sites a game can be played at, relative to the first team
+SITES = ('neutral', 'home', 'away')
+
+
+class MatchupPredictor():
+    """Scores matchups between teams going into their next game of a season.
+    Each matchup is scored from both teams' points of view (as target and as
+    opposition) and the two are averaged, as the rows for every game are in
+    the generated features.
+    """
+    def __init__(self, model, data, year=None):
+        """
+        Arguments:
+            model: The TrainedModel from model_io
+            data: The raw data dictionary as given by scrape.py
+            year: The season whose current features are used. Default is the
+                latest season in data.
+        """
+        self.model = model
+        self.year = max(int(y) for y in data['years']) if year is None \
+            else int(year)
+
+        names = model.schema.get('features', feature_names())
+        exclude = [name for name in FeatureGenerators.ALL
+                   if name not in names]
+        self._home = names.index('atHome') if 'atHome' in names else None
+
+        states = current_features(data, self.year, exclude)
+        self.teams = sorted(states)
+        self.index = {tid: i for i, tid in enumerate(self.teams)}
+        self.features = np.array([[np.nan if v is None else float(v)
+                                   for v in states[tid]]
+                                  for tid in self.teams]).reshape(
+                                      len(self.teams), len(names))
+
+        # the temporal models' latent features depend on the games before,
+        # so keep the state of each latent model at the end of each team's
+        # season so far (over the rows the model would have used)
+        self._latent = []
+        if model.latent:
+            X, _, schema = generate_features(data, exclude_features=exclude,
+                                             with_schema=True)
+            X = np.where(np.equal(X, None), np.nan, X).astype(float)
+            X = X[~np.isnan(X[:, 1 + model.columns]).any(axis=1)]
+            ids = np.zeros(len(self.teams))
+            for i, (year, tid) in enumerate(schema['series']):
+                if year == self.year and tid in self.index:
+                    ids[self.index[tid]] = i + 1
+            self._latent = model.next_states(X, ids)
+
+    def score(self, targets, opps, sites):
+        """Returns the probability that the target team wins each matchup,
+        from the target's point of view only, in a single vectorized call
+
+        Arguments:
+            targets: The index in teams of the target team of each matchup
+            opps: The index in teams of the opposition of each matchup
+            sites: The site of each matchup, one of SITES relative to the
+                target team
+        """
+        sites = np.asarray(sites)
+        target = self.features[targets]
+        opp = self.features[opps]
+        if self._home is not None:
+            target[:, self._home] = sites == 'home'
+            opp[:, self._home] = sites == 'away'
+
+        X = np.column_stack((np.zeros(len(target)), target, opp))
+        return self.model.predict_proba_next(self._latent, targets, X)
+
+    def predict(self, matchups):
+        """Returns the probability that the first team beats the second in
+        each matchup, nan where neither point of view can be scored since
+        features needed by the model are unknown.
+
+        Arguments:
+            matchups: A list of (team, other team, site) where the site is
+                one of SITES relative to the first team
+        """
+        flipped = {'home': 'away', 'away': 'home', 'neutral': 'neutral'}
+        a = [self.index[m[0]] for m in matchups]
+        b = [self.index[m[1]] for m in matchups]
+        sites = [m[2] for m in matchups]
+        probs = self.score(a + b, b + a,
+                           sites + [flipped[site] for site in sites])
+        return combine(*probs.reshape(2, -1))
+
+    def check(self, team, other, site):
+        """Raises a ValueError if the matchup can't be scored
+
+        Arguments:
+            team: The id of the first team
+            other: The id of the other team
+            site: The site relative to the first team
+        """
+        for tid in (team, other):
+            if tid not in self.index:
+                raise ValueError('Unknown team {}'.format(tid))
+        if site not in SITES:
+            raise ValueError('The site must be one of {}'.format(
+                ', '.join(SITES)))
+
+
+def combine(probs, other_probs):
+    """Averages the probability that a team wins from its point of view with
+    the probability from the other team's point of view that they lose. If
+    only one point of view is known (not nan) then that is used alone.
+
+    Arguments:
+        probs: The probabilities that the first team wins as target
+        other_probs: The probabilities that the other team wins as target
+    """
+    both = np.stack((probs, 1. - np.asarray(other_probs)))
+    known = ~np.isnan(both)
+    return np.where(known.any(axis=0),
+                    np.where(known, both, 0.).sum(axis=0) /
+                    np.maximum(known.sum(axis=0), 1), np.nan)
+
+
+class LatencyMetrics():
+    """Keeps the latencies of the most recent requests and the sizes of the
+    most recent batches
+    """
+    def __init__(self, window=10000):
+        """
+        Arguments:
+            window: The number of recent requests and batches to keep
+        """
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._batches = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def record(self, seconds, error=False):
+        """Records a request
+
+        Arguments:
+            seconds: How long it took to answer
+            error: Whether it failed
+        """
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self._latencies.append(seconds)
+
+    def record_batch(self, size, seconds):
+        """Records a batched prediction
+
+        Arguments:
+            size: The number of matchups in it
+            seconds: How long the prediction took
+        """
+        with self._lock:
+            self._batches.append((size, seconds))
+
+    def summary(self):
+        """Returns the metrics as a dict, with times in milliseconds
+        """
+        with self._lock:
+            latencies = 1000. * np.array(self._latencies)
+            batches = np.array(self._batches).reshape(-1, 2)
+            summary = {'requests': self.requests, 'errors': self.errors,
+                       'uptime_s': time.time() - self.started}
+        if len(latencies):
+            p50, p90, p99 = np.percentile(latencies, (50, 90, 99))
+            summary.update({'latency_ms': {
+                'mean': latencies.mean(), 'p50': p50, 'p90': p90,
+                'p99': p99, 'max': latencies.max()}})
+        if len(batches):
+            summary.update({'batches': {
+                'mean_size': batches[:, 0].mean(),
+                'max_size': int(batches[:, 0].max()),
+                'mean_predict_ms': 1000. * batches[:, 1].mean()}})
+        return summary
+
+
+class MicroBatcher():
+    """Collects the matchups of concurrent requests and scores them together.
+    A single thread waits for the first request, then up to max_wait for more
+    (or until max_batch matchups), and makes one call to the predictor.
+    """
+    def __init__(self, predictor, metrics, max_batch=1024, max_wait=0.001):
+        """
+        Arguments:
+            predictor: The MatchupPredictor
+            metrics: The LatencyMetrics to record the batches in
+            max_batch: The most matchups to score at once
+            max_wait: The longest time in seconds to wait for more requests
+                once one has arrived
+        """
+        self.predictor = predictor
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict(self, matchups):
+        """Returns the probabilities of the matchups once their batch is done
+
+        Arguments:
+            matchups: A list of matchups, see MatchupPredictor.predict
+        """
+        pending = {'matchups': matchups, 'done': threading.Event()}
+        self._queue.put(pending)
+        pending['done'].wait()
+        if 'error' in pending:
+            raise pending['error']
+        return pending['probs']
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0]['matchups'])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    pending = self._queue.get(
+                        timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                size += len(pending['matchups'])
+
+            start = time.time()
+            try:
+                probs = self.predictor.predict(
+                    [m for pending in batch for m in pending['matchups']])
+                i = 0
+                for pending in batch:
+                    n = len(pending['matchups'])
+                    pending['probs'] = probs[i:i + n]
+                    i += n
+            except Exception as e:
+                for pending in batch:
+                    pending['error'] = e
+            self.metrics.record_batch(size, time.time() - start)
+            for pending in batch:
+                pending['done'].set()
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """Answers
+        GET /predict?a=TEAM&b=TEAM[&site=neutral|home|away]
+        POST /predict with a JSON list of {"a": TEAM, "b": TEAM, "site": ...}
+        GET /metrics
+        GET /teams
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body):
+        text = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def _predict(self, queries):
+        """Scores the queries through the batcher and sends the result
+
+        Arguments:
+            queries: A list of dicts with a, b and optionally site
+        """
+        start = time.time()
+        try:
+            matchups = [(int(q['a']), int(q['b']), q.get('site', 'neutral'))
+                        for q in queries]
+            for matchup in matchups:
+                self.server.batcher.predictor.check(*matchup)
+        except (KeyError, TypeError, ValueError) as e:
+            self.server.metrics.record(time.time() - start, error=True)
+            self._send(400, {'error': str(e)})
+            return None
+
+        probs = self.server.batcher.predict(matchups)
+        results = [{'a': a, 'b': b, 'site': site,
+                    'p': None if p != p else float(p)}
+                   for (a, b, site), p in zip(matchups, probs)]
+        self.server.metrics.record(time.time() - start)
+        return results
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self._send(200, self.server.metrics.summary())
+        elif url.path == '/teams':
+            self._send(200, self.server.batcher.predictor.teams)
+        elif url.path == '/predict':
+            query = {key: values[0]
+                     for key, values in parse_qs(url.query).items()}
+            results = self._predict([query])
+            if results is not None:
+                self._send(200, results[0])
+        else:
+            self._send(404, {'error': 'Unknown path ' + url.path})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/predict':
+            self._send(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            queries = json.loads(self.rfile.read(length).decode())
+        except ValueError:
+            self._send(400, {'error': 'The body must be a JSON list'})
+            return
+        if not isinstance(queries, list):
+            self._send(400, {'error': 'The body must be a JSON list'})
+            return
+        results = self._predict(queries)
+        if results is not None:
+            self._send(200, results)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """The same as ThreadingHTTPServer but listening on a Unix socket
+    """
+    daemon_threads = True
+
+
+def make_server(model, data, address, year=None, verbose=False, **kwargs):
+    """Makes the server, loading everything it keeps in memory up front
+
+    Arguments:
+        model: The TrainedModel from model_io
+        data: The raw data dictionary as given by scrape.py
+        address: Either a (host, port) to listen on or the path of a Unix
+            socket
+        year: See MatchupPredictor
+        verbose: Whether to log every request
+        kwargs: Passed on to MicroBatcher, eg. max_batch or max_wait
+    """
+    predictor = MatchupPredictor(model, data, year)
+    metrics = LatencyMetrics()
+
+    if isinstance(address, str):
+        server = UnixHTTPServer(address, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer(address, PredictionHandler)
+    server.metrics = metrics
+    server.batcher = MicroBatcher(predictor, metrics, **kwargs)
+    server.verbose = verbose
+    return server
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Serve the probability that one team beats another '
+                    'going into their next game.')
+    parser.add_argument('model', type=str,
+                        help='The model saved by train_models.py --save')
+    parser.add_argument('data', type=str,
+                        help='The raw data from scrape.py with the games '
+                             'played so far.')
+    parser.add_argument('--year', type=int, default=None,
+                        help='The season to use. Default is the latest.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='The address to listen on.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='The port to listen on.')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Listen on this Unix socket instead.')
+    parser.add_argument('--max-batch', type=int, default=1024,
+                        help='The most matchups to score at once.')
+    parser.add_argument('--max-wait', type=float, default=1.,
+                        help='The longest to wait for concurrent requests '
+                             'to batch together, in milliseconds.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    try:
+        model = load_model(args.model)
+    except:
+        print('COULDN\'T LOAD', args.model)
+        exit(1)
+
+    try:
+        with open(args.data, 'r') as f:
+            data = json.load(f)
+    except:
+        print('COULDN\'T OPEN', args.data)
+        exit(1)
+
+    address = args.socket if args.socket is not None \
+        else (args.host, args.port)
+    server = make_server(model, data, address, args.year, args.verbose,
+                         max_batch=args.max_batch,
+                         max_wait=args.max_wait / 1000.)
+    print('SERVING', model.name, 'FOR', server.batcher.predictor.year, 'ON',
+          address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None:
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
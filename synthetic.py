@@ -0,0 +1,281 @@
+# synthetic.py
+# Generates a synthetic league of any size in the same formats as the real
+# data: ESPN style boxscore payloads, as scrape.get_game downloads them, and
+# the season dictionaries scrape.py saves once they are parsed. Every team
+# has a strength each season which drifts between seasons and decides its
+# games, so that the models have something to learn
+
+import argparse
+import datetime
+import json
+
+import numpy as np
+
+from scrape import parse_game
+
+
+# the labels of ESPN's boxscore totals, in order
+LABELS = ('MIN', 'FG', '3PT', 'FT', 'OREB', 'DREB', 'REB', 'AST', 'STL',
+          'BLK', 'TO', 'PF', 'PTS')
+
+# the size of the real data, about 350 teams playing 30 games in 13 seasons
+REAL_SIZE = {'n_teams': 350, 'games_per_team': 30, 'n_seasons': 13}
+
+# the number of teams ranked each season
+N_RANKED = 25
+
+# the number of players on each team, ten of whom play each game
+ROSTER_SIZE = 13
+
+
+def _team_box(rng, strength, opp_strength, missing_rate):
+    """Returns the boxscore totals of one team as ESPN's strings, its points
+    and its counts (of the makes and attempts of twos, threes and free throws
+    and the other totals) for splitting between its players
+
+    Arguments:
+        rng: The numpy random Generator
+        strength: The team's strength this season
+        opp_strength: The opposition's strength
+        missing_rate: The probability that each total is unknown ('--')
+    """
+    edge = strength - opp_strength
+    fga, tpa, fta = rng.poisson((36, 20, 20))
+    fgm = rng.binomial(fga, np.clip(0.48 + 0.04 * edge, 0.05, 0.95))
+    tpm = rng.binomial(tpa, np.clip(0.34 + 0.03 * edge, 0.05, 0.95))
+    ftm = rng.binomial(fta, 0.7)
+    others = rng.poisson((10, 24 + 2 * edge, 13, 6, 3, 13 - edge, 18)).clip(0)
+    oreb, dreb, ast, stl, blk, to, pf = others
+    points = 2 * fgm + 3 * tpm + ftm
+
+    totals = ['200', '{}-{}'.format(fgm + tpm, fga + tpa),
+              '{}-{}'.format(tpm, tpa), '{}-{}'.format(ftm, fta)] + \
+        [str(v) for v in (oreb, dreb, oreb + dreb, ast, stl, blk, to, pf,
+                          points)]
+    for k in np.flatnonzero(rng.random(len(totals) - 1) < missing_rate):
+        totals[k + 1] = '--'
+    counts = {'made': (fgm, tpm, ftm), 'attempts': (fga, tpa, fta),
+              'others': others}
+    return totals, int(points), counts
+
+
+def _athletes(rng, tid, counts):
+    """Returns ESPN's per player stat lines of one team, splitting its counts
+    between ten of its thirteen players. The first five are always the
+    starters and play the most.
+
+    Arguments:
+        rng: The numpy random Generator
+        tid: The team's id, where its players' ids are tid * 100 + 1 to 13
+        counts: The counts from _team_box
+    """
+    bench = 6 + rng.choice(ROSTER_SIZE - 5, size=5, replace=False)
+    played = np.r_[np.arange(1, 6), np.sort(bench)]
+    share = rng.dirichlet(np.r_[np.full(5, 4.), np.full(5, 1.5)])
+
+    minutes = rng.multinomial(200, share)
+    attempts = [rng.multinomial(a, share) for a in counts['attempts']]
+    made = [rng.multivariate_hypergeometric(a, m)
+            for a, m in zip(attempts, counts['made'])]
+    others = [rng.multinomial(n, share) for n in counts['others']]
+
+    athletes = []
+    for i, k in enumerate(played):
+        (fgm, tpm, ftm), (fga, tpa, fta) = [[part[i] for part in split]
+                                            for split in (made, attempts)]
+        oreb, dreb, ast, stl, blk, to, pf = [part[i] for part in others]
+        stats = [str(minutes[i]), '{}-{}'.format(fgm + tpm, fga + tpa),
+                 '{}-{}'.format(tpm, tpa), '{}-{}'.format(ftm, fta)] + \
+            [str(v) for v in (oreb, dreb, oreb + dreb, ast, stl, blk, to, pf,
+                              2 * fgm + 3 * tpm + ftm)]
+        athletes.append({'athlete': {'id': str(tid * 100 + k),
+                                     'displayName': 'Player {}'.format(k)},
+                         'starter': bool(k <= 5), 'didNotPlay': False,
+                         'stats': stats})
+    return athletes
+
+
+def _payload(home, away, date, neutral, halves):
+    """Returns the boxscore JSON of a game as ESPN gives it
+
+    Arguments:
+        home: The home team's dict of 'id', 'score', 'record', 'rank' (None if
+            unranked), 'totals' and 'athletes'
+        away: The same for the away team
+        date: The datetime of the game
+        neutral: Whether it was at a neutral site
+        halves: The (home, away) first half scores
+    """
+    def team(side, half):
+        info = {'id': str(side['id']), 'score': str(side['score']),
+                'record': [{'summary': side['record']}],
+                'linescores': [{'displayValue': str(half)}]}
+        if side['rank'] is not None:
+            info['rank'] = side['rank']
+        return info
+
+    return {'__gamepackage__': {'homeTeam': team(home, halves[0]),
+                                'awayTeam': team(away, halves[1])},
+            'gamepackageJSON': {
+                'header': {'competitions': [
+                    {'neutralSite': bool(neutral),
+                     'date': date.strftime('%Y-%m-%dT%H:%MZ')}]},
+                'boxscore': {'players': [
+                    {'team': {'id': str(side['id'])},
+                     'statistics': [{'labels': list(LABELS),
+                                     'athletes': side['athletes'],
+                                     'totals': side['totals']}]}
+                    for side in (home, away)]}}}
+
+
+def generate_boxscores(n_teams=350, games_per_team=30, n_seasons=13,
+                       missing_rate=0.01, seed=0, first_year=2006):
+    """Yields the (year, game id, boxscore JSON) of every game of a synthetic
+    league, season by season. Every team plays every season, and each round
+    of a season the teams are paired at random so every team plays exactly
+    games_per_team games (one team sits out each round if there are an odd
+    number). The players' stat lines are drawn from their own stream, so
+    the games are the same as before they were added.
+
+    Arguments:
+        n_teams: The number of teams
+        games_per_team: The number of rounds of games each season
+        n_seasons: The number of seasons
+        missing_rate: The probability that each boxscore total is unknown
+        seed: The seed of the random draws
+        first_year: The first season, where 2006 is the 05/06 season
+    """
+    rng = np.random.default_rng(seed)
+    player_rng = np.random.default_rng([seed, 1])
+    tids = np.arange(1, n_teams + 1)
+    strength = rng.normal(size=n_teams)
+    gid = 400000000
+
+    for year in range(first_year, first_year + n_seasons):
+        # the strengths carry over from the last season with some change
+        strength = 0.8 * strength + 0.6 * rng.normal(size=n_teams)
+        ranks = {int(t): r + 1 for r, t in
+                 enumerate(np.argsort(-strength)[:N_RANKED])}
+        records = np.zeros((n_teams, 2), dtype=int)
+        start = datetime.datetime(year - 1, 11, 10, 19)
+        gap = 120. / max(games_per_team, 1)
+
+        for r in range(games_per_team):
+            date = start + datetime.timedelta(days=int(r * gap))
+            order = rng.permutation(n_teams)
+            for h, a in zip(order[0::2], order[1::2]):
+                neutral = rng.random() < 0.05
+                home_edge = 0 if neutral else 0.3
+                home = {'id': int(tids[h]), 'rank': ranks.get(h)}
+                away = {'id': int(tids[a]), 'rank': ranks.get(a)}
+                home['totals'], home['score'], home_counts = _team_box(
+                    rng, strength[h] + home_edge, strength[a], missing_rate)
+                away['totals'], away['score'], away_counts = _team_box(
+                    rng, strength[a], strength[h] + home_edge, missing_rate)
+                home['athletes'] = _athletes(player_rng, home['id'],
+                                             home_counts)
+                away['athletes'] = _athletes(player_rng, away['id'],
+                                             away_counts)
+                if home['score'] == away['score']:
+                    # settled in overtime by a free throw, which is simply
+                    # added to the score
+                    winner = home if rng.random() < 0.5 else away
+                    winner['score'] += 1
+
+                won = home['score'] > away['score']
+                records[h] += (won, not won)
+                records[a] += (not won, won)
+                home['record'] = '{}-{}'.format(*records[h])
+                away['record'] = '{}-{}'.format(*records[a])
+
+                halves = (rng.binomial(home['score'], 0.5),
+                          rng.binomial(away['score'], 0.5))
+                gid += 1
+                yield year, gid, _payload(home, away, date, neutral, halves)
+
+
+def parse_boxscores(boxscores):
+    """Yields the (year, game id, game) of every boxscore which parses, as
+    scrape.parse_game gives the game
+
+    Arguments:
+        boxscores: An iterable of the (year, game id, boxscore JSON) of every
+            game, as from generate_boxscores
+    """
+    for year, gid, payload in boxscores:
+        game = parse_game(payload, gid)
+        if game is not None:
+            yield year, gid, game
+
+
+def make_league(games, years, n_teams):
+    """Returns the data dictionary of the league as scrape.py saves it, with
+    the string keys it has once loaded from JSON
+
+    Arguments:
+        games: An iterable of the (year, game id, game) of every game, as from
+            parse_boxscores
+        years: The seasons
+        n_teams: The number of teams, whose ids are 1 to n_teams
+    """
+    data = {'years': list(years),
+            'teams': {str(tid): {str(year): {'reg': []} for year in years}
+                      for tid in range(1, n_teams + 1)}}
+    for year, gid, game in games:
+        data[str(gid)] = game
+        for tid in (game['homeId'], game['awayId']):
+            data['teams'][str(tid)][str(year)]['reg'].append(gid)
+    return data
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic league in the same format as the '
+                    'data downloaded by scrape.py.')
+    parser.add_argument('outfile', type=str,
+                        help='The file to save the league\'s data to.')
+    parser.add_argument('--teams', type=int, default=REAL_SIZE['n_teams'],
+                        help='The number of teams.')
+    parser.add_argument('--games', type=int,
+                        default=REAL_SIZE['games_per_team'],
+                        help='The number of games each team plays a season.')
+    parser.add_argument('--seasons', type=int,
+                        default=REAL_SIZE['n_seasons'],
+                        help='The number of seasons.')
+    parser.add_argument('--missing-rate', type=float, default=0.01,
+                        help='The probability that each boxscore total is '
+                             'unknown.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the random draws.')
+    parser.add_argument('--boxscores', type=str, default=None,
+                        help='Also save the boxscore JSON of every game to '
+                             'this file, one [game id, boxscore] per line.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    boxscores = generate_boxscores(args.teams, args.games, args.seasons,
+                                   args.missing_rate, args.seed)
+    years = range(2006, 2006 + args.seasons)
+    if args.boxscores is None:
+        data = make_league(parse_boxscores(boxscores), years, args.teams)
+    else:
+        with open(args.boxscores, 'w') as f:
+            def _saved():
+                for year, gid, payload in boxscores:
+                    f.write(json.dumps([gid, payload]) + '\n')
+                    yield year, gid, payload
+            data = make_league(parse_boxscores(_saved()), years,
+                               args.teams)
+    with open(args.outfile, 'w') as f:
+        json.dump(data, f)
+
+
+if __name__ == '__main__':
+    main()
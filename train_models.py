@@ -3,15 +3,22 @@
 # Developed by Liam McInroy on 11.30.18
 
 import argparse
+import copy
 import json
 
 import numpy as np
 
-from pomegranate import BayesClassifier, MultivariateGaussianDistribution
-from sklearn.metrics import accuracy_score
-from sklearn.model_selection import KFold
+import batched_hmm
+import cv_harness
+import hmm_cache
+import instrument
+import workqueue
 
 from feature_gen import FeatureGenerators
+from gaussian_bayes import GaussianBayesClassifier, block_stats
+from kalman import KalmanModel
+from parallel_cv import ParallelCV
+from walk_forward import walk_forward
 
 
 def get_series_form(X):
@@ -21,25 +28,50 @@ def get_series_form(X):
     Arguments:
         X: The entire matrix of features with first column the series id
     """
-    # the last series id, none are negative so we will get a new one
-    last_series_idx = -1
-    # restrict down, but since a temporal we need to make a list of entries
-    _X = []
-    for row in X:
-        if row[0] != last_series_idx:
-            # create a new series to train on, start with empty input
-            # series then add to them while the row has the same index
-            last_series_idx = row[0]
-            _X.append(np.full((0, X.shape[1] - 1), None, dtype=None))
-
-        # add the datapoint to the current series
-        # print(_X[-1], row[1:])
-        try:
-            _X[-1] = np.vstack((_X[-1], row[1:]))
-        except Exception as e:
-            print(_X[-1], row[1:])
-            raise e
-    return _X
+    # a new series starts wherever the series id changes
+    starts, _ = batched_hmm.series_bounds(X[:, 0])
+    return np.split(X[:, 1:], starts[1:])
+
+
+# cache of the validity masks for each dataset given to the get_*_inputs
+# functions, keyed by the id of the dataset. The dataset itself is also kept
+# so that its id can't be reused by another array while it is cached
+_MASK_CACHE = {}
+
+
+def get_input_masks(X):
+    """Computes which columns and rows of the features have unknown values,
+    but only once per dataset since every model would otherwise repeat the same
+    scan. Returns a dictionary of boolean masks over the columns and rows of X
+
+    Arguments:
+        X: The entire matrix of features with first column the series id
+    """
+    if id(X) in _MASK_CACHE and _MASK_CACHE[id(X)][0] is X:
+        return _MASK_CACHE[id(X)][1]
+
+    num_features = int((X.shape[1] - 1) / 2)
+
+    # a single elementwise pass over the object array finds every unknown
+    missing = np.equal(X, None)
+
+    # a feature is only kept if the target team's column of it never has
+    # unknown values, which then doubles over for the opposition's column too
+    known_features = ~missing[:, 1:num_features + 1].any(axis=0)
+    non_stat_cols = np.concatenate(([False], known_features, known_features))
+
+    masks = {
+        # the feature columns (including the series id) used by the non stat
+        # models and the rows which have valid data over them
+        'non_stat_cols': non_stat_cols,
+        'non_stat_rows': ~missing[:, non_stat_cols].any(axis=1),
+        # the rows which have valid data throughout
+        'complete_rows': ~missing.any(axis=1),
+    }
+
+    _MASK_CACHE.clear()
+    _MASK_CACHE[id(X)] = (X, masks)
+    return masks
 
 
 def get_non_stat_inputs(X, y, keepSeriesID=False):
@@ -50,23 +82,18 @@ def get_non_stat_inputs(X, y, keepSeriesID=False):
         y: The initial labels
         keepSeriesID: Whether to remove the series ID in processing
     """
-    # exclude the time series identifying features if we aren't using a
-    # temporal model
-    _X = X[:, (1 - int(keepSeriesID)):]
+    masks = get_input_masks(X)
 
     # get the features which don't have unknown values (just examine over the
     # target team's features, then double them over for the opposition's too
-    cols = [jj for j in range(int(_X.shape[1] / 2)) if None not in _X[:, j]
-            for jj in (j, j + int(_X.shape[1] / 2))]
-
-    # restrict to not have unknown features
-    _X = _X[:, cols]
-
-    # get the rows which have valid data throughout
-    rows = [i for i in range(_X.shape[0]) if None not in _X[i]]
+    # and exclude the time series identifying features if we aren't using a
+    # temporal model
+    cols = masks['non_stat_cols'].copy()
+    cols[0] = keepSeriesID
 
-    # restrict down
-    return _X[rows], y[rows]
+    # restrict down to the rows which have valid data throughout
+    rows = masks['non_stat_rows']
+    return X[np.ix_(rows, cols)].astype(float), y[rows]
 
 
 def get_stat_inputs(X, y, keepSeriesID=False):
@@ -77,12 +104,30 @@ def get_stat_inputs(X, y, keepSeriesID=False):
         y: The initial labels
         keepSeriesID: Whether to remove the series id during processing
     """
-    _X = X[:, (1 - int(keepSeriesID)):]
-
     # get the rows which have valid data throughout
-    rows = [i for i in range(_X.shape[0]) if None not in _X[i]]
+    rows = get_input_masks(X)['complete_rows']
+
+    return X[rows, (1 - int(keepSeriesID)):].astype(float), y[rows]
+
+
+def get_comp_stat_columns(X):
+    """Gives whether the target team is home (1), away (-1) or neutral (0) and
+    the difference in each other feature between the teams, for every row.
+
+    Arguments:
+        X: The features as floats, with first column the series id
+    """
+    num_features = int((X.shape[1] - 1) / 2)
+
+    # put if our team is home (1), away (-1), or neutral (0)
+    home = np.where(X[:, 1] != 0, 1.,
+                    np.where(X[:, 1 + num_features] != 0, -1., 0.))
 
-    return X[rows, 1:], y[rows]
+    # now we have to skip to start at n + 2 since we skip whether other team
+    # is home or away
+    diffs = X[:, 2:num_features + 1] - X[:, num_features + 2:]
+
+    return np.column_stack((home, diffs))
 
 
 def get_comp_stat_inputs(X, y, keepSeriesID=False):
@@ -96,65 +141,331 @@ def get_comp_stat_inputs(X, y, keepSeriesID=False):
     """
     # This one's inputs are only half the size, because the difference in each
     # feature is computed instead of trying to learn over all of them
-    num_features = int((X.shape[1] - 1) / 2)
 
     # get the rows which have valid data throughout
-    rows = [i for i in range(X.shape[0]) if None not in X[i]]
+    rows = get_input_masks(X)['complete_rows']
+    _X = X[rows].astype(float)
 
-    # restrict down
-    _X = X[rows, 0:num_features + int(keepSeriesID)]
+    if keepSeriesID:
+        return np.column_stack((_X[:, 0], get_comp_stat_columns(_X))), y[rows]
+    return get_comp_stat_columns(_X), y[rows]
 
-    # put if our team is home (1), away (-1), or neutral (0)
-    _X[:, int(keepSeriesID)] = \
-        [1 if X[i, 1] else (-1 if X[i, 1 + num_features] else 0)
-         for i in rows]
 
-    # now we have to skip to start at n + 2 since we skip whether other team
-    # is home or away
-    _X[:, (1 + int(keepSeriesID)):] = \
-        X[rows, 2:num_features + 1] - X[rows, num_features + 2:]
+class GaussianBayesStage():
+    """The classifier stage of every model, a bayesian classifier with a
+    multivariate gaussian distribution over the inputs for each class.
+    """
+    def key(self):
+        """Identifies the stage for the cross validation harness
+        """
+        return ('gaussian_bayes',)
+
+    def fit(self, X, y):
+        """Trains the classifier
+
+        Arguments:
+            X: The inputs
+            y: The classes
+        """
+        return GaussianBayesClassifier.from_samples(X, y)
+
+    def block_stats(self, X, y, blocks):
+        """Computes the sufficient statistics of the whole dataset and of each
+        held out block, so that each fold's classifier can be made from them
+
+        Arguments:
+            X: The inputs
+            y: The classes
+            blocks: The held out rows of each fold
+        """
+        stats = block_stats(X, y, blocks)
+        total = stats[0]
+        for block in stats[1:]:
+            total = total + block
+        return total, stats
+
+    def fit_excluding(self, stats, k):
+        """Makes the classifier trained on every block but the kth
+
+        Arguments:
+            stats: The result of block_stats
+            k: The held out block
+        """
+        total, blocks = stats
+        return GaussianBayesClassifier.from_stats(total - blocks[k])
+
+
+class HiddenSpaceStage():
+    """The latent feature stage of the temporal models, which replaces the
+    series id with the hidden state of each game as found by an HMM.
+    """
+    def __init__(self, n_components=2, cache_dir=None):
+        """
+        Arguments:
+            n_components: The number of hidden states to use for feature
+                generation with the HMM.
+            cache_dir: The folder of the HMMCache to reuse and warm start the
+                HMMs from. If None, every HMM is trained from scratch, so
+                the results don't depend on what was trained before.
+        """
+        self.n_components = n_components
+        self.cache_dir = cache_dir
+
+    def key(self):
+        """Identifies the stage for the cross validation harness
+        """
+        return ('hmm', self.n_components)
+
+    def _cache(self):
+        """The HMMCache of the folder, or None if there isn't one
+        """
+        if self.cache_dir is None:
+            return None
+        return hmm_cache.get_cache(self.cache_dir)
+
+    def fit(self, X):
+        """Trains the HMM
+
+        Arguments:
+            X: The inputs with first column the series id
+        """
+        return FeatureGenerators.HiddenSpaceGenerator(
+            X, self.n_components, cache=self._cache())
+
+    def refit(self, hmm, X):
+        """Continues training a copy of the HMM on X, eg. once another
+        season has been added to the data it was trained on
+
+        Arguments:
+            hmm: The trained HMM
+            X: The inputs with first column the series id
+        """
+        return FeatureGenerators.HiddenSpaceGenerator(
+            X, self.n_components, cache=self._cache(), init=hmm)
+
+    def transform(self, hmm, X):
+        """Gets the hidden state of each game as a column
+
+        Arguments:
+            hmm: The trained HMM
+            X: The inputs with first column the series id
+        """
+        # since one dimensional feature (with a different label for each
+        # component), then we decode every series at once into a single
+        # column to glue onto the end of the normal inputs
+        return batched_hmm.predict(batched_hmm.HMMParams.from_pomegranate(hmm),
+                                   X)
 
-    return _X, y[rows]
 
+class KalmanStage():
+    """A latent feature stage for the temporal models which replaces the series
+    id with the filtered latent form of the team from a linear gaussian state
+    space model, a continuous alternative to the HMM's discrete state.
+    """
+    def __init__(self, n_dims=2):
+        """
+        Arguments:
+            n_dims: The dimension of the latent form
+        """
+        self.n_dims = n_dims
+
+    def key(self):
+        """Identifies the stage for the cross validation harness
+        """
+        return ('kalman', self.n_dims)
+
+    def fit(self, X):
+        """Learns the state space model with EM
+
+        Arguments:
+            X: The inputs with first column the series id
+        """
+        return KalmanModel(self.n_dims).fit(X)
+
+    def refit(self, model, X):
+        """Continues EM from a copy of the model on X, eg. once another
+        season has been added to the data it was fit on
+
+        Arguments:
+            model: The trained KalmanModel
+            X: The inputs with first column the series id
+        """
+        return copy.deepcopy(model).fit(X, warm_start=True)
+
+    def transform(self, model, X):
+        """Gets the filtered latent form before each game as columns, which
+        only depend on the team's games up until then
+
+        Arguments:
+            model: The trained KalmanModel
+            X: The inputs with first column the series id
+        """
+        return model.filter(X)
+
+
+class StackedLatentStage():
+    """Several latent feature stages whose columns are all glued together, eg.
+    the HMM's hidden state augmented with the Kalman filter's latent form.
+    """
+    def __init__(self, *stages):
+        """
+        Arguments:
+            stages: The latent feature stages
+        """
+        self.stages = stages
+
+    def key(self):
+        """Identifies the stage for the cross validation harness
+        """
+        return sum((stage.key() for stage in self.stages), ())
+
+    def fit(self, X):
+        """Fits every stage
+
+        Arguments:
+            X: The inputs with first column the series id
+        """
+        return [stage.fit(X) for stage in self.stages]
+
+    def refit(self, models, X):
+        """Continues training every stage's model
+
+        Arguments:
+            models: The fitted models of every stage
+            X: The inputs with first column the series id
+        """
+        return [stage.refit(model, X)
+                for stage, model in zip(self.stages, models)]
+
+    def transform(self, models, X):
+        """Gets the columns of every stage
+
+        Arguments:
+            models: The fitted models of every stage
+            X: The inputs with first column the series id
+        """
+        return np.hstack([stage.transform(model, X)
+                          for stage, model in zip(self.stages, models)])
+
+
+# The input selection for each model and whether it is temporal, so includes
+# the hidden state space feature
+_MODEL_STAGES = {'naive_non_stat': (get_non_stat_inputs, False),
+                 'naive_stat': (get_stat_inputs, False),
+                 'comp_naive_stat': (get_comp_stat_inputs, False),
+                 'temporal_non_stat': (get_non_stat_inputs, True),
+                 'temporal_stat': (get_stat_inputs, True),
+                 'temporal_comp_stat': (get_comp_stat_inputs, True),
+                 }
+
+
+def get_model_spec(name, **kwargs):
+    """Gets the stages of the named model for the cross validation harness
 
-def train_naive_non_stat_bayes(X, y, **kwargs):
-    """Train a naive bayesian model on the given features data, which doesn't
-    use many of the team statistics since they're unreliably provided.
+    Arguments:
+        name: One of the keys of _MODELS
+        kwargs: The same as the train_* functions
+    """
+    inputs, temporal = _MODEL_STAGES[name]
+    latent = None
+    if temporal:
+        hmm = HiddenSpaceStage(kwargs.get('n_components', 2),
+                               kwargs.get('hmm_cache', None))
+        kalman = KalmanStage(kwargs.get('n_dims', 2))
+        latent = {'hmm': hmm,
+                  'kalman': kalman,
+                  'both': StackedLatentStage(hmm, kalman),
+                  }[kwargs.get('latent', 'hmm')]
+    return cv_harness.ModelSpec(name, inputs, GaussianBayesStage(), latent)
+
+
+def _cross_validate(X, y, specs, **kwargs):
+    """Runs the K-fold cross validation of the models and prints each of their
+    accuracies. If an executor is given, the folds are only scheduled on it
+    and a function for each model which prints its results once they finish
+    is returned instead, so that several models can share the same pool.
 
     Arguments:
         X: The features generated by feature_gen.py to train from
         y: The classes
-        kwargs: For verbosity
-            verbose: If greater than zero, then outputs basic information
-                about the training process during training. Default 0.
-            n_splits: The number of folds to use during KFold cross validation
-                Default 5.
+        specs: The ModelSpecs of the models
+        kwargs: The same as the train_* functions
     """
     def printverbose(*msg):
         if kwargs.get('verbose', 0) > 0:
             print(*msg)
 
-    _X, _y = get_non_stat_inputs(X, y)
+    def schedule(executor):
+        """Submits the folds to the executor and returns the reporting
+        functions
+        """
+        # begin the training routine. We use K-fold to estimate the accuracy
+        # and generalization power of the models
+        return [make_report(results) for results in
+                cv_harness.schedule(X, y, specs, executor,
+                                    n_splits=kwargs.get('n_splits', 5))]
+
+    def make_report(results):
+        """Returns the function printing the results of a single model
+        """
+        def report():
+            """Prints the accuracy of each fold, in fold order
+            """
+            # for the temporal models this includes the series ID since it
+            # gets replaced by the hidden state
+            printverbose('Training with {} features'.format(results.shape[1]))
+            printverbose('Training on {} samples'.format(results.shape[0]))
+
+            cum_acc = 0
+            for k, acc in enumerate(results.result()):
+                printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
+                cum_acc = (k * cum_acc + acc) / (k + 1.)
+                printverbose('\tCurrent cumulative accuracy:', cum_acc)
+
+            print('Cumulative accuracy after {} folds: {}'.format(k + 1,
+                                                                  cum_acc))
+        return report
+
+    if kwargs.get('executor', None) is not None:
+        return schedule(kwargs['executor'])
+
+    with ParallelCV(kwargs.get('n_jobs', 1)) as executor:
+        for report in schedule(executor):
+            report()
+
+
+def _train_model(name, X, y, **kwargs):
+    """Cross validates a single model, see the train_* functions
 
-    printverbose('Training with {} features'.format(_X.shape[1]))
-    printverbose('Training on {} samples'.format(_X.shape[0]))
+    Arguments:
+        name: One of the keys of _MODELS
+        X: The features generated by feature_gen.py to train from
+        y: The classes
+        kwargs: The same as the train_* functions
+    """
+    reports = _cross_validate(X, y, [get_model_spec(name, **kwargs)],
+                              **kwargs)
+    return reports[0] if reports else None
 
-    # begin the training routine. We use K-fold to estimate the accuracy and
-    # generalization power of the models
-    sk_fold = KFold(n_splits=kwargs.get('n_splits', 5))
-    cum_acc = 0
-    for k, (train_idx, test_idx) in enumerate(sk_fold.split(_X, _y)):
-        clf = BayesClassifier.from_samples(MultivariateGaussianDistribution,
-                                           _X[train_idx],
-                                           _y[train_idx].flatten())
 
-        acc = accuracy_score(_y[test_idx].flatten(),
-                             clf.predict(_X[test_idx]))
-        printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
-        cum_acc = (k * cum_acc + acc) / (k + 1.)
-        printverbose('\tCurrent cumulative accuracy:', cum_acc)
+def train_naive_non_stat_bayes(X, y, **kwargs):
+    """Train a naive bayesian model on the given features data, which doesn't
+    use many of the team statistics since they're unreliably provided.
 
-    print('Cumulative accuracy after {} folds: {}'.format(k + 1, cum_acc))
+    Arguments:
+        X: The features generated by feature_gen.py to train from
+        y: The classes
+        kwargs: For verbosity
+            verbose: If greater than zero, then outputs basic information
+                about the training process during training. Default 0.
+            n_splits: The number of folds to use during KFold cross validation
+                Default 5.
+            n_jobs: The number of processes to run the folds across. Default
+                1, running them one after another.
+            executor: A ParallelCV to schedule the folds on instead. If given
+                then a function printing the results is returned.
+    """
+    return _train_model('naive_non_stat', X, y, **kwargs)
 
 
 def train_naive_stat_bayes(X, y, **kwargs):
@@ -169,32 +480,12 @@ def train_naive_stat_bayes(X, y, **kwargs):
                 about the training process during training. Default 0.
             n_splits: The number of folds to use during KFold cross validation
                 Default 5.
+            n_jobs: The number of processes to run the folds across. Default
+                1, running them one after another.
+            executor: A ParallelCV to schedule the folds on instead. If given
+                then a function printing the results is returned.
     """
-    def printverbose(*msg):
-        if kwargs.get('verbose', 0) > 0:
-            print(*msg)
-
-    _X, _y = get_stat_inputs(X, y)
-
-    printverbose('Training with {} features'.format(_X.shape[1]))
-    printverbose('Training on {} samples'.format(_X.shape[0]))
-
-    # begin the training routine. We use K-fold to estimate the accuracy and
-    # generalization power of the models
-    sk_fold = KFold(n_splits=kwargs.get('n_splits', 5))
-    cum_acc = 0
-    for k, (train_idx, test_idx) in enumerate(sk_fold.split(_X, _y)):
-        clf = BayesClassifier.from_samples(MultivariateGaussianDistribution,
-                                           _X[train_idx],
-                                           _y[train_idx].flatten())
-
-        acc = accuracy_score(_y[test_idx].flatten(),
-                             clf.predict(_X[test_idx]))
-        printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
-        cum_acc = (k * cum_acc + acc) / (k + 1.)
-        printverbose('\tCurrent cumulative accuracy:', cum_acc)
-
-    print('Cumulative accuracy after {} folds: {}'.format(k + 1, cum_acc))
+    return _train_model('naive_stat', X, y, **kwargs)
 
 
 def train_comp_naive_stat_bayes(X, y, **kwargs):
@@ -211,32 +502,12 @@ def train_comp_naive_stat_bayes(X, y, **kwargs):
                 about the training process during training. Default 0.
             n_splits: The number of folds to use during KFold cross validation
                 Default 5.
+            n_jobs: The number of processes to run the folds across. Default
+                1, running them one after another.
+            executor: A ParallelCV to schedule the folds on instead. If given
+                then a function printing the results is returned.
     """
-    def printverbose(*msg):
-        if kwargs.get('verbose', 0) > 0:
-            print(*msg)
-
-    _X, _y = get_comp_stat_inputs(X, y)
-
-    printverbose('Training with {} features'.format(_X.shape[1]))
-    printverbose('Training on {} samples'.format(_X.shape[0]))
-
-    # begin the training routine. We use K-fold to estimate the accuracy and
-    # generalization power of the models
-    sk_fold = KFold(n_splits=kwargs.get('n_splits', 5))
-    cum_acc = 0
-    for k, (train_idx, test_idx) in enumerate(sk_fold.split(_X, _y)):
-        clf = BayesClassifier.from_samples(MultivariateGaussianDistribution,
-                                           _X[train_idx],
-                                           _y[train_idx].flatten())
-
-        acc = accuracy_score(_y[test_idx].flatten(),
-                             clf.predict(_X[test_idx]))
-        printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
-        cum_acc = (k * cum_acc + acc) / (k + 1.)
-        printverbose('\tCurrent cumulative accuracy:', cum_acc)
-
-    print('Cumulative accuracy after {} folds: {}'.format(k + 1, cum_acc))
+    return _train_model('comp_naive_stat', X, y, **kwargs)
 
 
 def train_temporal_non_stat_bayes(X, y, **kwargs):
@@ -268,48 +539,22 @@ def train_temporal_non_stat_bayes(X, y, **kwargs):
                 about the training process during training. Default 0.
             n_splits: The number of folds to use during KFold cross validation
                 Default 5.
+            n_jobs: The number of processes to run the folds across. Default
+                1, running them one after another.
+            executor: A ParallelCV to schedule the folds on instead. If given
+                then a function printing the results is returned.
             n_components: The number of hidden states to use for feature
                 generation with the HMM. Default 2 (winning/losing)
+            latent: Which latent features to use, either 'hmm' for the HMM's
+                hidden state, 'kalman' for the latent form from a KalmanModel
+                or 'both'. Default 'hmm'.
+            n_dims: The dimension of the KalmanModel's latent form. Default 2
+            hmm_cache: The folder to persist the trained HMMs to, so that
+                reruns on the same data skip training and other data warm
+                starts from the closest cached HMM. Default None, only
+                caching them in memory.
     """
-    def printverbose(*msg):
-        if kwargs.get('verbose', 0) > 0:
-            print(*msg)
-
-    _X, _y = get_non_stat_inputs(X, y, keepSeriesID=True)
-
-    # size of _X.shape[1] with series ID since it gets replaced by hidden state
-    printverbose('Training with {} features'.format(_X.shape[1]))
-    printverbose('Training on {} samples'.format(_X.shape[0]))
-
-    # begin the training routine. We use K-fold to estimate the accuracy and
-    # generalization power of the models
-    sk_fold = KFold(n_splits=kwargs.get('n_splits', 5))
-    cum_acc = 0
-    for k, (train_idx, test_idx) in enumerate(sk_fold.split(_X, _y)):
-        hmm = \
-            FeatureGenerators.HiddenSpaceGenerator(_X[train_idx],
-                                                   kwargs.get('n_components',
-                                                              2))
-        # since one dimensional feature (with a different label for each
-        # component, then we instead stack vertically across all the series
-        # predictions then glue onto the end of the normal inputs
-        hiddenTrain = np.vstack((np.array(hmm.predict(x)).reshape(-1, 1)
-                                 for x in get_series_form(_X[train_idx])))
-        clf = BayesClassifier.from_samples(MultivariateGaussianDistribution,
-                                           np.hstack((_X[train_idx, 1:],
-                                                      hiddenTrain)),
-                                           _y[train_idx].flatten())
-
-        hiddenTest = np.vstack((np.array(hmm.predict(x)).reshape(-1, 1)
-                                for x in get_series_form(_X[test_idx])))
-        acc = accuracy_score(_y[test_idx].flatten(),
-                             clf.predict(np.hstack((_X[test_idx, 1:],
-                                                    hiddenTest))))
-        printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
-        cum_acc = (k * cum_acc + acc) / (k + 1.)
-        printverbose('\tCurrent cumulative accuracy:', cum_acc)
-
-    print('Cumulative accuracy after {} folds: {}'.format(k + 1, cum_acc))
+    return _train_model('temporal_non_stat', X, y, **kwargs)
 
 
 def train_temporal_stat_bayes(X, y, **kwargs):
@@ -341,48 +586,22 @@ def train_temporal_stat_bayes(X, y, **kwargs):
                 about the training process during training. Default 0.
             n_splits: The number of folds to use during KFold cross validation
                 Default 5.
+            n_jobs: The number of processes to run the folds across. Default
+                1, running them one after another.
+            executor: A ParallelCV to schedule the folds on instead. If given
+                then a function printing the results is returned.
             n_components: The number of hidden states to use for feature
                 generation with the HMM. Default 2 (winning/losing)
+            latent: Which latent features to use, either 'hmm' for the HMM's
+                hidden state, 'kalman' for the latent form from a KalmanModel
+                or 'both'. Default 'hmm'.
+            n_dims: The dimension of the KalmanModel's latent form. Default 2
+            hmm_cache: The folder to persist the trained HMMs to, so that
+                reruns on the same data skip training and other data warm
+                starts from the closest cached HMM. Default None, only
+                caching them in memory.
     """
-    def printverbose(*msg):
-        if kwargs.get('verbose', 0) > 0:
-            print(*msg)
-
-    _X, _y = get_stat_inputs(X, y, keepSeriesID=True)
-
-    # size of _X.shape[1] with series ID since it gets replaced by hidden state
-    printverbose('Training with {} features'.format(_X.shape[1]))
-    printverbose('Training on {} samples'.format(_X.shape[0]))
-
-    # begin the training routine. We use K-fold to estimate the accuracy and
-    # generalization power of the models
-    sk_fold = KFold(n_splits=kwargs.get('n_splits', 5))
-    cum_acc = 0
-    for k, (train_idx, test_idx) in enumerate(sk_fold.split(_X, _y)):
-        hmm = \
-            FeatureGenerators.HiddenSpaceGenerator(_X[train_idx],
-                                                   kwargs.get('n_components',
-                                                              2))
-        # since one dimensional feature (with a different label for each
-        # component, then we instead stack vertically across all the series
-        # predictions then glue onto the end of the normal inputs
-        hiddenTrain = np.vstack((np.array(hmm.predict(x)).reshape(-1, 1)
-                                 for x in get_series_form(_X[train_idx])))
-        clf = BayesClassifier.from_samples(MultivariateGaussianDistribution,
-                                           np.hstack((_X[train_idx, 1:],
-                                                      hiddenTrain)),
-                                           _y[train_idx].flatten())
-
-        hiddenTest = np.vstack((np.array(hmm.predict(x)).reshape(-1, 1)
-                                for x in get_series_form(_X[test_idx])))
-        acc = accuracy_score(_y[test_idx].flatten(),
-                             clf.predict(np.hstack((_X[test_idx, 1:],
-                                                    hiddenTest))))
-        printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
-        cum_acc = (k * cum_acc + acc) / (k + 1.)
-        printverbose('\tCurrent cumulative accuracy:', cum_acc)
-
-    print('Cumulative accuracy after {} folds: {}'.format(k + 1, cum_acc))
+    return _train_model('temporal_stat', X, y, **kwargs)
 
 
 def train_temporal_comp_stat_bayes(X, y, **kwargs):
@@ -413,48 +632,22 @@ def train_temporal_comp_stat_bayes(X, y, **kwargs):
                 about the training process during training. Default 0.
             n_splits: The number of folds to use during KFold cross validation
                 Default 5.
+            n_jobs: The number of processes to run the folds across. Default
+                1, running them one after another.
+            executor: A ParallelCV to schedule the folds on instead. If given
+                then a function printing the results is returned.
             n_components: The number of hidden states to use for feature
                 generation with the HMM. Default 2 (winning/losing)
+            latent: Which latent features to use, either 'hmm' for the HMM's
+                hidden state, 'kalman' for the latent form from a KalmanModel
+                or 'both'. Default 'hmm'.
+            n_dims: The dimension of the KalmanModel's latent form. Default 2
+            hmm_cache: The folder to persist the trained HMMs to, so that
+                reruns on the same data skip training and other data warm
+                starts from the closest cached HMM. Default None, only
+                caching them in memory.
     """
-    def printverbose(*msg):
-        if kwargs.get('verbose', 0) > 0:
-            print(*msg)
-
-    _X, _y = get_comp_stat_inputs(X, y, keepSeriesID=True)
-
-    # size of _X.shape[1] with series ID since it gets replaced by hidden state
-    printverbose('Training with {} features'.format(_X.shape[1]))
-    printverbose('Training on {} samples'.format(_X.shape[0]))
-
-    # begin the training routine. We use K-fold to estimate the accuracy and
-    # generalization power of the models
-    sk_fold = KFold(n_splits=kwargs.get('n_splits', 5))
-    cum_acc = 0
-    for k, (train_idx, test_idx) in enumerate(sk_fold.split(_X, _y)):
-        hmm = \
-            FeatureGenerators.HiddenSpaceGenerator(_X[train_idx],
-                                                   kwargs.get('n_components',
-                                                              2))
-        # since one dimensional feature (with a different label for each
-        # component, then we instead stack vertically across all the series
-        # predictions then glue onto the end of the normal inputs
-        hiddenTrain = np.vstack((np.array(hmm.predict(x)).reshape(-1, 1)
-                                 for x in get_series_form(_X[train_idx])))
-        clf = BayesClassifier.from_samples(MultivariateGaussianDistribution,
-                                           np.hstack((_X[train_idx, 1:],
-                                                      hiddenTrain)),
-                                           _y[train_idx].flatten())
-
-        hiddenTest = np.vstack((np.array(hmm.predict(x)).reshape(-1, 1)
-                                for x in get_series_form(_X[test_idx])))
-        acc = accuracy_score(_y[test_idx].flatten(),
-                             clf.predict(np.hstack((_X[test_idx, 1:],
-                                                    hiddenTest))))
-        printverbose('Fold {} accuracy: {}'.format(k + 1, acc))
-        cum_acc = (k * cum_acc + acc) / (k + 1.)
-        printverbose('\tCurrent cumulative accuracy:', cum_acc)
-
-    print('Cumulative accuracy after {} folds: {}'.format(k + 1, cum_acc))
+    return _train_model('temporal_comp_stat', X, y, **kwargs)
 
 
 # The collection of models trainable on. The 'model' command line argument
@@ -468,8 +661,11 @@ _MODELS = {'naive_non_stat': train_naive_non_stat_bayes,
            }
 
 
-def parse_args():
+def parse_args(argv=None):
     """To get the necessary arguments from the command line
+
+    Arguments:
+        argv: The arguments, default those of the command line
     """
     parser = argparse.ArgumentParser(
         description='Training a model and getting an estimated level of '
@@ -484,31 +680,179 @@ def parse_args():
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Whether to output more training information '
                              'execution and training.')
-    return parser.parse_args()
+    parser.add_argument('--latent', choices=('hmm', 'kalman', 'both'),
+                        default='hmm',
+                        help='The latent features of the temporal models, '
+                             'the HMM\'s hidden state, the Kalman filter\'s '
+                             'latent form or both.')
+    parser.add_argument('--hmm-cache', type=str, default=None,
+                        help='A folder to persist the trained HMMs to, so '
+                             'that reruns skip or warm start their training.')
+    parser.add_argument('--save', type=str, default=None,
+                        help='Instead of cross validating, fit the model on '
+                             'the whole dataset and save it to this file for '
+                             'predict.py.')
+    parser.add_argument('--walk-forward', action='store_true',
+                        help='Instead of K-fold cross validation, test on '
+                             'each season after training on the seasons '
+                             'before it.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes to run the folds (and '
+                             'models if all) across. 0 uses every cpu.')
+    parser.add_argument('--chunk-rows', type=int, default=65536,
+                        help='For features saved as .npy, which are trained '
+                             'on out of core, the number of rows to read at '
+                             'once.')
+    workqueue.add_arguments(parser)
+    instrument.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def load_data(path):
+    """Loads the features saved by feature_gen.py, returning X, y and the
+    schema describing the columns (None if saved before schemas were)
+
+    Arguments:
+        path: The features file
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    # convert back to numpy since json can't serialize numpy arrays
+    X = np.array(data[0], dtype=None)
+    y = np.array(data[1], dtype=None)
+    return X, y, data[2] if len(data) > 2 else None
 
 
-def main():
+def _main_out_of_core(args):
+    """Trains on features saved as .npy a chunk of rows at a time, with the
+    same options as main except for walk forward and the number of jobs
+
+    Arguments:
+        args: The parsed command line arguments
+    """
+    import out_of_core
+
+    try:
+        features = out_of_core.FeatureFile(args.data)
+    except:
+        print('COULDN\'T OPEN', args.data)
+        exit(1)
+    if args.model != 'all' and args.model not in _MODELS or \
+            args.save is not None and args.model == 'all':
+        print('INVALID MODEL')
+        exit(1)
+    if args.walk_forward:
+        print('WALK FORWARD NEEDS THE FEATURES IN MEMORY')
+        exit(1)
+
+    kwargs = dict(chunk_rows=args.chunk_rows, latent=args.latent)
+    try:
+        if args.save is not None:
+            with instrument.span('train_models.fit', model=args.model):
+                model = out_of_core.fit(features, args.model, **kwargs)
+            model.save(args.save)
+            print('SAVED', args.model, 'TO', args.save)
+            return
+
+        names = list(_MODELS) if args.model == 'all' else [args.model]
+        for name in names:
+            if args.model == 'all':
+                print('TESTING:', name)
+            with instrument.span('train_models.cross_validate', model=name):
+                results = out_of_core.cross_validate(features, name,
+                                                     verbose=args.verbose,
+                                                     **kwargs)
+            print('Cumulative accuracy after {} folds: {}'.format(
+                len(results), np.mean(results)))
+    except ValueError as e:
+        print(str(e).upper())
+        exit(1)
+
+
+def main(argv=None, load=load_data):
     """When called from the command line
+
+    Arguments:
+        argv: The arguments, default those of the command line
+        load: The function loading the features, eg. worker.py's which keeps
+            them loaded between jobs
     """
-    args = parse_args()
+    args = parse_args(argv)
+    instrument.start(args, 'train_models')
+
+    if args.data.endswith('.npy'):
+        _main_out_of_core(args)
+        return
 
     X = np.array((0, 0))
     y = np.array((0, 0))
     try:
-        with open(args.data, 'r') as f:
-            X, y = json.load(f)
-        # convert back to numpy since json can't serialize numpy arrays
-        X = np.array(X, dtype=None)
-        y = np.array(y, dtype=None)
-
+        with instrument.span('train_models.load_data'):
+            X, y, schema = load(args.data)
     except:
         print('COULDN\'T OPEN', args.data)
         exit(1)
 
+    if args.save is not None:
+        if args.model not in _MODELS:
+            print('INVALID MODEL')
+            exit(1)
+
+        # fit on the whole dataset rather than cross validating
+        import model_io
+        with instrument.span('train_models.fit', model=args.model):
+            model = model_io.fit_model(args.model, X, y, schema=schema,
+                                       latent=args.latent,
+                                       hmm_cache=args.hmm_cache)
+        model.save(args.save)
+        print('SAVED', args.model, 'TO', args.save)
+        return
+
+    if args.walk_forward:
+        if args.model != 'all' and args.model not in _MODELS:
+            print('INVALID MODEL')
+            exit(1)
+        if schema is None:
+            print('THE SEASONS ARE UNKNOWN, REGENERATE THE FEATURES')
+            exit(1)
+
+        names = list(_MODELS) if args.model == 'all' else [args.model]
+        for name in names:
+            if args.model == 'all':
+                print('TESTING:', name)
+            with instrument.span('train_models.walk_forward', model=name):
+                results = walk_forward(X, y, schema,
+                                       get_model_spec(
+                                           name, latent=args.latent,
+                                           hmm_cache=args.hmm_cache),
+                                       verbose=args.verbose)
+            n_rows = sum(n for _, n, _ in results)
+            print('Walk forward accuracy over {} seasons: {}'.format(
+                len(results), sum(n * acc for _, n, acc in results) /
+                max(n_rows, 1)))
+        return
+
     if args.model == 'all':
-        for name, model in _MODELS.items():
-            print('TESTING:', name)
-            model(X, y, verbose=args.verbose)
+        # schedule every model's folds on the same pool (or queue) first,
+        # then report each of them in order as they finish
+        with workqueue.make_executor(args, args.jobs) as executor:
+            # every model goes through the harness together, so that any
+            # stage they share is computed only once for each fold
+            specs = [get_model_spec(name, latent=args.latent,
+                                    hmm_cache=args.hmm_cache)
+                     for name in _MODELS]
+            if args.verbose:
+                for key, group in cv_harness.plan(specs).items():
+                    print('SHARING', key[0], 'BETWEEN',
+                          ', '.join(spec.name for spec in group))
+            reports = _cross_validate(X, y, specs, verbose=args.verbose,
+                                      executor=executor)
+            for name, report in zip(_MODELS, reports):
+                print('TESTING:', name)
+                # only waits on the folds left, as the pool runs them all
+                with instrument.span('train_models.cross_validate',
+                                     model=name):
+                    report()
 
     else:
         if args.model not in _MODELS:
@@ -516,7 +860,12 @@ def main():
             exit(1)
 
         # run the training routine
-        _MODELS[args.model](X, y, verbose=args.verbose)
+        with workqueue.make_executor(args, args.jobs) as executor, \
+                instrument.span('train_models.cross_validate',
+                                model=args.model):
+            _MODELS[args.model](X, y, verbose=args.verbose, executor=executor,
+                                latent=args.latent,
+                                hmm_cache=args.hmm_cache)()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+# walk_forward.py
+# Evaluates a model the way it would be used: trained on every season before
+# a season, tested on that season, then that season is added to the model and
+# the next one is tested. Rather than refitting for every season, the
+# classifier's sufficient statistics are added to and the latent models
+# continue training from where the last season left them
+
+import numpy as np
+
+from gaussian_bayes import GaussianBayesClassifier, GaussianStats
+
+
+def row_seasons(series_ids, schema):
+    """Returns the season of every row, from the series ids and the schema
+
+    Arguments:
+        series_ids: The series id of each row
+        schema: The schema of the features from feature_gen.py
+    """
+    years = np.array([year for year, _ in schema['series']])
+    return years[np.asarray(series_ids, dtype=float).astype(int) - 1]
+
+
+def walk_forward(X, y, schema, spec, verbose=False):
+    """Tests the model on every season but the first, trained on the seasons
+    before it, and returns a list of (season, test rows, accuracy).
+
+    The classifier's statistics of each season are computed once and added
+    to the total after it has been tested. The temporal models' latent models
+    are warm started from the previous season's with the new season added,
+    but since their features of the earlier seasons change with them, then the
+    statistics of the earlier seasons are recomputed (in one pass, which is
+    cheap next to training them).
+
+    Arguments:
+        X: The features generated by feature_gen.py
+        y: The labels
+        schema: The schema of the features, for the season of each series
+        spec: The cv_harness.ModelSpec of the model
+        verbose: Whether to print each season as it is tested
+    """
+    _X, _y = spec.inputs(X, y, keepSeriesID=True)
+    _y = np.asarray(_y).flatten()
+    seasons = row_seasons(_X[:, 0], schema)
+    years = np.unique(seasons)
+
+    classes = np.unique(_y)
+    results = []
+
+    def record(year, clf, inputs, labels):
+        acc = np.mean(clf.predict(inputs) == labels)
+        results.append((int(year), len(labels), acc))
+        if verbose:
+            print('Season {} accuracy: {}'.format(year, acc))
+
+    if spec.latent is None:
+        # every season's statistics with the same shift, so they can be added
+        inputs = _X[:, 1:]
+        shift = inputs.mean(axis=0)
+        total = None
+        for year in years:
+            test = seasons == year
+            if total is not None:
+                record(year, GaussianBayesClassifier.from_stats(total),
+                       inputs[test], _y[test])
+            block = GaussianStats.from_samples(inputs[test], _y[test],
+                                               classes, shift)
+            total = block if total is None else total + block
+        return results
+
+    latent = None
+    for year in years[1:]:
+        train = seasons < year
+        latent = spec.latent.fit(_X[train]) if latent is None \
+            else spec.latent.refit(latent, _X[train])
+
+        # the latent features of the training seasons and the tested one in
+        # one batched call
+        seen = seasons <= year
+        inputs = np.hstack((_X[seen, 1:],
+                            spec.latent.transform(latent, _X[seen])))
+        before = seasons[seen] < year
+        stats = GaussianStats.from_samples(inputs[before], _y[seen][before],
+                                           classes)
+        record(year, GaussianBayesClassifier.from_stats(stats),
+               inputs[~before], _y[seen][~before])
+    return results
@@ -0,0 +1,236 @@
+# worker.py
+# A persistent worker for train_models.py. Starting python and importing
+# numpy, sklearn and pomegranate takes longer than many of the jobs a sweep
+# runs, so the worker imports everything once, keeps every dataset it has
+# loaded (though not what each job computes from it), and runs the jobs
+# sent to it over a Unix socket one after another, streaming back their
+# output. Only the standard library is imported until the worker starts, so
+# sending it a job is quick too
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import traceback
+
+
+# the socket the worker listens on unless told otherwise, one per user since
+# the temporary directory is shared
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+                              'march_madness_worker-{}.sock'.format(
+                                  os.getuid()))
+
+# the features loaded so far, keyed by their absolute path, with the
+# modification time and size of the file they were loaded from
+_DATASETS = {}
+
+
+def load_data(path):
+    """Loads the features as train_models.load_data does, but only once
+    unless the file has changed since
+
+    Arguments:
+        path: The features file
+    """
+    import train_models
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if path not in _DATASETS or _DATASETS[path][0] != version:
+        _DATASETS[path] = (version, train_models.load_data(path))
+    return _DATASETS[path][1]
+
+
+def warm(preload=()):
+    """Imports everything the jobs use and loads the given features, so the
+    first job doesn't wait on them
+
+    Arguments:
+        preload: The features files to load
+    """
+    import train_models  # noqa: F401
+    import sklearn.model_selection  # noqa: F401
+    try:
+        import pomegranate  # noqa: F401
+    except ImportError:
+        pass  # only needed by the temporal models
+    for path in preload:
+        load_data(path)
+
+
+class _Stream():
+    """A file which sends what is written to it to the client as JSON lines
+    of {"out": text}
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        if text:
+            self.wfile.write((json.dumps({'out': text}) + '\n').encode())
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def run_job(job, out):
+    """Runs a job in this process and returns its exit code
+
+    Arguments:
+        job: The dict of the 'argv' of train_models.py and the 'cwd' its
+            paths are relative to
+        out: The file its output is written to
+    """
+    import cv_harness
+    import instrument
+    import train_models
+
+    # every job starts with nothing memoized, so the memory doesn't grow with
+    # each job and no job can get values memoized for another's dataset
+    cv_harness.clear_cache()
+    train_models._MASK_CACHE.clear()
+
+    cwd = os.getcwd()
+    code = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            os.chdir(job.get('cwd', cwd))
+            train_models.main(job['argv'], load=load_data)
+        except SystemExit as e:
+            # exit() and argparse's errors, as a command line would see them
+            code = e.code if isinstance(e.code, int) else \
+                (0 if e.code is None else 1)
+            if isinstance(e.code, str):
+                print(e.code)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            instrument.finish()
+            os.chdir(cwd)
+    return code
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Reads a job as a line of JSON, runs it and answers with its output as
+    JSON lines of {"out": text} then {"exit": code}
+    """
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+        except ValueError:
+            self.wfile.write(b'{"out": "INVALID JOB\\n"}\n{"exit": 1}\n')
+            return
+        if self.server.verbose:
+            print('RUNNING', ' '.join(job.get('argv', [])))
+        out = _Stream(self.wfile)
+        code = run_job(job, out)
+        self.wfile.write((json.dumps({'exit': code}) + '\n').encode())
+        if self.server.verbose:
+            print('FINISHED WITH', code)
+
+
+def make_server(path, verbose=False):
+    """Makes the worker, which runs one job at a time. Only its own user can
+    connect to the socket, as a job can run anything train_models.py can,
+    eg. --save to any path.
+
+    Arguments:
+        path: The Unix socket to listen on
+        verbose: Whether to print every job
+    """
+    # the socket is created with mode 0600 rather than changed after binding,
+    # so there is no moment anyone else could connect
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(path, JobHandler)
+    finally:
+        os.umask(umask)
+    server.verbose = verbose
+    return server
+
+
+def submit(path, argv, out=None):
+    """Sends a job to the worker and returns its exit code, writing its
+    output as it arrives
+
+    Arguments:
+        path: The worker's Unix socket
+        argv: The arguments of train_models.py, relative to this directory
+        out: The file to write the output to, default standard out
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps({'argv': list(argv),
+                                  'cwd': os.getcwd()}) + '\n').encode())
+        for line in sock.makefile('rb'):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            print(message['out'], end='', file=out, flush=True)
+    return 1  # the worker went away before the job finished
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Keep a process warm with the libraries and datasets '
+                    'loaded to run train_models.py jobs, or send it a job.',
+        usage='%(prog)s [-h] [--socket SOCKET] [--preload FILES] [-v] '
+              '[train_models.py arguments ...]')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help='The Unix socket of the worker.')
+    parser.add_argument('--preload', type=str, default='',
+                        help='The features files to load when starting, '
+                             'separated by commas.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print every job the worker runs.')
+    parser.add_argument('job', nargs=argparse.REMAINDER,
+                        help='The arguments of train_models.py to run on the '
+                             'worker. If none then start the worker.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+
+    # a -- separates the job's arguments from the worker's
+    job = args.job[1:] if args.job[:1] == ['--'] else args.job
+    if job:
+        try:
+            code = submit(args.socket, job)
+        except OSError:
+            print('COULDN\'T CONNECT TO', args.socket)
+            exit(1)
+        exit(code)
+
+    path = os.path.abspath(args.socket)
+    try:
+        warm([f for f in args.preload.split(',') if f])
+    except IOError as e:
+        print('COULDN\'T OPEN', e.filename)
+        exit(1)
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = make_server(path, args.verbose)
+    print('WORKING ON', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,609 @@
+# workqueue.py
+# Runs the tasks of the heavy command line tools (the folds of the cross
+# validation, the trials of the search, chunks of the bracket simulations and
+# the seasons of the pipeline's features) on workers on any number of
+# machines. The tool being run is the coordinator: it listens on a port, and
+# every worker started with `python3 workqueue.py host:port` connects to it and
+# asks for one task at a time. The messages are pickled over
+# multiprocessing.connection, authenticated with a shared key, so the workers
+# must be trusted and run the same code, which is checked when they connect.
+# With no key set it only listens on this machine, with a random key.
+# A task is leased to its worker, which sends a heartbeat while running it,
+# and is given to another worker if its worker goes away or goes quiet for
+# longer than the lease. Large arrays are sent to each worker only once
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import importlib
+import ipaddress
+import itertools
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+
+# the port the coordinator listens on if not given
+DEFAULT_PORT = 8765
+
+# the environment variable of the key shared by the coordinator and workers
+AUTHKEY_VARIABLE = 'MARCH_MADNESS_QUEUE_KEY'
+
+# the interface the coordinator listens on if not given, so that only
+# workers on this machine can connect unless asked otherwise
+DEFAULT_HOST = '127.0.0.1'
+
+
+class RemoteError(Exception):
+    """A task raised an exception on its worker. Its message is the worker's
+    traceback.
+    """
+
+
+class TaskLost(Exception):
+    """A task's workers went away more times than it is retried, or the
+    coordinator was closed before it finished
+    """
+
+
+def authkey():
+    """Returns the key shared by the coordinator and workers from the
+    environment, or None if it isn't set
+    """
+    key = os.environ.get(AUTHKEY_VARIABLE)
+    return key.encode() if key else None
+
+
+def is_loopback(host):
+    """Whether the host is only reachable from this machine
+
+    Arguments:
+        host: The host name or address
+    """
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def parse_address(text):
+    """Parses host:port (or just a port, on DEFAULT_HOST) into an address.
+    The default port is DEFAULT_PORT.
+
+    Arguments:
+        text: The address
+    """
+    host, _, port = text.rpartition(':') if ':' in text else ('', '', text)
+    if not port.isdigit():
+        host, port = text, ''
+    return host or DEFAULT_HOST, int(port) if port else DEFAULT_PORT
+
+
+def code_version():
+    """Returns a hash of every python file beside this one, which the
+    coordinator and workers must agree on since the tasks are pickled by
+    reference to their functions
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(here)):
+        if name.endswith('.py'):
+            digest.update(name.encode())
+            with open(os.path.join(here, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _main_module():
+    """Returns the name of the script the coordinator was run as if it is
+    one of the files beside this one, or None. What it defines is pickled as
+    __main__'s, which the workers must import by its name instead.
+    """
+    path = getattr(sys.modules['__main__'], '__file__', None)
+    here = os.path.dirname(os.path.abspath(__file__))
+    if path is None or os.path.dirname(os.path.abspath(path)) != here:
+        return None
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class ArrayRef():
+    """Stands in for a numpy array in a task's arguments, which the worker
+    asks the coordinator for the first time it sees it and keeps after
+    """
+    def __init__(self, key):
+        self.key = key
+
+
+class _Task():
+    def __init__(self, tid, func, args, kwargs):
+        self.tid = tid
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+
+
+class Coordinator():
+    """Hands out tasks to the workers which connect to it and collects their
+    results as futures
+    """
+    def __init__(self, address=(DEFAULT_HOST, DEFAULT_PORT), lease=60.,
+                 retries=3, verbose=False, key=None):
+        """
+        Arguments:
+            address: The (host, port) to listen on, where port 0 picks one
+            lease: How long a worker may go without a heartbeat or result
+                before its task is given to another worker, in seconds
+            retries: How many times a task whose worker went away is given
+                to another worker before its future fails with TaskLost
+            verbose: Whether to print the workers as they come and go
+            key: The key the workers must have, as bytes. Default is the
+                one in the environment. If neither is set then a random one
+                is made (see generated_key), which is only allowed when
+                listening on this machine, since anyone with the key can run
+                code on it.
+        """
+        if key is None:
+            key = authkey()
+        # the key made up here, which the local workers need to be given
+        self.generated_key = None
+        if key is None:
+            if not is_loopback(address[0]):
+                raise ValueError('Set {} to listen on {}, as anyone with the '
+                                 'key can run code here'.format(
+                                     AUTHKEY_VARIABLE, address[0]))
+            key = secrets.token_hex(16).encode()
+            self.generated_key = key.decode()
+        self.key = key
+
+        self.lease = lease
+        self.retries = retries
+        self.verbose = verbose
+        self.stats = collections.Counter()
+
+        self._version = code_version()
+        self._tasks = collections.deque()
+        self._arrays = {}
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._listener = Listener(address, authkey=key)
+        self.address = self._listener.address
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def share(self, array):
+        """Returns an ArrayRef to put in tasks' arguments in place of the
+        array, so that each worker only receives it once
+
+        Arguments:
+            array: The numpy array
+        """
+        digest = hashlib.sha256('{}{}'.format(array.dtype.str, array.shape)
+                                .encode())
+        digest.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+        key = digest.hexdigest()
+        with self._cond:
+            self._arrays[key] = array
+        return ArrayRef(key)
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) to run on a worker and returns its
+        concurrent.futures.Future. func must be picklable, ie. a function
+        defined at the top of a module.
+
+        Arguments:
+            func: The function
+            args: Its arguments, where an ArrayRef becomes its array
+            kwargs: Its keyword arguments
+        """
+        task = _Task(next(self._ids), func, args, kwargs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('The coordinator is closed')
+            self._tasks.append(task)
+            self.stats['submitted'] += 1
+            self._cond.notify()
+        return task.future
+
+    def map(self, func, iterable):
+        """Runs func on every item on the workers and returns the results in
+        order, as the builtin map
+
+        Arguments:
+            func: The function
+            iterable: Its argument of each task
+        """
+        futures = [self.submit(func, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                continue  # eg. a client with the wrong key
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _next(self):
+        """Waits for the next task, or returns None once closed
+        """
+        with self._cond:
+            while not self._tasks and not self._closed:
+                self._cond.wait()
+            return self._tasks.popleft() if self._tasks else None
+
+    def _lost(self, task):
+        """Gives a task whose worker went away to another, unless it has been
+        tried too many times
+        """
+        with self._cond:
+            if task.attempts > self.retries or self._closed:
+                self.stats['lost'] += 1
+                task.future.set_exception(TaskLost(
+                    'Task {} was lost {} times'.format(task.tid,
+                                                       task.attempts)))
+            else:
+                self.stats['retried'] += 1
+                self._tasks.appendleft(task)
+                self._cond.notify()
+
+    def _serve(self, conn):
+        """Talks to one worker until it goes away or the coordinator closes
+        """
+        task = None
+        name = '?'
+        try:
+            _, version, name = conn.recv()
+            if version != self._version:
+                conn.send(('reject', 'the worker\'s code differs'))
+                if self.verbose:
+                    print('REJECTED WORKER', name, '(DIFFERENT CODE)')
+                return
+            conn.send(('welcome', _main_module()))
+            self.stats['workers'] += 1
+            if self.verbose:
+                print('WORKER JOINED', name)
+
+            while True:
+                conn.recv()  # ready for a task
+                task = self._next()
+                if task is None:
+                    conn.send(('stop',))
+                    return
+                conn.send(('task', task.tid, task.func, task.args,
+                           task.kwargs))
+                task.attempts += 1
+
+                while True:
+                    if not conn.poll(self.lease):
+                        raise TimeoutError('no heartbeat from ' + name)
+                    message = conn.recv()
+                    if message[0] == 'array':
+                        with self._cond:
+                            array = self._arrays[message[1]]
+                        conn.send(('array', message[1], array))
+                    elif message[0] == 'result':
+                        self.stats['done'] += 1
+                        task.future.set_result(message[2])
+                        break
+                    elif message[0] == 'error':
+                        self.stats['failed'] += 1
+                        task.future.set_exception(RemoteError(message[2]))
+                        break
+                    # otherwise a heartbeat, which renews the lease
+                task = None
+        except Exception:
+            if self.verbose:
+                print('WORKER LEFT', name)
+            if task is not None and not task.future.done():
+                self._lost(task)
+        finally:
+            conn.close()
+
+    def close(self):
+        """Stops handing out tasks, telling idle workers to stop, and fails
+        any task which hasn't finished
+        """
+        with self._cond:
+            self._closed = True
+            pending = list(self._tasks)
+            self._tasks.clear()
+            self._cond.notify_all()
+        for task in pending:
+            task.future.set_exception(TaskLost('The coordinator closed'))
+        self._listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class QueueCV():
+    """Runs the folds of the cross validations on a Coordinator's workers,
+    with the same submit as parallel_cv.ParallelCV so it can be used in its
+    place
+    """
+    def __init__(self, coordinator, own=True):
+        """
+        Arguments:
+            coordinator: The Coordinator
+            own: Whether closing this closes the coordinator too
+        """
+        self.coordinator = coordinator
+        self.own = own
+
+    def submit(self, fold_func, X, y, n_splits=5, pass_fold=False, folds=None,
+               **kwargs):
+        """See ParallelCV.submit
+        """
+        import instrument
+        from parallel_cv import FoldResults, ProfiledFold, fold_splits
+
+        X_ref = self.coordinator.share(X)
+        y_ref = self.coordinator.share(y)
+        futures = []
+        for k, train_idx, test_idx in fold_splits(X, y, n_splits, folds):
+            fold_kwargs = dict(kwargs, fold=k) if pass_fold else kwargs
+            if instrument.enabled():
+                # profiled on the worker, and merged into this profile
+                futures.append(ProfiledFold(self.coordinator.submit(
+                    instrument.run_profiled, fold_func, X_ref, y_ref,
+                    train_idx, test_idx, **fold_kwargs)))
+            else:
+                futures.append(self.coordinator.submit(
+                    fold_func, X_ref, y_ref, train_idx, test_idx,
+                    **fold_kwargs))
+        return FoldResults(futures)
+
+    def map(self, func, iterable):
+        """See Coordinator.map
+        """
+        return self.coordinator.map(func, iterable)
+
+    def close(self):
+        if self.own:
+            self.coordinator.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_arguments(parser):
+    """Adds the --queue option to a command line parser
+
+    Arguments:
+        parser: The argparse.ArgumentParser
+    """
+    parser.add_argument('--queue', type=str, default=None,
+                        help='Listen on this [host:]port for workers started '
+                             'by workqueue.py and run the tasks on them '
+                             'instead of local processes.')
+
+
+def start_coordinator(args):
+    """Makes the Coordinator of --queue and prints where the workers should
+    connect, and the key they need if one was made up. Exits if a key is
+    needed and isn't set.
+
+    Arguments:
+        args: The parsed command line arguments
+    """
+    try:
+        coordinator = Coordinator(parse_address(args.queue),
+                                  verbose=getattr(args, 'verbose', False))
+    except ValueError as e:
+        print(e)
+        exit(1)
+    print('WAITING FOR WORKERS ON {}:{}'.format(*coordinator.address))
+    if coordinator.generated_key is not None:
+        print('WITH {}={}'.format(AUTHKEY_VARIABLE,
+                                  coordinator.generated_key))
+    return coordinator
+
+
+def make_executor(args, n_jobs=1):
+    """Returns a QueueCV if --queue was given, otherwise a ParallelCV
+
+    Arguments:
+        args: The parsed command line arguments
+        n_jobs: The number of local processes if not using the queue
+    """
+    if getattr(args, 'queue', None) is None:
+        from parallel_cv import ParallelCV
+        return ParallelCV(n_jobs)
+
+    return QueueCV(start_coordinator(args))
+
+
+def _resolve(value, conn, arrays):
+    """Returns the value, or the array if it is an ArrayRef, asking the
+    coordinator for it if it isn't kept yet
+    """
+    if not isinstance(value, ArrayRef):
+        return value
+    if value.key not in arrays:
+        conn.send(('array', value.key))
+        _, key, array = conn.recv()
+        arrays[key] = array
+    return arrays[value.key]
+
+
+def _heartbeat(conn, lock, tid, every, stop):
+    while not stop.wait(every):
+        with lock:
+            conn.send(('alive', tid))
+
+
+def work(address, name=None, heartbeat=5., max_tasks=None, key=None):
+    """Runs tasks from the coordinator at the address until it tells this
+    worker to stop or goes away. Returns the number of tasks run.
+
+    Arguments:
+        address: The coordinator's (host, port)
+        name: How the coordinator refers to this worker
+        heartbeat: How often to tell the coordinator the task is still
+            running, in seconds, which must be well under its lease
+        max_tasks: Stop after this many tasks, eg. to test losing tasks
+        key: The coordinator's key, as bytes. Default is the one in the
+            environment.
+    """
+    key = key if key is not None else authkey()
+    if key is None:
+        raise RuntimeError('Set {} to the coordinator\'s key'.format(
+            AUTHKEY_VARIABLE))
+    conn = Client(address, authkey=key)
+    lock = threading.Lock()
+    arrays = {}
+    n_tasks = 0
+    try:
+        conn.send(('hello', code_version(),
+                   name or '{}:{}'.format(socket.gethostname(),
+                                          os.getpid())))
+        reply = conn.recv()
+        if reply[0] == 'reject':
+            raise RuntimeError('Rejected by the coordinator: ' + reply[1])
+        if reply[1] is not None:
+            # so that what the coordinator's script defines unpickles here
+            sys.modules['__main__'] = importlib.import_module(reply[1])
+
+        while max_tasks is None or n_tasks < max_tasks:
+            conn.send(('ready',))
+            message = conn.recv()
+            if message[0] == 'stop':
+                break
+            _, tid, func, args, kwargs = message
+            args = [_resolve(arg, conn, arrays) for arg in args]
+
+            stop = threading.Event()
+            beating = threading.Thread(target=_heartbeat,
+                                       args=(conn, lock, tid, heartbeat,
+                                             stop), daemon=True)
+            beating.start()
+            try:
+                result = ('result', tid, func(*args, **kwargs))
+            except Exception:
+                result = ('error', tid, traceback.format_exc())
+            stop.set()
+            beating.join()
+
+            with lock:
+                try:
+                    conn.send(result)
+                except Exception:
+                    # eg. the result can't be pickled
+                    conn.send(('error', tid, traceback.format_exc()))
+            n_tasks += 1
+    except (EOFError, OSError):
+        pass  # the coordinator went away
+    finally:
+        conn.close()
+    return n_tasks
+
+
+def start_local_workers(coordinator, n_workers, **kwargs):
+    """Starts worker processes on this machine for the coordinator, eg. for
+    testing, and returns their subprocess.Popen
+
+    Arguments:
+        coordinator: The Coordinator
+        n_workers: The number of processes
+        kwargs: Passed on to subprocess.Popen
+    """
+    host, port = coordinator.address
+    env = dict(kwargs.pop('env', os.environ),
+               **{AUTHKEY_VARIABLE: coordinator.key.decode()})
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '{}:{}'.format(host, port), '--once'],
+                             env=env, **kwargs)
+            for _ in range(n_workers)]
+
+
+def parse_args():
+    """To get the necessary arguments from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Run the tasks of a train_models.py, search.py, '
+                    'bracket.py or pipeline.py started with --queue. The key '
+                    'shared with it is read from ' + AUTHKEY_VARIABLE + '.')
+    parser.add_argument('address', type=str,
+                        help='The host:port the coordinator listens on.')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='The number of worker processes to run.')
+    parser.add_argument('--once', action='store_true',
+                        help='Stop when the coordinator does, rather than '
+                             'waiting for the next one.')
+    parser.add_argument('--heartbeat', type=float, default=5.,
+                        help='How often to tell the coordinator a task is '
+                             'still running, in seconds.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print when connecting to a coordinator.')
+    return parser.parse_args()
+
+
+def main():
+    """When called from the command line
+    """
+    args = parse_args()
+    address = parse_address(args.address)
+    # the tasks refer to this module by its name (eg. ArrayRef), not as
+    # __main__, so the worker is run from it
+    import workqueue
+
+    if args.workers > 1:
+        # each worker is its own process, started the same way
+        argv = [sys.executable, os.path.abspath(__file__), args.address,
+                '--heartbeat', str(args.heartbeat)] + \
+            (['--once'] if args.once else []) + \
+            (['-v'] if args.verbose else [])
+        workers = [subprocess.Popen(argv) for _ in range(args.workers)]
+        try:
+            exit(max(worker.wait() for worker in workers))
+        except KeyboardInterrupt:
+            exit(0)
+
+    try:
+        while True:
+            try:
+                n_tasks = workqueue.work(address, heartbeat=args.heartbeat)
+            except ConnectionRefusedError:
+                time.sleep(1.)  # no coordinator yet
+                continue
+            except AuthenticationError:
+                print('THE KEY DIFFERS FROM THE COORDINATOR\'S, SET',
+                      AUTHKEY_VARIABLE)
+                exit(1)
+            except RuntimeError as e:
+                print(e)
+                exit(1)
+            if args.verbose:
+                print('RAN', n_tasks, 'TASKS FOR', args.address)
+            if args.once:
+                break
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()